@@ -0,0 +1,91 @@
+"""
+Compares allocate_work against the previous fixed order queue scan.
+
+    python3 -m benchmarks.bench_allocate_work
+
+Groups are spread over every (table_type, af) work queue. Two cases are
+timed for each size: nothing is due yet (the common case between monitor
+cycles) and everything is overdue (each call deals one group).
+"""
+
+import time
+from types import SimpleNamespace
+from p2pd import IP4, IP6, VALID_AFS
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dealer.dealer_utils import allocate_work
+
+SIZES = (10_000, 100_000, 1_000_000)
+CALLS = 10_000
+
+def scan_allocate_work(mem_db, need_afs, table_types, cur_time, mon_freq):
+    # The linear scan allocate_work used before the ready heaps.
+    for table_choice in table_types:
+        for need_af in need_afs:
+            wq = mem_db.work[table_choice][need_af]
+            for status_type in (STATUS_INIT, STATUS_AVAILABLE, STATUS_DEALT,):
+                for group_id, meta_group in wq.queues[status_type]:
+                    if status_type == STATUS_INIT:
+                        wq.move_work(group_id, STATUS_DEALT)
+                        return meta_group.group
+
+                    work_timestamp = wq.timestamps[group_id]
+                    elapsed = max(0, cur_time - work_timestamp)
+                    if status_type != STATUS_DEALT:
+                        if elapsed < mon_freq:
+                            break
+
+                    if status_type == STATUS_DEALT:
+                        if elapsed < WORKER_TIMEOUT:
+                            break
+
+                    wq.move_work(group_id, STATUS_DEALT)
+                    return meta_group.group
+
+    return []
+
+def build_db(n):
+    # Lightweight payloads so setup cost doesn't dominate.
+    mem_db = MemDB()
+    queues = [
+        (table_type, af)
+        for table_type in TABLE_TYPES
+        for af in (int(IP4), int(IP6))
+    ]
+
+    for group_id in range(1, n + 1):
+        table_type, af = queues[group_id % len(queues)]
+        meta_group = SimpleNamespace(group=[])
+        mem_db.groups[group_id] = meta_group
+        mem_db.work[table_type][af].add_work(
+            group_id,
+            meta_group,
+            STATUS_AVAILABLE
+        )
+
+    return mem_db
+
+def time_calls(func, mem_db, cur_time):
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        func(mem_db, VALID_AFS, TABLE_TYPES, cur_time, MONITOR_FREQUENCY)
+
+    return (time.perf_counter() - start) / CALLS * 1e6
+
+def main():
+    print("groups     case      scan us/call  heap us/call")
+    for n in SIZES:
+        for case in ("idle", "overdue"):
+            results = []
+            for func in (scan_allocate_work, allocate_work):
+                mem_db = build_db(n)
+                cur_time = int(time.time())
+                if case == "overdue":
+                    cur_time += MONITOR_FREQUENCY * 2
+
+                results.append(time_calls(func, mem_db, cur_time))
+
+            print("%-10d %-9s %12.2f  %12.2f" % (n, case, *results))
+
+if __name__ == "__main__":
+    main()
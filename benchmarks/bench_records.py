@@ -0,0 +1,89 @@
+"""
+Memory and time for 1M services (+ their statuses) held as the pydantic
+models vs the slotted records MemDB now uses.
+
+    python3 -m benchmarks.bench_records [n]
+
+Measures building the rows (what sqlite_import does per row), turning
+them back into dicts (what the server list build does per record) and
+the memory held by the rows.
+"""
+
+import sys
+import time
+import tracemalloc
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db_defs import *
+
+SERVICE_NO = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+MEM_SAMPLE = 100_000
+NOW = int(time.time())
+
+def build(record_cls, status_cls, n):
+    rows = []
+    for i in range(1, n + 1):
+        record = record_cls(
+            id=i,
+            table_type=SERVICES_TABLE_TYPE,
+            type=STUN_MAP_TYPE,
+            af=int(IP4),
+            proto=int(UDP),
+            ip="8.8.%d.%d" % ((i >> 8) & 255, i & 255),
+            port=3478,
+            user=None,
+            password=None,
+            alias_id=None,
+            status_id=i,
+            group_id=i,
+            score=0
+        )
+
+        status = status_cls(
+            id=i,
+            row_id=i,
+            table_type=SERVICES_TABLE_TYPE,
+            status=STATUS_AVAILABLE,
+            last_status=NOW,
+            test_no=10,
+            failed_tests=1,
+            last_success=NOW,
+            last_uptime=NOW,
+            uptime=100,
+            max_uptime=200
+        )
+
+        rows.append((record, status))
+
+    return rows
+
+def bench(name, record_cls, status_cls):
+    start = time.perf_counter()
+    rows = build(record_cls, status_cls, SERVICE_NO)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for record, status in rows:
+        record.dict()
+    dict_time = time.perf_counter() - start
+    del rows
+
+    # tracemalloc slows building down a lot so sample memory separately.
+    sample = min(SERVICE_NO, MEM_SAMPLE)
+    tracemalloc.start()
+    rows = build(record_cls, status_cls, sample)
+    per_service = tracemalloc.get_traced_memory()[0] / sample
+    tracemalloc.stop()
+
+    print("%-9s build %6.2f s  dict() %5.2f s  %5d B/service  ~%6.0f MB" % (
+        name,
+        build_time,
+        dict_time,
+        per_service,
+        per_service * SERVICE_NO / 1e6
+    ))
+
+if __name__ == "__main__":
+    print("%d services" % (SERVICE_NO,))
+    bench("pydantic", RecordType, StatusType)
+    bench("slotted", Record, Status)
@@ -0,0 +1,63 @@
+"""
+Round trip cost of a /work call over HTTP vs the Unix socket RPC.
+
+    python3 -m benchmarks.bench_rpc
+
+Both sides run in this process so the numbers are the total CPU per
+message (client + dealer). Uses an empty MemDB so there's no work to
+hand out and transport overhead dominates.
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+import httpx
+from p2pd_server_monitor.dealer.dealer import app, mem_db
+from p2pd_server_monitor.dealer.dealer_core import DEALER_CALLS
+from p2pd_server_monitor.rpc import RPCServer, RPCClient, msgpack
+
+CALLS = 2000
+PARAMS = {
+    "stack_type": 2,
+    "table_type": None,
+    "current_time": None,
+    "monitor_frequency": None,
+    "max_groups": 10,
+    "max_seconds": None,
+}
+
+async def bench_http():
+    # Loopback is faked as the client address for localhost_only.
+    transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 1234))
+    async with httpx.AsyncClient(transport=transport, base_url="http://dealer") as client:
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            resp = await client.post("/work", json=PARAMS)
+            assert(resp.status_code == 200)
+
+        return time.perf_counter() - start
+
+async def bench_rpc():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dealer.sock")
+        server = await RPCServer(DEALER_CALLS, mem_db).start(path)
+        client = RPCClient(None, path)
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            await client.call("work", PARAMS)
+
+        duration = time.perf_counter() - start
+        await client.close()
+        await server.close()
+        return duration
+
+async def main():
+    http = await bench_http()
+    rpc = await bench_rpc()
+    codec = "msgpack" if msgpack is not None else "json"
+    print("http        %.1f us/call" % (http / CALLS * 1e6,))
+    print("rpc (%s) %.1f us/call" % (codec, rpc / CALLS * 1e6,))
+
+if __name__ == "__main__":
+    asyncio.run(main())
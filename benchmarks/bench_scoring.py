@@ -0,0 +1,95 @@
+"""
+Scoring 1M statuses one at a time vs in one NumPy pass.
+
+    python3 -m benchmarks.bench_scoring [n]
+
+The scalar run is what build_server_list used to do per record
+(status.dict() + compute_service_score). The batch run gathers the
+columns from the status objects, or reads them straight from the
+status store.
+
+Averaging the scores per group (1 - 4 members) is timed the same way:
+sum() per group vs group_score_averages.
+"""
+
+import sys
+import time
+import random
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db_defs import Status
+from p2pd_server_monitor.db.status_store import StatusStore
+from p2pd_server_monitor.dealer.dealer_utils import compute_service_score
+from p2pd_server_monitor.dealer.scoring import compute_service_scores, group_score_averages, np
+
+STATUS_NO = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+COLUMNS = ("test_no", "failed_tests", "uptime", "max_uptime")
+
+def build():
+    rand = random.Random(1)
+    statuses = []
+    for i in range(1, STATUS_NO + 1):
+        test_no = rand.randrange(0, 5000)
+        max_uptime = rand.randrange(0, 10 ** 7)
+        statuses.append(Status(
+            i, i, SERVICES_TABLE_TYPE, STATUS_AVAILABLE, 1735689700,
+            test_no, rand.randrange(0, test_no + 1), 0, 0,
+            rand.randrange(0, max_uptime + 1), max_uptime
+        ))
+
+    return statuses
+
+def main():
+    statuses = build()
+
+    start = time.perf_counter()
+    scalar = [compute_service_score(s.dict()) for s in statuses]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cols = [
+        np.fromiter((getattr(s, name) for s in statuses), np.int64, STATUS_NO)
+        for name in COLUMNS
+    ]
+    batch = compute_service_scores(*cols)
+    batch_time = time.perf_counter() - start
+
+    store = StatusStore(capacity=STATUS_NO + 1)
+    store.load(statuses)
+    start = time.perf_counter()
+    stored = compute_service_scores(*[store.column(name)[1:] for name in COLUMNS])
+    store_time = time.perf_counter() - start
+
+    # Consecutive statuses share a group like in build_server_list.
+    rand = random.Random(2)
+    group_index = []
+    while len(group_index) < STATUS_NO:
+        group_no = len(group_index) and group_index[-1] + 1
+        group_index.extend([group_no] * rand.randrange(1, 5))
+
+    group_index = group_index[:STATUS_NO]
+    group_no = group_index[-1] + 1
+    start = time.perf_counter()
+    members = [[] for _ in range(group_no)]
+    for score, group in zip(scalar, group_index):
+        members[group].append(score)
+
+    scalar_avg = [sum(m) / len(m) for m in members]
+    scalar_avg_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_avg = group_score_averages(batch, group_index, group_no)
+    batch_avg_time = time.perf_counter() - start
+
+    assert(batch.tolist() == scalar)
+    assert(stored.tolist() == scalar)
+    assert(batch_avg.tolist() == scalar_avg)
+    print("%d statuses" % (STATUS_NO,))
+    print("scalar              %.2f s" % (scalar_time,))
+    print("batch from objects  %.2f s" % (batch_time,))
+    print("batch from store    %.2f s" % (store_time,))
+    print("%d groups" % (group_no,))
+    print("scalar averages     %.2f s" % (scalar_avg_time,))
+    print("batch averages      %.2f s" % (batch_avg_time,))
+
+if __name__ == "__main__":
+    main()
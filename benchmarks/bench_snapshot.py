@@ -0,0 +1,64 @@
+"""
+Restart time from the snapshot + journal vs loading SQLite.
+
+    python3 -m benchmarks.bench_snapshot [services]
+
+Uses the same DB as bench_sqlite_import. Also times writing the
+snapshot and journaling 10k status changes.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_utils import sqlite_import
+from p2pd_server_monitor.db.mem_db_journal import MemDBJournal, recover_mem_db
+from benchmarks.bench_sqlite_import import build_db, SERVICE_NO
+
+CHANGES = 10_000
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "monitor.sqlite3")
+        snapshot_path = db_path + ".snapshot"
+        journal_path = db_path + ".journal"
+        await build_db(db_path)
+
+        mem_db = MemDB()
+        start = time.perf_counter()
+        await sqlite_import(mem_db, db_path)
+        sqlite_time = time.perf_counter() - start
+
+        journal = MemDBJournal(mem_db, journal_path, snapshot_path)
+        mem_db.journal = journal
+        start = time.perf_counter()
+        journal.snapshot()
+        snapshot_time = time.perf_counter() - start
+
+        # A burst of completed work.
+        status_ids = list(mem_db.statuses)[:CHANGES]
+        for status_id in status_ids:
+            mem_db.statuses[status_id].test_no += 1
+            mem_db.mark_dirty(STATUS_TABLE_TYPE, status_id)
+
+        start = time.perf_counter()
+        journal.flush()
+        flush_time = time.perf_counter() - start
+        journal.close()
+
+        start = time.perf_counter()
+        recover_mem_db(MemDB(), snapshot_path, journal_path)
+        recover_time = time.perf_counter() - start
+        snapshot_size = os.path.getsize(snapshot_path)
+
+    print("%d services" % (SERVICE_NO,))
+    print("sqlite load       %.2f s" % (sqlite_time,))
+    print("snapshot recovery %.2f s" % (recover_time,))
+    print("snapshot write    %.2f s (%.1f MB)" % (snapshot_time, snapshot_size / 1e6))
+    print("journal %d rows  %.3f s (fsync)" % (CHANGES, flush_time))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Soak test: many probes through service_monitor against local stand-ins
+while watching open file descriptors and asyncio tasks.
+
+    python3 -m benchmarks.bench_soak [probes]
+
+Runs PROBES (100k by default) STUN map, NTP, MQTT and TURN probes in
+turn with CONCURRENCY in flight. The stand-ins drop some requests and
+are "down" for some so the failure and timeout paths run too. Probes
+run in rounds of SAMPLE_EVERY. FD and task counts are sampled between
+rounds, when nothing is in flight, and must not climb past the first
+sample -- anything a probe leaves behind would make them grow.
+"""
+
+import os
+import sys
+import time
+import asyncio
+from p2pd import IP4, UDP, TCP, Interface
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.worker_monitors import service_monitor
+from p2pd_server_monitor.worker.udp_mux import UDPMux
+from benchmarks.standins import StunStandIn, NTPStandIn, MQTTStandIn, TURNStandIn
+from benchmarks.load_harness import LOOPBACK_INFO
+
+PROBES = 100000
+CONCURRENCY = 500
+SAMPLE_EVERY = 10000
+FD_SLACK = 2 # Sockets the loop may open lazily (e.g. self pipe.)
+
+def fd_count():
+    return len(os.listdir("/proc/self/fd"))
+
+def make_work(service_type, addr, proto=UDP, user=None, password=None):
+    return [{
+        "type": service_type,
+        "af": IP4,
+        "proto": proto,
+        "ip": addr[0],
+        "port": addr[1],
+        "user": user,
+        "password": password,
+    }]
+
+async def main(probes=PROBES):
+    stun = await StunStandIn(loss=0.01, fail=0.01, seed=1).start()
+    ntp = await NTPStandIn(loss=0.01, fail=0.01, seed=2).start()
+    mqtt = await MQTTStandIn(loss=0.01, fail=0.01, seed=3).start()
+    turn = await TURNStandIn(loss=0.01, fail=0.01, seed=4).start()
+    works = [
+        make_work(STUN_MAP_TYPE, stun.addr),
+        make_work(NTP_TYPE, ntp.addr),
+        make_work(MQTT_TYPE, mqtt.addr, TCP),
+        make_work(TURN_TYPE, turn.addr, UDP, "user", "pass"),
+    ]
+
+    # MQTT and TURN clients need a route so use loopback.
+    nic = Interface.from_dict(LOOPBACK_INFO)
+    results = {0: 0, 1: 0}
+    samples = []
+    async def runner(counter):
+        # CONCURRENCY of these per round.
+        for n in counter:
+            # Failed probes raise -- worker() counts them as 0.
+            try:
+                is_success, _ = await service_monitor(nic, works[n % len(works)])
+            except Exception:
+                is_success = 0
+
+            results[int(bool(is_success))] += 1
+
+    start = time.perf_counter()
+    for offset in range(0, probes, SAMPLE_EVERY):
+        counter = iter(range(offset, min(probes, offset + SAMPLE_EVERY)))
+        await asyncio.gather(*[runner(counter) for _ in range(CONCURRENCY)])
+        done = results[0] + results[1]
+        samples.append((done, fd_count(), len(asyncio.all_tasks())))
+
+    duration = time.perf_counter() - start
+
+    print("%d probes in %.1f s (%.0f/s) -- %d ok, %d failed" % (
+        probes, duration, probes / duration, results[1], results[0]
+    ))
+
+    print("%10s %6s %8s" % ("probes", "fds", "tasks"))
+    for sample in samples:
+        print("%10d %6d %8d" % sample)
+
+    _, base_fds, base_tasks = samples[0]
+    for _, fds, tasks in samples:
+        assert fds <= base_fds + FD_SLACK, "FDs grew %d -> %d" % (base_fds, fds)
+        assert tasks <= base_tasks, "tasks grew %d -> %d" % (base_tasks, tasks)
+
+    leftover = len(asyncio.all_tasks()) - 1
+    print("tasks left after run: %d" % (leftover,))
+    assert leftover == 0, "probe tasks left running"
+
+    await UDPMux.close_all(nic)
+    for standin in (stun, ntp, mqtt, turn):
+        standin.close()
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else PROBES))
@@ -0,0 +1,100 @@
+"""
+Flush time for 100k statuses with 1% churn between saves.
+
+    python3 -m benchmarks.bench_sqlite_flush
+
+Compares the old save (delete every row then re-insert everything)
+with the dirty row write-behind flush.
+"""
+
+import os
+import time
+import random
+import asyncio
+import tempfile
+import aiosqlite
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_defs import Status
+from p2pd_server_monitor.db.mem_db_utils import sqlite_export, sqlite_flush
+from p2pd_server_monitor.db.db_init import delete_all_data
+
+STATUS_NO = 100_000
+CHURN = 0.01
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "p2pd_server_monitor",
+    "db",
+    "monitor.sqlite3.sql"
+)
+
+def build_db():
+    mem_db = MemDB()
+    now = int(time.time())
+    for status_id in range(1, STATUS_NO + 1):
+        mem_db.statuses[status_id] = Status(
+            id=status_id,
+            row_id=status_id,
+            table_type=SERVICES_TABLE_TYPE,
+            status=STATUS_AVAILABLE,
+            last_status=now,
+            test_no=0,
+            failed_tests=0,
+            last_success=0,
+            last_uptime=0,
+            uptime=0,
+            max_uptime=0
+        )
+        mem_db.mark_dirty(STATUS_TABLE_TYPE, status_id)
+
+    return mem_db
+
+def churn(mem_db):
+    # Simulate a minute of completed work.
+    for status_id in random.sample(range(1, STATUS_NO + 1), int(STATUS_NO * CHURN)):
+        status = mem_db.statuses[status_id]
+        status.test_no += 1
+        mem_db.mark_dirty(STATUS_TABLE_TYPE, status_id)
+
+async def timed(sqlite_db, coro):
+    start = time.perf_counter()
+    await sqlite_db.execute("BEGIN")
+    await coro
+    await sqlite_db.commit()
+    return time.perf_counter() - start
+
+async def full_rewrite(mem_db, sqlite_db):
+    await delete_all_data(sqlite_db)
+    await sqlite_export(mem_db, sqlite_db)
+
+async def main():
+    mem_db = build_db()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "monitor.sqlite3")
+        async with aiosqlite.connect(db_path) as sqlite_db:
+            with open(SCHEMA_PATH) as f:
+                await sqlite_db.executescript(f.read())
+
+            await sqlite_db.execute("PRAGMA journal_mode=WAL")
+            await sqlite_db.execute("PRAGMA synchronous=NORMAL")
+            initial = await timed(sqlite_db, sqlite_flush(mem_db, sqlite_db))
+
+            churn(mem_db)
+            full = await timed(sqlite_db, full_rewrite(mem_db, sqlite_db))
+
+            # A baseline that silently wrote nothing would look fast.
+            async with sqlite_db.execute("SELECT COUNT(*) FROM status") as cursor:
+                (count,) = await cursor.fetchone()
+            assert count == STATUS_NO, "re-insert wrote %d rows" % (count,)
+
+            flush = await timed(sqlite_db, sqlite_flush(mem_db, sqlite_db))
+
+    print("statuses:            %d" % (STATUS_NO,))
+    print("changed rows:        %d" % (int(STATUS_NO * CHURN),))
+    print("initial flush:       %.3f s" % (initial,))
+    print("delete + re-insert:  %.3f s" % (full,))
+    print("dirty row flush:     %.3f s" % (flush,))
+
+if __name__ == "__main__":
+    asyncio.run(main())
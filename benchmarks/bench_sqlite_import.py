@@ -0,0 +1,95 @@
+"""
+Cold start time for a DB of 200k services and 50k aliases.
+
+    python3 -m benchmarks.bench_sqlite_import [services]
+
+Reports time to first work (status + services resident so /work can
+be served) and the time to load everything.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import aiosqlite
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_utils import sqlite_import
+
+SERVICE_NO = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+ALIAS_NO = SERVICE_NO // 4
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "p2pd_server_monitor",
+    "db",
+    "monitor.sqlite3.sql"
+)
+
+def ip(i):
+    return "8.%d.%d.%d" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+async def build_db(path):
+    now = int(time.time())
+    async with aiosqlite.connect(path) as db:
+        with open(SCHEMA_PATH) as f:
+            await db.executescript(f.read())
+
+        await db.executemany(
+            "INSERT INTO aliases (id, fqn, af, ip, group_id) VALUES (?, ?, ?, ?, ?)",
+            [
+                (i, "s%d.example.com" % (i,), int(IP4), ip(i), i)
+                for i in range(1, ALIAS_NO + 1)
+            ]
+        )
+
+        await db.executemany(
+            "INSERT INTO services (id, type, af, proto, ip, port, group_id, alias_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    i,
+                    STUN_MAP_TYPE,
+                    int(IP4),
+                    int(UDP),
+                    ip(i),
+                    3478,
+                    ALIAS_NO + i,
+                    i if i <= ALIAS_NO else None
+                )
+                for i in range(1, SERVICE_NO + 1)
+            ]
+        )
+
+        statuses = []
+        status_id = 1
+        for table_type, n in ((ALIASES_TABLE_TYPE, ALIAS_NO), (SERVICES_TABLE_TYPE, SERVICE_NO)):
+            for row_id in range(1, n + 1):
+                statuses.append(
+                    (status_id, table_type, row_id, STATUS_AVAILABLE, now)
+                )
+                status_id += 1
+
+        await db.executemany(
+            "INSERT INTO status (id, table_type, row_id, status, last_status) VALUES (?, ?, ?, ?, ?)",
+            statuses
+        )
+        await db.commit()
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "monitor.sqlite3")
+        await build_db(path)
+
+        mem_db = MemDB()
+        start = time.perf_counter()
+        await sqlite_import(mem_db, path)
+        total = time.perf_counter() - start
+
+    print("%d services, %d aliases" % (SERVICE_NO, ALIAS_NO))
+    print("time to first work %.2f s" % (mem_db.load_stats["first_work"],))
+    print("full load          %.2f s" % (total,))
+
+if __name__ == "__main__":
+    asyncio.run(main())
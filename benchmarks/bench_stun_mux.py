@@ -0,0 +1,76 @@
+"""
+STUN probes per second with a socket per probe vs the shared mux.
+
+    python3 -m benchmarks.bench_stun_mux
+
+Both send binding requests to the STUN stand-in on loopback. The
+socket per probe run opens (and closes) a UDP socket for each request
+the way STUNClient does. The mux run sends them all over
+UDP_MUX_SOCKETS sockets. Each run has CONCURRENCY probes in flight.
+"""
+
+import time
+import asyncio
+from p2pd import IP4, STUNMsg, RFC5389
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.stun_mux import StunMux
+from benchmarks.standins import StunStandIn
+
+PROBES = 20000
+CONCURRENCY = 500
+
+class OneShot(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.reply = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+async def probe_own_socket(dest):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        OneShot,
+        local_addr=("127.0.0.1", 0)
+    )
+
+    try:
+        transport.sendto(STUNMsg(mode=RFC5389).pack(), dest)
+        await asyncio.wait_for(protocol.reply, 2)
+    finally:
+        transport.close()
+
+async def run(probe):
+    # Returns (seconds, failed probes.)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    failed = []
+    async def one():
+        async with semaphore:
+            try:
+                await probe()
+            except Exception:
+                failed.append(1)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(PROBES)])
+    return time.perf_counter() - start, len(failed)
+
+async def main():
+    server = await StunStandIn().start()
+    dest = server.addr
+
+    own, own_failed = await run(lambda: probe_own_socket(dest))
+    mux = StunMux()
+    shared, mux_failed = await run(lambda: mux.get_wan_ip(IP4, dest))
+
+    print("socket per probe %8.0f probes/s %5d failed (%d sockets)" % (
+        PROBES / own, own_failed, PROBES
+    ))
+    print("mux              %8.0f probes/s %5d failed (%d sockets)" % (
+        PROBES / shared, mux_failed, mux.fd_count()
+    ))
+    await mux.close()
+    server.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
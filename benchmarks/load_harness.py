@@ -0,0 +1,313 @@
+"""
+End to end load test: a dealer, N worker processes and local stand-ins
+for every service they probe -- no network needed.
+
+    python3 -m benchmarks.load_harness [--services 4000] [--workers 4] ...
+
+This process is the dealer. It fills a MemDB with SERVICES synthetic
+services (STUN map, NTP, MQTT and TURN in turn) and serves DEALER_CALLS
+over the Unix socket RPC. The stand-ins run in their own process so
+their CPU isn't charged to the dealer or the workers. Each worker
+process runs a WorkerPool exactly like worker.main but its probes are
+pointed at the stand-in for the service type. A --down fraction of the
+services point at a closed port instead so the timeout paths run too.
+
+Printed every second and at the end:
+
+    alloc -- groups dealt a second and dealer time per /work call
+    probes -- completions a second and how many succeeded
+    fresh -- how long since each service was last checked (p50 / p95 /
+             max) and how many were checked within --frequency
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from p2pd import *
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.txt_strs import TXTS
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dealer.dealer_core import DEALER_CALLS
+from p2pd_server_monitor.rpc import RPCServer, RPCClient
+from p2pd_server_monitor.worker.worker import worker
+from p2pd_server_monitor.worker.worker_pool import WorkerPool
+from p2pd_server_monitor.worker.udp_mux import UDPMux
+from benchmarks.standins import StunStandIn, NTPStandIn, MQTTStandIn, TURNStandIn
+
+# (service type, proto) dealt round robin.
+HARNESS_TYPES = (
+    (STUN_MAP_TYPE, UDP),
+    (NTP_TYPE, UDP),
+    (MQTT_TYPE, TCP),
+    (TURN_TYPE, UDP),
+)
+
+# Loopback with a made up public IP -- enough for p2pd routes.
+LOOPBACK_INFO = {
+    "id": "lo",
+    "name": "lo",
+    "mac": "00-00-00-00-00-00",
+    "is_default": {int(IP4): True, int(IP6): False},
+    "nat": {"type": OPEN_INTERNET, "delta": {"type": NA_DELTA, "value": 0}},
+    "netiface_index": 1,
+    "nic_no": 0,
+    "rp": {
+        int(IP4): [{
+            "af": int(IP4),
+            "nic_ips": [{"af": int(IP4), "cidr": 32, "ip": "127.0.0.1"}],
+            "ext_ips": [{"af": int(IP4), "cidr": 32, "ip": "8.8.8.8"}],
+            "link_local_ips": [],
+        }],
+        int(IP6): [],
+    },
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--services", type=int, default=4000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=WORKER_TASK_NO, help="probe tasks per worker")
+    parser.add_argument("--fetch-interval", type=float, default=WORK_FETCH_INTERVAL, help="min seconds between leases")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--frequency", type=int, default=10, help="seconds between checks of a service")
+    parser.add_argument("--latency", type=float, default=0.005, help="stand-in reply delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.01)
+    parser.add_argument("--fail", type=float, default=0.01)
+    parser.add_argument("--down", type=float, default=0.05, help="fraction of services that never answer")
+    return parser.parse_args(argv)
+
+def closed_port(proto):
+    # A port nothing listens on.
+    sock_type = socket.SOCK_DGRAM if proto == UDP else socket.SOCK_STREAM
+    with socket.socket(socket.AF_INET, sock_type) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+################################################################################
+# Stand-ins process.
+
+async def serve_standins(args, conn):
+    knobs = {"latency": args.latency, "loss": args.loss, "fail": args.fail}
+    standins = {
+        STUN_MAP_TYPE: await StunStandIn(seed=1, **knobs).start(),
+        NTP_TYPE: await NTPStandIn(seed=2, **knobs).start(),
+        MQTT_TYPE: await MQTTStandIn(seed=3, **knobs).start(),
+        TURN_TYPE: await TURNStandIn(seed=4, **knobs).start(),
+    }
+
+    addrs = {t: tuple(s.addr) for t, s in standins.items()}
+    for proto in (UDP, TCP):
+        addrs[("down", int(proto))] = ("127.0.0.1", closed_port(proto))
+
+    # Runs until the dealer asks for stats.
+    conn.send(addrs)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, conn.recv)
+    conn.send({TXTS[t]: s.stats for t, s in standins.items()})
+    for standin in standins.values():
+        standin.close()
+
+def standins_main(args, conn):
+    asyncio.run(serve_standins(args, conn))
+
+################################################################################
+# Worker processes.
+
+class HarnessPool(WorkerPool):
+    # Short runs can't wait out the 1 - 5 min idle pause.
+    async def pause(self, seconds):
+        await super().pause(min(seconds, 1))
+
+def harness_probe(addrs, down):
+    async def probe(nic, curl, init_work):
+        # Same group pointed at the stand-in for its type.
+        group = []
+        for work in init_work:
+            work = dict(work)
+            if work["id"] % 1000 < down * 1000:
+                work["ip"], work["port"] = addrs[("down", int(work["proto"]))]
+            else:
+                work["ip"], work["port"] = addrs[work["type"]]
+
+            group.append(work)
+
+        return await worker(nic, curl, init_work=group)
+
+    return probe
+
+async def run_worker(args, path, addrs):
+    nic = Interface.from_dict(LOOPBACK_INFO)
+    curl = RPCClient(nic.route(IP4), path)
+    pool = HarnessPool(
+        nic,
+        curl,
+        harness_probe(addrs, args.down),
+        task_no=args.tasks,
+        table_type=SERVICES_TABLE_TYPE,
+        fetch_interval=args.fetch_interval
+    )
+
+    asyncio.get_running_loop().call_later(args.duration, pool.stop)
+    try:
+        await pool.run()
+    finally:
+        await UDPMux.close_all(nic)
+        await curl.close()
+
+def worker_main(args, path, addrs):
+    # worker() prints every probe.
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    asyncio.run(run_worker(args, path, addrs))
+
+################################################################################
+# Dealer (this process.)
+
+def build_mem_db(services):
+    mem_db = MemDB()
+    for n in range(services):
+        service_type, proto = HARNESS_TYPES[n % len(HARNESS_TYPES)]
+        ip = "44.%d.%d.%d" % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+        record = mem_db.insert_service(
+            service_type, IP4, proto, ip, 3478, "user", "pass", None
+        )
+        mem_db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+
+    return mem_db
+
+class DealerStats:
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.calls = {"work": 0, "complete": 0}
+        self.work_time = 0
+        self.groups = 0
+        self.completed = 0
+        self.ok = 0
+
+    def wrap(self, calls):
+        # DEALER_CALLS that count what they do.
+        def work(mem_db, **params):
+            # Workers send None -- use the harness frequency.
+            params["monitor_frequency"] = self.frequency
+            start = time.perf_counter()
+            resp = calls["work"](mem_db, **params)
+            self.work_time += time.perf_counter() - start
+            self.calls["work"] += 1
+            self.groups += len(resp.get("groups", []))
+            return resp
+
+        def complete(mem_db, statuses, lease_id=None):
+            self.calls["complete"] += 1
+            self.completed += len(statuses)
+            self.ok += sum(1 for s in statuses if s["is_success"])
+            return calls["complete"](mem_db, statuses, lease_id)
+
+        return dict(calls, work=work, complete=complete)
+
+    def snapshot(self):
+        return (self.groups, self.completed, self.ok, self.calls["work"], self.work_time)
+
+def freshness(mem_db, now):
+    # Seconds since each service was checked -- None if never.
+    ages = []
+    never = 0
+    for status in mem_db.statuses.values():
+        if status.table_type != SERVICES_TABLE_TYPE:
+            continue
+
+        if status.test_no:
+            ages.append(now - status.last_status)
+        else:
+            never += 1
+
+    return sorted(ages), never
+
+def freshness_line(mem_db, frequency):
+    ages, never = freshness(mem_db, int(time.time()))
+    total = len(ages) + never
+    fresh = sum(1 for age in ages if age <= frequency)
+    return "fresh p50 %3ds p95 %3ds max %3ds, %5.1f%% within %ds, %d never" % (
+        percentile(ages, 0.5),
+        percentile(ages, 0.95),
+        ages[-1] if ages else 0,
+        fresh / max(1, total) * 100,
+        frequency,
+        never
+    )
+
+def rate_line(before, after, seconds):
+    groups, completed, ok, work_calls, work_time = (
+        a - b for a, b in zip(after, before)
+    )
+
+    return "alloc %6.0f groups/s %5.0f us/call | probes %6.0f/s %5.1f%% ok" % (
+        groups / seconds,
+        work_time / max(1, work_calls) * 1e6,
+        completed / seconds,
+        ok / max(1, completed) * 100,
+    )
+
+async def main(args):
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    standins = ctx.Process(target=standins_main, args=(args, child_conn))
+    standins.start()
+    loop = asyncio.get_running_loop()
+    addrs = await loop.run_in_executor(None, parent_conn.recv)
+
+    start = time.perf_counter()
+    mem_db = build_mem_db(args.services)
+    print("%d services loaded in %.1f s" % (args.services, time.perf_counter() - start))
+
+    stats = DealerStats(args.frequency)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dealer.sock")
+        server = await RPCServer(stats.wrap(DEALER_CALLS), mem_db).start(path)
+        workers = [
+            ctx.Process(target=worker_main, args=(args, path, addrs))
+            for _ in range(args.workers)
+        ]
+
+        for proc in workers:
+            proc.start()
+
+        # Report until every worker has drained and exited.
+        began = time.perf_counter()
+        last = stats.snapshot()
+        while any(proc.is_alive() for proc in workers):
+            await asyncio.sleep(1)
+            now = stats.snapshot()
+            print("%4ds %s | %s" % (
+                time.perf_counter() - began,
+                rate_line(last, now, 1),
+                freshness_line(mem_db, args.frequency)
+            ))
+            last = now
+
+        elapsed = time.perf_counter() - began
+        await server.close()
+
+    parent_conn.send("stop")
+    standin_stats = await loop.run_in_executor(None, parent_conn.recv)
+    standins.join()
+
+    print()
+    print("%d workers * %d tasks, %d services, %.0f s" % (
+        args.workers, args.tasks, args.services, elapsed
+    ))
+    print("total %s" % (rate_line((0,) * 5, stats.snapshot(), elapsed),))
+    print("final %s" % (freshness_line(mem_db, args.frequency),))
+    for name, counts in standin_stats.items():
+        print("%-10s %s" % (name, counts))
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
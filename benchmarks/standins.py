@@ -0,0 +1,391 @@
+"""
+Local stand-ins for the servers workers probe so load can be measured
+offline.
+
+Every stand-in takes the same knobs:
+
+    latency -- seconds added before each reply
+    loss -- chance a request is dropped (the client may resend)
+    fail -- chance the server is "down" for a request (no reply at all,
+            even to resends -- decided once per request id)
+
+StunStandIn listens on two IPs * two ports (127.0.0.1 and 127.0.0.2 by
+default -- Linux routes all of 127/8 to loopback) and answers RFC3489
+change requests from the right socket. NTPStandIn answers client mode
+requests. MQTTStandIn is a tiny MQTT 3.1.1 / 5 broker -- enough for a
+client to subscribe to its own topic and get its messages back.
+TURNStandIn answers allocations the way p2pd's TURNClient expects (401
+with a realm and nonce first, then a relay address) but doesn't check
+credentials.
+
+For the TCP stand-in (MQTT) fail drops the connection and loss drops
+the forwarded message.
+"""
+
+import time
+import socket
+import struct
+import random
+import asyncio
+import itertools
+from p2pd.ntp_client import NTPPacket, system_to_ntp_time
+
+class StandIn:
+    def __init__(self, latency=0, loss=0, fail=0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.fail = fail
+        self.rand = random.Random(seed)
+        self.failed = {} # request id: down?
+        self.transports = []
+        self.stats = {"requests": 0, "replies": 0, "dropped": 0}
+
+    def should_reply(self, request_id):
+        self.stats["requests"] += 1
+        if request_id not in self.failed:
+            # Bounded so a soak run doesn't grow it forever.
+            if len(self.failed) > 100000:
+                self.failed.clear()
+
+            self.failed[request_id] = self.rand.random() < self.fail
+
+        if self.failed[request_id] or self.rand.random() < self.loss:
+            self.stats["dropped"] += 1
+            return False
+
+        return True
+
+    def delay(self, f):
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, f)
+        else:
+            f()
+
+    def send(self, transport, data, addr):
+        def send():
+            if not transport.is_closing():
+                transport.sendto(data, addr)
+                self.stats["replies"] += 1
+
+        self.delay(send)
+
+    async def listen(self, protocol, addr):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: protocol,
+            local_addr=addr
+        )
+
+        self.transports.append(transport)
+        return transport
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+        self.transports = []
+
+class StandInProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server, index=0):
+        self.server = server
+        self.index = index
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.on_request(self, data, addr)
+
+def stun_addr_attr(attr_type, addr):
+    value = struct.pack("!BBH", 0, 1, addr[1]) + socket.inet_aton(addr[0])
+    return struct.pack("!HH", attr_type, len(value)) + value
+
+def stun_xor_addr_attr(addr):
+    port = addr[1] ^ 0x2112
+    ip = struct.unpack("!I", socket.inet_aton(addr[0]))[0] ^ 0x2112A442
+    value = struct.pack("!BBHI", 0, 1, port, ip)
+    return struct.pack("!HH", 0x0020, len(value)) + value
+
+def stun_change_flags(data):
+    # CHANGE-REQUEST bits (4 = ip, 2 = port) or 0.
+    pos = 20
+    while pos + 4 <= len(data):
+        attr_type, attr_len = struct.unpack("!HH", data[pos:pos + 4])
+        if attr_type == 0x0003 and attr_len >= 4:
+            return data[pos + 7] & 6
+
+        pos += 4 + attr_len + (-attr_len % 4)
+
+    return 0
+
+class StunStandIn(StandIn):
+    def __init__(self, ip="127.0.0.1", alt_ip="127.0.0.2", **kwargs):
+        super().__init__(**kwargs)
+        self.ips = (ip, alt_ip)
+        self.ports = None
+        self.sockets = {} # (ip index, port index): transport
+
+    async def start(self, port=0, alt_port=0):
+        for i, ip in enumerate(self.ips):
+            for j, want in enumerate((port, alt_port)):
+                # Alt IP reuses the ports picked for the main IP.
+                if self.ports is not None:
+                    want = self.ports[j]
+
+                protocol = StandInProtocol(self, (i, j))
+                transport = await self.listen(protocol, (ip, want))
+                self.sockets[(i, j)] = transport
+
+            if self.ports is None:
+                self.ports = (
+                    self.sockets[(0, 0)].get_extra_info("sockname")[1],
+                    self.sockets[(0, 1)].get_extra_info("sockname")[1],
+                )
+
+        return self
+
+    @property
+    def addr(self):
+        return (self.ips[0], self.ports[0])
+
+    def on_request(self, protocol, data, addr):
+        if len(data) < 20 or data[0:2] != b"\x00\x01":
+            return
+
+        if not self.should_reply(bytes(data[8:20])):
+            return
+
+        # Reply from the socket the change request asks for.
+        flags = stun_change_flags(data)
+        ip_index, port_index = protocol.index
+        if flags & 4:
+            ip_index ^= 1
+        if flags & 2:
+            port_index ^= 1
+
+        changed = (self.ips[protocol.index[0] ^ 1], self.ports[protocol.index[1] ^ 1])
+        body = stun_addr_attr(0x0001, addr)
+        body += stun_xor_addr_attr(addr)
+        body += stun_addr_attr(0x0005, changed)
+        reply = struct.pack("!HH", 0x0101, len(body)) + data[4:20] + body
+        self.send(self.sockets[(ip_index, port_index)], reply, addr)
+
+class NTPStandIn(StandIn):
+    async def start(self, ip="127.0.0.1", port=0):
+        transport = await self.listen(StandInProtocol(self), (ip, port))
+        self.addr = transport.get_extra_info("sockname")[:2]
+        return self
+
+    def on_request(self, protocol, data, addr):
+        if len(data) < 48 or not self.should_reply(bytes(data[40:48])):
+            return
+
+        now = system_to_ntp_time(time.time())
+        packet = NTPPacket(version=3, mode=4, tx_timestamp=now)
+        packet.stratum = 2
+        packet.recv_timestamp = now
+        reply = bytearray(packet.to_data())
+
+        # Originate is the client's transmit timestamp, as sent.
+        reply[24:32] = data[40:48]
+        self.send(protocol.transport, bytes(reply), addr)
+
+def mqtt_varint(n):
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | (128 if n else 0))
+        if not n:
+            return bytes(out)
+
+def mqtt_packet(header, body):
+    return bytes([header]) + mqtt_varint(len(body)) + body
+
+def mqtt_string(buf, pos):
+    size = struct.unpack("!H", buf[pos:pos + 2])[0]
+    return bytes(buf[pos + 2:pos + 2 + size]), pos + 2 + size
+
+def mqtt_skip_props(buf, pos):
+    # Properties are a varint length then that many bytes.
+    size, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        size |= (byte & 127) << shift
+        shift += 7
+        if not byte & 128:
+            return pos + size
+
+async def mqtt_read(reader):
+    # (header byte, body) or None on EOF.
+    try:
+        header = (await reader.readexactly(1))[0]
+        size, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            size |= (byte & 127) << shift
+            shift += 7
+            if not byte & 128:
+                break
+
+        return header, await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+class MQTTStandIn(StandIn):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.server = None
+        self.subs = {} # topic: {(writer, version) ...}
+        self.conn_ids = itertools.count()
+
+    async def start(self, ip="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, ip, port)
+        self.addr = self.server.sockets[0].getsockname()[:2]
+        return self
+
+    def write(self, writer, data):
+        def write():
+            if not writer.is_closing():
+                writer.write(data)
+
+        self.delay(write)
+
+    async def handle(self, reader, writer):
+        version = 4
+        topics = set()
+        try:
+            while True:
+                packet = await mqtt_read(reader)
+                if packet is None:
+                    break
+
+                header, body = packet
+                kind = header >> 4
+                if kind == 1: # CONNECT
+                    if not self.should_reply(next(self.conn_ids)):
+                        break
+
+                    _, pos = mqtt_string(body, 0)
+                    version = body[pos]
+                    ack = b"\x00\x00\x00" if version == 5 else b"\x00\x00"
+                    self.write(writer, mqtt_packet(0x20, ack))
+                    self.stats["replies"] += 1
+
+                if kind == 8: # SUBSCRIBE
+                    pid, pos = body[0:2], 2
+                    if version == 5:
+                        pos = mqtt_skip_props(body, pos)
+
+                    granted = b""
+                    while pos < len(body):
+                        topic, pos = mqtt_string(body, pos)
+                        pos += 1
+                        topics.add(topic)
+                        self.subs.setdefault(topic, set()).add((writer, version))
+                        granted += b"\x00"
+
+                    props = b"\x00" if version == 5 else b""
+                    self.write(writer, mqtt_packet(0x90, pid + props + granted))
+
+                if kind == 3: # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic, pos = mqtt_string(body, 0)
+                    pid = b""
+                    if qos:
+                        pid, pos = body[pos:pos + 2], pos + 2
+                    if version == 5:
+                        pos = mqtt_skip_props(body, pos)
+
+                    payload = body[pos:]
+                    if qos == 1:
+                        self.write(writer, mqtt_packet(0x40, pid))
+                    if qos == 2:
+                        self.write(writer, mqtt_packet(0x50, pid))
+
+                    # Delivered at QoS 0.
+                    if self.rand.random() >= self.loss:
+                        self.forward(topic, payload)
+
+                if kind == 6: # PUBREL
+                    self.write(writer, mqtt_packet(0x70, body[0:2]))
+
+                if kind == 12: # PINGREQ
+                    self.write(writer, mqtt_packet(0xD0, b""))
+
+                if kind == 14: # DISCONNECT
+                    break
+        finally:
+            for topic in topics:
+                subs = self.subs.get(topic, set())
+                subs.difference_update({s for s in subs if s[0] is writer})
+                if not subs:
+                    self.subs.pop(topic, None)
+
+            writer.close()
+
+    def forward(self, topic, payload):
+        topic_buf = struct.pack("!H", len(topic)) + topic
+        for writer, version in list(self.subs.get(topic, ())):
+            props = b"\x00" if version == 5 else b""
+            self.write(writer, mqtt_packet(0x30, topic_buf + props + payload))
+
+    def close(self):
+        super().close()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+def stun_attr(attr_type, value):
+    padding = b"\x00" * (-len(value) % 4)
+    return struct.pack("!HH", attr_type, len(value)) + value + padding
+
+def stun_attrs(data):
+    # {attr type: value} for a STUN / TURN message.
+    attrs = {}
+    pos = 20
+    while pos + 4 <= len(data):
+        attr_type, attr_len = struct.unpack("!HH", data[pos:pos + 4])
+        attrs[attr_type] = bytes(data[pos + 4:pos + 4 + attr_len])
+        pos += 4 + attr_len + (-attr_len % 4)
+
+    return attrs
+
+class TURNStandIn(StandIn):
+    def __init__(self, realm=b"standin", **kwargs):
+        super().__init__(**kwargs)
+        self.realm = realm
+        self.relay_ports = itertools.count(50000)
+
+    async def start(self, ip="127.0.0.1", port=0):
+        transport = await self.listen(StandInProtocol(self), (ip, port))
+        self.addr = transport.get_extra_info("sockname")[:2]
+        return self
+
+    def on_request(self, protocol, data, addr):
+        if len(data) < 20 or not self.should_reply(bytes(data[8:20])):
+            return
+
+        method = struct.unpack("!H", data[0:2])[0] & 0x000F
+        attrs = stun_attrs(data)
+        if method == 0x0003: # Allocate
+            if 0x0008 not in attrs:
+                # Unsigned -- ask for credentials.
+                body = stun_attr(0x0009, b"\x00\x00\x04\x01Unauthorized")
+                body += stun_attr(0x0014, self.realm)
+                body += stun_attr(0x0015, b"%016x" % (self.rand.getrandbits(64),))
+                msg_type = 0x0113
+            else:
+                relay = (self.addr[0], 50000 + next(self.relay_ports) % 10000)
+                body = stun_xor_addr_attr(relay)[4:]
+                body = stun_attr(0x0016, body)
+                body += stun_xor_addr_attr(addr)
+                body += stun_attr(0x000D, struct.pack("!I", 600))
+                msg_type = 0x0103
+        else:
+            # Refresh, CreatePermission etc. just succeed.
+            body = b""
+            msg_type = 0x0100 | method
+
+        reply = struct.pack("!HH", msg_type, len(body)) + data[4:20] + body
+        self.send(protocol.transport, reply, addr)
@@ -8,6 +8,12 @@ from p2pd import *
 
 class MemDB():
     def __init__(self):
+        self.server_list = None # Set by the dealer.
+        self.journal = None # Set by the dealer.
+        self.status_store = None # Optional numpy copy of statuses.
+        self.metrics = None # Set by the dealer.
+        self.probe_budget = None # Set by the dealer.
+        self.dns_cache = None # Set by the dealer.
         self.setup_db() 
 
     def setup_db(self):
@@ -26,9 +32,24 @@ class MemDB():
             self.id_max[table_type] = 0
 
         self.id_max[GROUPS_TABLE_TYPE] = 0
+
+        # Tables that can be served from. sqlite_import fills this in
+        # as each table finishes loading.
+        self.loaded = set(TABLE_TYPES)
+        self.load_stats = {}
         self.id_max[STATUS_TABLE_TYPE] = 0
         self.records_by_aliases = {}
         self.aliases_by_ip = {}
+        self.held = {} # alias_id: {group_id ...} waiting on DNS
+        self.leases = OrderedDict() # lease_id: lease
+        self.lease_id = 0
+
+        # Rows changed since the last SQLite flush.
+        self.dirty = {}
+        self.deleted = {}
+        for table_type in PERSISTED_TABLE_TYPES:
+            self.dirty[table_type] = set()
+            self.deleted[table_type] = set()
 
         # Unique indexes.
         self.uniques = {
@@ -57,6 +78,48 @@ class MemDB():
             STATUS_TABLE_TYPE: self.statuses
         })
 
+    def mark_dirty(self, table_type, row_id):
+        self.dirty[table_type].add(row_id)
+        self.deleted[table_type].discard(row_id)
+        if self.journal is not None:
+            self.journal.mark_dirty(table_type, row_id)
+
+        if self.status_store is not None:
+            if table_type == STATUS_TABLE_TYPE:
+                self.status_store.put(self.statuses[row_id])
+
+    def mark_deleted(self, table_type, row_id):
+        self.deleted[table_type].add(row_id)
+        self.dirty[table_type].discard(row_id)
+        if self.journal is not None:
+            self.journal.mark_deleted(table_type, row_id)
+
+        if self.status_store is not None:
+            if table_type == STATUS_TABLE_TYPE:
+                self.status_store.remove(row_id)
+
+    def take_changes(self):
+        """
+        Swap out the change sets so edits made while a flush is
+        awaiting I/O are kept for the next flush.
+        """
+        changes = (self.dirty, self.deleted)
+        self.dirty = {t: set() for t in PERSISTED_TABLE_TYPES}
+        self.deleted = {t: set() for t in PERSISTED_TABLE_TYPES}
+        return changes
+
+    def restore_changes(self, changes):
+        # A flush failed -- retry these rows next time.
+        dirty, deleted = changes
+        for table_type in PERSISTED_TABLE_TYPES:
+            for row_id in dirty[table_type]:
+                if row_id not in self.deleted[table_type]:
+                    self.dirty[table_type].add(row_id)
+
+            for row_id in deleted[table_type]:
+                if row_id not in self.dirty[table_type]:
+                    self.deleted[table_type].add(row_id)
+
     def add_id(self, table_type, n):
         if self.id_max[table_type] < n:
             self.id_max[table_type] = n
@@ -88,30 +151,125 @@ class MemDB():
     def add_work(self, af: int, table_type: int, group: Any, group_id=None, status_type=STATUS_INIT):
         # Save this as a new "group".
         group_id = group_id or self.get_id(GROUPS_TABLE_TYPE)
-        meta_group = MetaGroup(**{
-            "id": group_id,
-            "group": group,
-            "table_type": table_type,
-            "af": af
-        })
+        meta_group = Group(group_id, table_type, af, group)
         self.groups[group_id] = meta_group
 
-        # Add group to work queue LOG(1).
-        self.work[table_type][af].add_work(group_id, meta_group, status_type)
-
         # Add group id field.
         for member in group:
-            member.group_id = group_id
+            if member.group_id != group_id:
+                member.group_id = group_id
+                self.mark_dirty(member.table_type, member.id)
+
+        # Work with no IP waits for its alias.
+        if status_type == STATUS_INIT and self.hold_work(meta_group):
+            status_type = STATUS_HELD
 
+        # Add group to work queue LOG(1).
+        self.work[table_type][af].add_work(group_id, meta_group, status_type)
         return meta_group
 
+    def add_groups(self, table_type: int, groups, status_type=STATUS_INIT):
+        """
+        Bulk add_work for groups loaded from the DB. Members already
+        have their group_id so nothing is marked dirty.
+        """
+        by_af = {}
+        held = []
+        for group_id, group in groups.items():
+            af = group[0].af
+            meta_group = Group(group_id, table_type, af, group)
+            self.groups[group_id] = meta_group
+            if status_type == STATUS_INIT and self.hold_work(meta_group):
+                held.append(meta_group)
+                continue
+
+            by_af.setdefault(af, []).append((group_id, meta_group))
+
+        for af, items in by_af.items():
+            self.work[table_type][af].add_many(items, status_type)
+
+        for meta_group in held:
+            wq = self.work[table_type][meta_group.af]
+            wq.add_work(meta_group.id, meta_group, STATUS_HELD)
+
+    def hold_work(self, meta_group):
+        """
+        Records inserted with only a FQN have no IP until their alias
+        resolves so probing them is wasted. If the alias already has an
+        IP use it, otherwise hold the group until update_alias sets one.
+        """
+        if meta_group.table_type == ALIASES_TABLE_TYPE:
+            return False
+
+        alias_ids = set()
+        for member in meta_group.group:
+            if member.ip is not None or member.alias_id is None:
+                continue
+
+            alias = self.records[ALIASES_TABLE_TYPE].get(member.alias_id)
+            if alias is not None and alias.ip is not None:
+                member.ip = alias.ip
+                self.mark_dirty(member.table_type, member.id)
+            else:
+                alias_ids.add(member.alias_id)
+
+        for alias_id in alias_ids:
+            self.held.setdefault(alias_id, set()).add(meta_group.id)
+
+        return bool(alias_ids)
+
+    def release_held(self, alias_id):
+        # Held work for an alias that now has an IP goes next.
+        released = []
+        for group_id in self.held.pop(alias_id, ()):
+            meta_group = self.groups.get(group_id)
+            if meta_group is None:
+                continue
+
+            # Still waiting on another alias.
+            if any(m.ip is None and m.alias_id is not None for m in meta_group.group):
+                continue
+
+            wq = self.work[meta_group.table_type][meta_group.af]
+            if wq.index.get(group_id, (None,))[0] != STATUS_HELD:
+                continue
+
+            wq.move_work(group_id, STATUS_INIT, front=True)
+            released.append(meta_group)
+
+        return released
+
+    def is_loaded(self, table_types=TABLE_TYPES):
+        return all(t in self.loaded for t in table_types)
+
+    def add_lease(self, meta_groups, lease_time):
+        # Forget leases nobody completed -- their work already timed out.
+        now = int(time.time())
+        while self.leases:
+            lease = next(iter(self.leases.values()))
+            if lease.expiry >= now:
+                break
+
+            self.leases.popitem(last=False)
+
+        # Remember the deal so unfinished work can be handed back.
+        entries = []
+        for meta_group in meta_groups:
+            wq = self.work[meta_group.table_type][meta_group.af]
+            entries.append(wq.entries.get(meta_group.id))
+
+        self.lease_id += 1
+        lease = Lease(self.lease_id, meta_groups, entries, now + lease_time)
+        self.leases[lease.id] = lease
+        return lease
+
     def init_status_row(self, row_id: int, table_type: int):
         # Associated row must exist.
         if row_id not in self.records[table_type]:
             raise KeyError(f"{row_id} not in records {table_type}")
         
         status_id = self.get_id(STATUS_TABLE_TYPE)
-        status = StatusType(**{
+        status = Status(**{
             "id": status_id,
             "row_id": row_id,
             "table_type": table_type,
@@ -126,11 +284,12 @@ class MemDB():
         })
 
         self.statuses[status_id] = status
+        self.mark_dirty(STATUS_TABLE_TYPE, status_id)
         return status
 
     def record_alias(self, af: int, fqn: str, ip=None):
         alias_id = self.get_id(ALIASES_TABLE_TYPE)
-        alias = AliasType(**{
+        alias = Alias.validated(**{
             "id": alias_id,
             "af": af,
             "fqn": fqn,
@@ -145,6 +304,7 @@ class MemDB():
 
         # Record the new alias.
         self.records[ALIASES_TABLE_TYPE][alias_id] = alias
+        self.mark_dirty(ALIASES_TABLE_TYPE, alias_id)
         self.records_by_aliases[alias_id] = []
 
         # Record the IP.
@@ -188,7 +348,7 @@ class MemDB():
         row_id = self.get_id(table_type)
 
         # Record imports record.
-        record = RecordType(**{
+        record = Record.validated(**{
             "id": row_id,
             "table_type": table_type,
             "type": record_type,
@@ -220,6 +380,7 @@ class MemDB():
 
         # Save in services table.
         self.records[table_type][row_id] = record
+        self.mark_dirty(table_type, row_id)
 
         # Init status row.
         status = self.init_status_row(row_id, table_type)
@@ -36,6 +36,19 @@ class UniqueIndex:
             raise KeyError(f"Duplicate entry {key}")
         self._index[key] = obj
 
+    def add_many(self, objs):
+        """
+        Add a batch of objects -- used when loading the DB.
+        Raises KeyError on the first duplicate.
+        """
+        index = self._index
+        make_key = self._make_key
+        for obj in objs:
+            key = make_key(obj)
+            if key in index:
+                raise KeyError(f"Duplicate entry {key}")
+            index[key] = obj
+
     def get(self, obj):
         """
         Retrieve object by actual object.
@@ -55,6 +68,16 @@ class UniqueIndex:
         return list(self._index.values())
 
 
+class Lease:
+    """Groups handed out together by one /work call."""
+    __slots__ = ("id", "groups", "entries", "expiry")
+
+    def __init__(self, lease_id, groups, entries, expiry):
+        self.id = lease_id
+        self.groups = groups
+        self.entries = entries # DEALT heap entry at lease time.
+        self.expiry = expiry
+
 def add_validator(field_name: str, cls: type, func):
     setattr(
         cls, 
@@ -154,6 +177,8 @@ class StatusType(BaseModel):
     last_uptime: int
     uptime: int
     max_uptime: int
+    success_ewma: float = 0.0
+    rtt_ewma: float = 0.0
 
     @field_validator("status")
     @classmethod
@@ -191,12 +216,128 @@ add_validator("table_type", MetaGroup, validate_table_type)
 add_validator("ip", AliasType, validate_ip)
 add_validator("ip", RecordType, validate_ip)
 
+"""
+The models above validate data coming from outside (API calls, import
+files.) What MemDB actually stores are the slotted classes below. They
+skip validation and the per-instance __dict__ so loading and scanning a
+large DB is far cheaper. Use validated() to build one from untrusted
+input and to_model() to get the pydantic version back.
+"""
+class SlotRecord:
+    __slots__ = ()
+    fields = ()
+    model = None
+
+    def dict(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    def to_model(self):
+        return self.model(**self.dict())
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(**{name: getattr(model, name) for name in cls.fields})
+
+    @classmethod
+    def validated(cls, **kwargs):
+        return cls.from_model(cls.model(**kwargs))
+
+    def __repr__(self):
+        items = ", ".join("%s=%r" % (k, v) for k, v in self.dict().items())
+        return "%s(%s)" % (type(self).__name__, items)
+
+class Alias(SlotRecord):
+    fields = (
+        "id", "af", "fqn", "ip", "group_id", "status_id", "table_type"
+    )
+    __slots__ = fields
+    model = AliasType
+
+    def __init__(self, id, af, fqn, ip, group_id=None, status_id=None, table_type=ALIASES_TABLE_TYPE):
+        self.id = id
+        self.af = af
+        self.fqn = fqn
+        self.ip = ip
+        self.group_id = group_id
+        self.status_id = status_id
+        self.table_type = table_type
+
+class Record(SlotRecord):
+    fields = (
+        "id", "table_type", "type", "af", "proto", "ip", "port", "user",
+        "password", "alias_id", "status_id", "group_id", "score"
+    )
+    __slots__ = fields
+    model = RecordType
+
+    def __init__(self, id, table_type, type, af, proto=None, ip=None, port=0, user=None, password=None, alias_id=None, status_id=None, group_id=None, score=0):
+        self.id = id
+        self.table_type = table_type
+        self.type = type
+        self.af = af
+        self.proto = proto
+        self.ip = ip
+        self.port = port
+        self.user = user
+        self.password = password
+        self.alias_id = alias_id
+        self.status_id = status_id
+        self.group_id = group_id
+        self.score = score
+
+class Status(SlotRecord):
+    fields = (
+        "id", "row_id", "table_type", "status", "last_status", "test_no",
+        "failed_tests", "last_success", "last_uptime", "uptime",
+        "max_uptime", "success_ewma", "rtt_ewma"
+    )
+    __slots__ = fields
+    model = StatusType
+
+    # Decayed success rate and latency (ms, 0 = unknown.)
+    float_fields = ("success_ewma", "rtt_ewma")
+
+    def __init__(self, id, row_id, table_type, status, last_status, test_no, failed_tests, last_success, last_uptime, uptime, max_uptime, success_ewma=0.0, rtt_ewma=0.0):
+        self.id = id
+        self.row_id = row_id
+        self.table_type = table_type
+        self.status = status
+        self.last_status = last_status
+        self.test_no = test_no
+        self.failed_tests = failed_tests
+        self.last_success = last_success
+        self.last_uptime = last_uptime
+        self.uptime = uptime
+        self.max_uptime = max_uptime
+        self.success_ewma = success_ewma
+        self.rtt_ewma = rtt_ewma
+
+class Group(SlotRecord):
+    fields = ("id", "table_type", "af", "group")
+    __slots__ = fields
+    model = MetaGroup
+
+    def __init__(self, id, table_type, af, group):
+        self.id = id
+        self.table_type = table_type
+        self.af = af
+        self.group = group
+
+    def to_model(self):
+        group = [member.to_model() for member in self.group]
+        return MetaGroup(
+            id=self.id,
+            table_type=self.table_type,
+            af=self.af,
+            group=group
+        )
+
 # Field types.
 MEM_DB_TYPES = {
-    SERVICES_TABLE_TYPE: RecordType,
-    ALIASES_TABLE_TYPE: AliasType,
-    IMPORTS_TABLE_TYPE: RecordType,
-    STATUS_TABLE_TYPE: StatusType
+    SERVICES_TABLE_TYPE: Record,
+    ALIASES_TABLE_TYPE: Alias,
+    IMPORTS_TABLE_TYPE: Record,
+    STATUS_TABLE_TYPE: Status
 }
 
 MEM_DB_ENUMS = {
@@ -0,0 +1,274 @@
+"""
+Crash recovery for MemDB without going through SQLite.
+
+A snapshot is every row (as a tuple of its record fields) plus the id
+counters, pickled with protocol 5. Rows marked dirty after that are
+appended to a journal every JOURNAL_FLUSH_INTERVAL seconds as CRC checked
+frames, so a crash loses at most that many seconds of changes. Recovery
+loads the snapshot and replays the journal over it. Journal entries are
+whole rows, so replay is just an upsert (or delete) by id.
+
+When the journal grows past JOURNAL_MAX_BYTES a new snapshot is written
+and the journal starts over. Both files carry a generation number and a
+journal is only replayed over the snapshot it was started from. That way
+a crash between the two writes can't roll rows back to older values.
+
+Rows are copied into tuples on the event loop. Pickling, writing and
+fsync run in an executor so a large snapshot doesn't stall requests.
+
+SQLite is still written as before. It can be behind the journal after a
+crash so every recovered row is flushed to it once. Delete the snapshot
+to make the dealer load from SQLite instead.
+"""
+
+import os
+import gc
+import asyncio
+import threading
+import time
+import zlib
+import struct
+import pickle
+from ..defs import *
+from .mem_db_defs import *
+from .mem_db_utils import *
+
+JOURNAL_FRAME = struct.Struct(">II") # length, crc32
+
+def row_values(record):
+    return tuple(getattr(record, name) for name in record.fields)
+
+def encode_frame(obj):
+    body = pickle.dumps(obj, protocol=5)
+    return JOURNAL_FRAME.pack(len(body), zlib.crc32(body)) + body
+
+def read_frames(path):
+    # Stops at the first torn or corrupt frame -- the tail of a crash.
+    with open(path, "rb") as fp:
+        while True:
+            header = fp.read(JOURNAL_FRAME.size)
+            if len(header) < JOURNAL_FRAME.size:
+                return
+
+            size, crc = JOURNAL_FRAME.unpack(header)
+            body = fp.read(size)
+            if len(body) < size or zlib.crc32(body) != crc:
+                return
+
+            yield pickle.loads(body)
+
+def write_file(path, data):
+    # Atomic replace so a crash leaves the old or new file, never half.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(tmp_path, path)
+
+class MemDBJournal:
+    def __init__(self, mem_db, path=JOURNAL_PATH, snapshot_path=SNAPSHOT_PATH, fsync=JOURNAL_FSYNC):
+        self.mem_db = mem_db
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.fsync = fsync
+        self.generation = 0
+        self.fp = None
+        self.size = 0
+
+        # Writes from the executor and close() can overlap at shutdown.
+        self.io_lock = threading.Lock()
+        self.dirty = {t: set() for t in PERSISTED_TABLE_TYPES}
+        self.deleted = {t: set() for t in PERSISTED_TABLE_TYPES}
+
+    def mark_dirty(self, table_type, row_id):
+        self.dirty[table_type].add(row_id)
+        self.deleted[table_type].discard(row_id)
+
+    def mark_deleted(self, table_type, row_id):
+        self.deleted[table_type].add(row_id)
+        self.dirty[table_type].discard(row_id)
+
+    def take_entries(self):
+        # Rows are read now so entries have their latest values.
+        entries = []
+        for table_type in PERSISTED_TABLE_TYPES:
+            table = self.mem_db.tables[table_type]
+            for row_id in self.deleted[table_type]:
+                entries.append((table_type, row_id, None))
+
+            for row_id in self.dirty[table_type]:
+                record = table.get(row_id)
+                if record is not None:
+                    entries.append((table_type, row_id, row_values(record)))
+
+            self.dirty[table_type].clear()
+            self.deleted[table_type].clear()
+
+        return entries
+
+    def flush(self):
+        # Returns how many rows were written.
+        if self.fp is None:
+            return 0
+
+        entries = self.take_entries()
+        if entries:
+            self.write_entries(entries)
+
+        return len(entries)
+
+    async def flush_in_executor(self):
+        # Same as flush but the disk work is off the event loop.
+        if self.fp is None:
+            return 0
+
+        entries = self.take_entries()
+        if entries:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.write_entries, entries)
+
+        return len(entries)
+
+    def write_entries(self, entries):
+        frame = encode_frame(entries)
+        with self.io_lock:
+            self.fp.write(frame)
+            self.fp.flush()
+            if self.fsync:
+                os.fsync(self.fp.fileno())
+
+            self.size += len(frame)
+
+    def should_compact(self):
+        return self.size > JOURNAL_MAX_BYTES
+
+    def snapshot_state(self):
+        # Unique across restarts so old journals never match.
+        mem_db = self.mem_db
+        self.generation = max(self.generation + 1, time.time_ns())
+        tables = {}
+        for table_type in PERSISTED_TABLE_TYPES:
+            tables[table_type] = [
+                row_values(record)
+                for record in mem_db.tables[table_type].values()
+            ]
+
+        # Anything waiting to be journaled is in the snapshot.
+        self.take_entries()
+        return {
+            "generation": self.generation,
+            "id_max": dict(mem_db.id_max),
+            "tables": tables,
+        }
+
+    def write_snapshot(self, state):
+        with self.io_lock:
+            write_file(self.snapshot_path, pickle.dumps(state, protocol=5))
+
+            # New journal starts with its generation.
+            if self.fp is not None:
+                self.fp.close()
+
+            header = encode_frame({"generation": state["generation"]})
+            write_file(self.path, header)
+            self.fp = open(self.path, "ab")
+            self.size = len(header)
+
+    def snapshot(self):
+        """
+        Write every row to a new snapshot and start an empty journal
+        for it. Anything waiting to be journaled is in the snapshot.
+        """
+        self.write_snapshot(self.snapshot_state())
+
+    async def snapshot_in_executor(self):
+        state = self.snapshot_state()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.write_snapshot, state)
+
+    def close(self):
+        self.flush()
+        with self.io_lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+def read_snapshot(snapshot_path, path):
+    """
+    Returns (generation, id_max, {table_type: {row_id: values}},
+    {table_type: deleted_ids}) with the journal applied or None if
+    there's no snapshot.
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+
+    with open(snapshot_path, "rb") as fp:
+        state = pickle.load(fp)
+
+    tables = {}
+    deleted = {}
+    for table_type, rows in state["tables"].items():
+        tables[table_type] = {values[0]: values for values in rows}
+        deleted[table_type] = set()
+
+    # Replay changes made since the snapshot.
+    if os.path.exists(path):
+        frames = read_frames(path)
+        header = next(frames, None)
+        if header is not None and header.get("generation") == state["generation"]:
+            for entries in frames:
+                for table_type, row_id, values in entries:
+                    if values is None:
+                        tables[table_type].pop(row_id, None)
+                        deleted[table_type].add(row_id)
+                    else:
+                        tables[table_type][row_id] = values
+                        deleted[table_type].discard(row_id)
+
+    return state["generation"], state["id_max"], tables, deleted
+
+def recover_mem_db(mem_db, snapshot_path=SNAPSHOT_PATH, path=JOURNAL_PATH):
+    """
+    Rebuild mem_db from the snapshot and journal. Returns the
+    generation it recovered or None if there was no snapshot.
+    """
+    start = time.perf_counter()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        state = read_snapshot(snapshot_path, path)
+        if state is None:
+            return None
+
+        generation, id_max, tables, deleted = state
+        status_ids = {table_type: {} for table_type in TABLE_TYPES}
+        statuses = [Status(*v) for v in tables[STATUS_TABLE_TYPE].values()]
+        load_statuses(mem_db, statuses, status_ids)
+        for table_type in IMPORT_ORDER:
+            cls = MEM_DB_TYPES[table_type]
+            objs = [cls(*v) for v in tables[table_type].values()]
+            groups = {}
+            load_records(mem_db, table_type, objs, status_ids, groups)
+            load_groups(mem_db, table_type, groups)
+
+        # Ids are never reused even if their rows were removed.
+        for table_type, n in id_max.items():
+            mem_db.add_id(table_type, n)
+
+        # SQLite may be behind the journal so the next flush writes
+        # every recovered row rather than only later changes.
+        for table_type in PERSISTED_TABLE_TYPES:
+            mem_db.dirty[table_type].update(tables[table_type])
+            mem_db.deleted[table_type].update(deleted[table_type])
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    freeze_loaded_rows()
+    elapsed = time.perf_counter() - start
+    mem_db.loaded.update(TABLE_TYPES)
+    mem_db.load_stats = {"snapshot": elapsed, "first_work": elapsed}
+    print("Recovered from snapshot in %.2f s" % (elapsed,))
+    return generation
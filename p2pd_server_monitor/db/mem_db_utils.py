@@ -1,5 +1,8 @@
 from dataclasses import asdict, fields, is_dataclass
 from collections import OrderedDict
+import gc
+import time
+import asyncio
 import aiosqlite
 import sqlite3
 from ..defs import *
@@ -12,7 +15,14 @@ async def insert_object(db, table, obj):
     async with db.execute(f"PRAGMA table_info({table})") as cursor:
         columns = {row[1] async for row in cursor}  
 
-    data = asdict(obj) if hasattr(obj, "__dataclass_fields__") else vars(obj)
+    # Slotted rows have no __dict__ for vars().
+    if isinstance(obj, SlotRecord):
+        data = obj.dict()
+    elif hasattr(obj, "__dataclass_fields__"):
+        data = asdict(obj)
+    else:
+        data = vars(obj)
+
     valid = {k: v for k, v in data.items() if k in columns}
 
     if not valid:
@@ -28,7 +38,9 @@ async def load_objects(db, table, cls, where_clause: str = None, where_args: tup
         db_cols = {row[1] async for row in cursor}
 
     # Get class fields dynamically
-    if is_dataclass(cls):
+    if hasattr(cls, "fields") and isinstance(cls.fields, tuple):
+        class_fields = list(cls.fields)
+    elif is_dataclass(cls):
         class_fields = [f.name for f in fields(cls)]
     elif hasattr(cls, "model_fields"):  # Pydantic v2
         class_fields = list(cls.model_fields.keys())
@@ -50,6 +62,10 @@ async def load_objects(db, table, cls, where_clause: str = None, where_args: tup
         rows = await cursor.fetchall()
         col_index = {desc[0]: i for i, desc in enumerate(cursor.description)}
 
+    # Rows already in field order can skip building kwargs.
+    if select_cols == class_fields:
+        return [cls(*row) for row in rows]
+
     objs = []
     for row in rows:
         kwargs = {col: row[col_index[col]] for col in select_cols}
@@ -67,62 +83,237 @@ async def sqlite_export(mem_db, sqlite_db):
                 what_exception()
                 continue
             except:
+                # Callers roll back rather than commit a partial export.
                 log_exception()
+                raise
+
+async def table_columns(db, table, cls):
+    # Columns that exist in both the table and the record class.
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        db_cols = {row[1] async for row in cursor}
+
+    return [c for c in cls.fields if c in db_cols]
+
+# Columns added after a table was first created. Older DBs
+# get them on startup or table_columns() would skip them.
+MIGRATED_COLUMNS = {
+    "status": (
+        ("success_ewma", "REAL NOT NULL DEFAULT 0"),
+        ("rtt_ewma", "REAL NOT NULL DEFAULT 0"),
+    ),
+}
+
+async def migrate_db(db_name=DB_NAME):
+    # Returns the columns that were added.
+    added = []
+    async with aiosqlite.connect(db_name) as sqlite_db:
+        for table, columns in MIGRATED_COLUMNS.items():
+            async with sqlite_db.execute(f"PRAGMA table_info({table})") as cursor:
+                db_cols = {row[1] async for row in cursor}
+
+            for col, col_type in columns:
+                if col not in db_cols:
+                    await sqlite_db.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {col} {col_type}"
+                    )
+                    added.append((table, col))
+
+        await sqlite_db.commit()
+
+    return added
+
+def upsert_sql(table, cols):
+    # Prepared once per table and reused for every row by executemany.
+    updates = ", ".join(f"{c} = excluded.{c}" for c in cols if c != "id")
+    placeholders = ", ".join("?" for _ in cols)
+    return (
+        f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders}) "
+        f"ON CONFLICT(id) DO UPDATE SET {updates}"
+    )
+
+async def upsert_rows(db, sql, rows):
+    try:
+        await db.executemany(sql, rows)
+    except sqlite3.IntegrityError:
+        # One bad row fails the whole batch so retry row by row.
+        for row in rows:
+            try:
+                await db.execute(sql, row)
+            except sqlite3.IntegrityError:
+                what_exception()
+
+async def sqlite_flush(mem_db, sqlite_db):
+    """
+    Write-behind for rows changed since the last flush.
+    Cost scales with how many rows changed rather than table sizes.
+    Returns the changes written so a failed commit can restore them.
+    """
+    changes = mem_db.take_changes()
+    dirty, deleted = changes
+    try:
+        for table_type in mem_db.tables:
+            table = MEM_DB_ENUMS[table_type]
+            if deleted[table_type]:
+                await sqlite_db.executemany(
+                    f"DELETE FROM {table} WHERE id = ?",
+                    [(row_id,) for row_id in deleted[table_type]]
+                )
+
+            if not dirty[table_type]:
+                continue
 
-async def sqlite_import(mem_db):
-    async with aiosqlite.connect(DB_NAME) as sqlite_db:
-        # 1. Load all StatusType rows in batch
-        all_statuses = await load_objects(sqlite_db, "status", StatusType)
-        for status in all_statuses:
-            mem_db.add_id(STATUS_TABLE_TYPE, status.id + 1)
-            mem_db.statuses[status.id] = status
-
-        # Used to rebuild groups table.
-        group_maps = OrderedDict({
-            ALIASES_TABLE_TYPE: {},
-            IMPORTS_TABLE_TYPE: {},
-            SERVICES_TABLE_TYPE: {}
-        })
-
-        # 2. Load main tables.
-        for table_type in group_maps:
             cls = MEM_DB_TYPES[table_type]
-            table_name = MEM_DB_ENUMS[table_type]
-            objs = await load_objects(sqlite_db, table_name, cls)
-            for obj in objs:
-                # Insert into main table dict
-                mem_db.add_id(table_type, obj.id + 1)
-                mem_db.tables[table_type][obj.id] = obj
-
-                # Try increase max group_id.
-                mem_db.add_id(GROUPS_TABLE_TYPE, obj.group_id + 1)
-                if obj.group_id not in group_maps[table_type]:
-                    group_maps[table_type][obj.group_id] = []
-                group_maps[table_type][obj.group_id].append(obj)
-
-                # Rebuild unique indexes
-                mem_db.uniques[table_type].add(obj)
-                if table_name == "aliases":
-                    mem_db.records_by_aliases[obj.id] = []
-                    mem_db.add_alias_by_ip(obj)
-                else:
-                    if obj.alias_id is not None:
-                        mem_db.records_by_aliases[obj.alias_id].append(obj)
-
-    # After loading all tables
-    for status in mem_db.statuses.values():
-        table_type = status.table_type
-        row_id = status.row_id
-
-        # Fetch the corresponding record
-        record = mem_db.records[table_type].get(row_id)
-        if record:
-            record.status_id = status.id
-
-    # Rebuild meta_group structure for services.
-    for table_type in group_maps:
-        for group_id in group_maps[table_type]:
-            group = group_maps[table_type][group_id]
-            status_id = group[0].status_id
-            status = mem_db.statuses[status_id].status
-            mem_db.add_work(group[0].af, table_type, group, group_id, STATUS_INIT)
+            cols = await table_columns(sqlite_db, table, cls)
+            records = mem_db.tables[table_type]
+            rows = []
+            for row_id in dirty[table_type]:
+                record = records.get(row_id)
+                if record is not None:
+                    rows.append(tuple(getattr(record, c) for c in cols))
+
+            await upsert_rows(sqlite_db, upsert_sql(table, cols), rows)
+    except:
+        mem_db.restore_changes(changes)
+        raise
+
+    return changes
+
+async def iter_objects(db, table, cls, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Yield lists of rows from a table as cls objects using fetchmany
+    so a big table never sits in memory twice. No validation is done.
+    """
+    cols = await table_columns(db, table, cls)
+    if not cols:
+        return
+
+    sql = f"SELECT {', '.join(cols)} FROM {table} ORDER BY id ASC"
+    positional = cols == list(cls.fields)
+    async with db.execute(sql) as cursor:
+        # Fetch the next batch while this one is being built.
+        pending = asyncio.ensure_future(cursor.fetchmany(batch_size))
+        while True:
+            rows = await pending
+            if not rows:
+                break
+
+            pending = asyncio.ensure_future(cursor.fetchmany(batch_size))
+            if positional:
+                yield [cls(*row) for row in rows]
+            else:
+                yield [cls(**dict(zip(cols, row))) for row in rows]
+
+def load_statuses(mem_db, statuses, status_ids):
+    # status_ids is {table_type: {row_id: status_id}} to link records with.
+    for status in statuses:
+        mem_db.statuses[status.id] = status
+        status_ids[status.table_type][status.row_id] = status.id
+
+    if statuses:
+        mem_db.add_id(STATUS_TABLE_TYPE, max(s.id for s in statuses) + 1)
+
+def load_records(mem_db, table_type, objs, status_ids, groups):
+    # Add a batch of rows for a table and collect them into groups.
+    records = mem_db.tables[table_type]
+    row_status_ids = status_ids[table_type]
+    records_by_aliases = mem_db.records_by_aliases
+
+    # Raises KeyError on duplicates.
+    mem_db.uniques[table_type].add_many(objs)
+    for obj in objs:
+        records[obj.id] = obj
+        obj.status_id = row_status_ids.get(obj.id)
+        if obj.group_id not in groups:
+            groups[obj.group_id] = []
+        groups[obj.group_id].append(obj)
+
+        # Tables can load in any order so don't overwrite.
+        if table_type == ALIASES_TABLE_TYPE:
+            records_by_aliases.setdefault(obj.id, [])
+            mem_db.add_alias_by_ip(obj)
+        elif obj.alias_id is not None:
+            records_by_aliases.setdefault(obj.alias_id, []).append(obj)
+
+    if objs:
+        mem_db.add_id(table_type, max(obj.id for obj in objs) + 1)
+
+def load_groups(mem_db, table_type, groups):
+    # Work queues for the whole table in one pass.
+    if groups:
+        mem_db.add_id(GROUPS_TABLE_TYPE, max(groups) + 1)
+        mem_db.add_groups(table_type, groups, STATUS_INIT)
+
+async def import_statuses(mem_db, sqlite_db):
+    status_ids = {table_type: {} for table_type in TABLE_TYPES}
+    async for statuses in iter_objects(sqlite_db, "status", Status):
+        load_statuses(mem_db, statuses, status_ids)
+
+    return status_ids
+
+async def import_table(mem_db, sqlite_db, table_type, status_ids):
+    groups = {} # group_id: [record ...]
+    table_name = MEM_DB_ENUMS[table_type]
+    cls = MEM_DB_TYPES[table_type]
+    async for objs in iter_objects(sqlite_db, table_name, cls):
+        load_records(mem_db, table_type, objs, status_ids, groups)
+
+    load_groups(mem_db, table_type, groups)
+
+# Services first so /work can start before the rest is resident.
+IMPORT_ORDER = (SERVICES_TABLE_TYPE, ALIASES_TABLE_TYPE, IMPORTS_TABLE_TYPE)
+
+# Set once rows from the first good load are frozen.
+rows_frozen = False
+
+def freeze_loaded_rows():
+    """
+    Rows live as long as the process so keep them out of GC scans.
+    Only done after the first load that worked. Freezing again
+    would pin rows replaced by later loads (and a failed load's
+    partial rows) for good.
+    """
+    global rows_frozen
+    if not rows_frozen:
+        gc.freeze()
+        rows_frozen = True
+
+async def sqlite_import(mem_db, db_name=DB_NAME):
+    """
+    Load the DB into mem_db. Tables are marked in mem_db.loaded as they
+    finish so the dealer can serve work while the rest loads.
+    Load times go in mem_db.load_stats, including time to first work.
+    """
+    start = time.perf_counter()
+    mem_db.loaded = set()
+    mem_db.load_stats = {}
+
+    # Millions of new objects set off full GC passes that find nothing.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        await import_tables(mem_db, db_name, start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    freeze_loaded_rows()
+    print("DB loaded in %.2f s" % (time.perf_counter() - start,))
+
+async def import_tables(mem_db, db_name, start):
+    async with aiosqlite.connect(db_name) as sqlite_db:
+        status_ids = await import_statuses(mem_db, sqlite_db)
+        mem_db.load_stats["status"] = time.perf_counter() - start
+
+        for table_type in IMPORT_ORDER:
+            await import_table(mem_db, sqlite_db, table_type, status_ids)
+            mem_db.loaded.add(table_type)
+            elapsed = time.perf_counter() - start
+            mem_db.load_stats[MEM_DB_ENUMS[table_type]] = elapsed
+            if table_type == SERVICES_TABLE_TYPE:
+                mem_db.load_stats["first_work"] = elapsed
+                print("Time to first work: %.2f s" % (elapsed,))
+
+            # Listed FQNs need the aliases too.
+            if mem_db.server_list is not None:
+                if table_type in (SERVICES_TABLE_TYPE, ALIASES_TABLE_TYPE):
+                    mem_db.server_list.rebuild()
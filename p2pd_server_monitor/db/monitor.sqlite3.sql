@@ -16,6 +16,8 @@ CREATE TABLE IF NOT EXISTS "status" (
 	"uptime"	INTEGER NOT NULL DEFAULT 0,
 	"max_uptime"	INTEGER NOT NULL DEFAULT 0,
 	"last_uptime"	INTEGER NOT NULL DEFAULT 0 CHECK("last_uptime" = 0 OR ("last_uptime" >= 1735689600 AND "last_uptime" <= 32503680000)),
+	"success_ewma"	REAL NOT NULL DEFAULT 0,
+	"rtt_ewma"	REAL NOT NULL DEFAULT 0,
 	PRIMARY KEY("id")
 );
 CREATE TABLE IF NOT EXISTS "aliases" (
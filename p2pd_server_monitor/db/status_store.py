@@ -0,0 +1,126 @@
+"""
+Optional columnar copy of the status table in a NumPy structured array.
+
+Row n of the array is status_id n so updates and lookups are an index.
+MemDB writes a status into its row whenever the status is marked dirty,
+so mark_complete keeps it current in place. Empty rows have id 0.
+
+Backed by a file the array is mmaped and other processes (e.g. something
+rendering /servers) can map the same file read-only and read every
+status with no copies and no calls to the dealer. Readers may see a row
+half way through an update -- fine for stats.
+
+Needs numpy. Turned on by setting MONITOR_STATUS_STORE to a file path.
+"""
+
+import os
+from ..defs import *
+from .mem_db_defs import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def status_dtype():
+    return np.dtype([
+        (name, "<f8" if name in Status.float_fields else "<i8")
+        for name in Status.fields
+    ])
+
+class StatusStore:
+    def __init__(self, path=None, capacity=STATUS_STORE_CAPACITY, readonly=False):
+        if np is None:
+            raise ImportError("the status store needs numpy")
+
+        self.path = path
+        self.readonly = readonly
+        self.dtype = status_dtype()
+        if path is None:
+            self.array = np.zeros(capacity, dtype=self.dtype)
+        else:
+            self.array = self.map(capacity)
+
+    @classmethod
+    def open_readonly(cls, path):
+        return cls(path, readonly=True)
+
+    def map(self, capacity):
+        if self.readonly:
+            return np.memmap(self.path, dtype=self.dtype, mode="r")
+
+        # Grow the file to fit -- new space reads as zeros.
+        size = capacity * self.dtype.itemsize
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+
+        if os.path.getsize(self.path) < size:
+            os.truncate(self.path, size)
+
+        return np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r+",
+            shape=(os.path.getsize(self.path) // self.dtype.itemsize,)
+        )
+
+    def refresh(self):
+        # Readers pick up rows added after the file grew.
+        if self.path is not None:
+            self.array = self.map(len(self.array))
+
+    def reserve(self, status_id):
+        if status_id < len(self.array):
+            return
+
+        capacity = max(status_id + 1, 2 * len(self.array))
+        if self.path is None:
+            array = np.zeros(capacity, dtype=self.dtype)
+            array[:len(self.array)] = self.array
+            self.array = array
+        else:
+            self.array.flush()
+            self.array = self.map(capacity)
+
+    def put(self, status):
+        self.reserve(status.id)
+        self.array[status.id] = tuple(
+            getattr(status, name) for name in Status.fields
+        )
+
+    def remove(self, status_id):
+        if status_id < len(self.array):
+            self.array[status_id] = 0
+
+    def load(self, statuses):
+        # Replace everything with these statuses in one pass per column.
+        statuses = list(statuses)
+        if statuses:
+            self.reserve(max(status.id for status in statuses))
+
+        self.array[:] = 0
+        ids = np.fromiter((s.id for s in statuses), np.int64, len(statuses))
+        for name in Status.fields:
+            self.array[name][ids] = np.fromiter(
+                (getattr(s, name) for s in statuses),
+                self.dtype[name],
+                len(statuses)
+            )
+
+    def column(self, name):
+        return self.array[name]
+
+    def valid(self):
+        # Mask of rows that hold a status.
+        return self.array["id"] != 0
+
+    def get(self, status_id):
+        if status_id >= len(self.array) or not self.array["id"][status_id]:
+            return None
+
+        row = self.array[status_id]
+        return {name: row[name].item() for name in Status.fields}
+
+    def flush(self):
+        if self.path is not None and not self.readonly:
+            self.array.flush()
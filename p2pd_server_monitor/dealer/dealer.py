@@ -1,8 +1,8 @@
 import uvicorn
 import aiosqlite
 import threading
-from fastapi import FastAPI, Depends, Request
-from fastapi.responses import Response
+from fastapi import FastAPI, Depends, Request, HTTPException
+from fastapi.responses import Response, JSONResponse, PlainTextResponse
 from p2pd import *
 from typing import List
 from pprint import pformat
@@ -13,179 +13,287 @@ from ..db.db_init import *
 from ..txt_strs import *
 from ..db.mem_db_utils import *
 from ..db.mem_db import *
+from ..db.mem_db_journal import *
+from ..db.status_store import *
 from ..do_imports import *
+from .server_list import *
+from .dealer_core import *
+from .dealer_metrics import *
+from ..rpc import *
+from ..dns_cache import *
 
 app = FastAPI(default_response_class=PrettyJSONResponse)
-mem_db = MemDB()
-server_cache = []
-server_list_str = ""
-refresh_task = None
+
+# Everything the endpoints expect to be set on a mem_db.
+def make_mem_db():
+    mem_db = MemDB()
+    mem_db.server_list = ServerList(mem_db, get_scorer(os.environ.get("MONITOR_SCORER")))
+    mem_db.metrics = dealer_metrics(mem_db)
+    mem_db.dns_cache = DNSCache()
+    if os.environ.get("MONITOR_PROBE_BUDGET"):
+        mem_db.probe_budget = ProbeBudget(float(os.environ["MONITOR_PROBE_BUDGET"]))
+
+    return mem_db
+
+mem_db = make_mem_db()
+flush_task = None
+load_task = None
+journal_task = None
+rpc_server = None
 db_lock = threading.Lock()
 
-async def save_all(mem_db):
-    async with aiosqlite.connect(DB_NAME) as sqlite_db:
+async def save_all(mem_db, db_name=DB_NAME):
+    async with aiosqlite.connect(db_name) as sqlite_db:
+        await sqlite_db.execute("PRAGMA journal_mode=WAL")
+        await sqlite_db.execute("PRAGMA synchronous=NORMAL")
+        changes = None
         try:
             await sqlite_db.execute("BEGIN")
-            await delete_all_data(sqlite_db)
-            await sqlite_export(mem_db, sqlite_db)
+            changes = await sqlite_flush(mem_db, sqlite_db)
+            await sqlite_db.commit()
         except Exception:
             what_exception()
             log_exception()
+
+            # Rows weren't saved so flush them again next time.
+            if changes is not None:
+                mem_db.restore_changes(changes)
+
             await sqlite_db.rollback()
             raise
-        else:
-            await sqlite_db.commit()
 
-async def refresh_server_cache():
-    global server_list_str
-    global server_cache
-    global mem_db
+async def flush_changes():
     while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
         try:
-            server_cache = build_server_list(mem_db)
-            server_list_str = json.dumps(
-                server_cache,
-                indent=4,
-                sort_keys=False,
-                default=str
-            )
-
+            start = time.perf_counter()
             await save_all(mem_db)
+            elapsed = time.perf_counter() - start
+            mem_db.metrics.observe("dealer_save_seconds", elapsed, ("sqlite",))
+            if mem_db.status_store is not None:
+                mem_db.status_store.flush()
+        except:
+            log_exception()
+
+async def start_journal(mem_db):
+    # Snapshot what's loaded and journal changes from here on.
+    if mem_db.journal is not None:
+        mem_db.journal.close()
+
+    # Changes made while the snapshot is written go in the new journal.
+    journal = MemDBJournal(mem_db)
+    state = journal.snapshot_state()
+    mem_db.journal = journal
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, journal.write_snapshot, state)
+
+async def journal_changes():
+    while True:
+        await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+        journal = mem_db.journal
+        if journal is None:
+            continue
+
+        try:
+            start = time.perf_counter()
+            await journal.flush_in_executor()
+            if journal.should_compact():
+                await journal.snapshot_in_executor()
+
+            elapsed = time.perf_counter() - start
+            mem_db.metrics.observe("dealer_save_seconds", elapsed, ("journal",))
         except:
             log_exception()
-        await asyncio.sleep(60)
 
 @app.middleware("http")
 async def no_cache_middleware(request: Request, call_next):
     response: Response = await call_next(request)
+
+    # The public server list sets its own caching headers.
+    if request.url.path.startswith("/servers"):
+        return response
+
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
-@app.on_event("startup")
-async def main():
-    global refresh_task
-    global mem_db
+# Callers retry when tables they need are still loading.
+@app.exception_handler(DealerLoadingError)
+async def loading_handler(request: Request, e: DealerLoadingError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(e)},
+        headers={"Retry-After": "1"}
+    )
+
+async def load_db():
+    # Old DBs lack newer columns that flushes need to write.
     try:
-        await sqlite_import(mem_db)
+        await migrate_db()
+    except:
+        log_exception()
 
-        # Merge CSV file imports with current mem DB.
+    # The snapshot + journal is newer than SQLite and faster to load.
+    recovered = None
+    try:
+        recovered = recover_mem_db(mem_db)
+    except:
+        log_exception()
+        mem_db.setup_db()
+
+    if recovered is None:
+        try:
+            await sqlite_import(mem_db)
+        except:
+            # Tables that didn't load keep refusing calls. New rows
+            # could reuse ids that are still in SQLite.
+            log_exception()
+            mem_db.metrics.inc("dealer_load_failed_total")
+            print("DB import failed. Tables loaded: %s" % (
+                ", ".join(MEM_DB_ENUMS[t] for t in sorted(mem_db.loaded)) or "none",
+            ))
+            mem_db.server_list.rebuild()
+
+            # A snapshot of the partial DB would replace SQLite on restart.
+            return
+
+    # Merge CSV file imports with current mem DB.
+    try:
         insert_main(mem_db)
     except:
         log_exception()
 
-    refresh_task = asyncio.create_task(refresh_server_cache())
+    mem_db.server_list.rebuild()
+
+    # Optional mmaped copy of the statuses other processes can read.
+    store_path = os.environ.get("MONITOR_STATUS_STORE")
+    if store_path:
+        try:
+            mem_db.status_store = StatusStore(store_path)
+            mem_db.status_store.load(mem_db.statuses.values())
+        except:
+            log_exception()
+            mem_db.status_store = None
+
+    await start_journal(mem_db)
+
+@app.on_event("startup")
+async def main():
+    global flush_task
+    global load_task
+    global journal_task
+    global rpc_server
+    global mem_db
+
+    # Requests are served while the DB loads in the background.
+    mem_db.loaded = set()
+    load_task = asyncio.create_task(load_db())
+    flush_task = asyncio.create_task(flush_changes())
+    journal_task = asyncio.create_task(journal_changes())
+
+    # Workers on this host can skip HTTP and talk over a Unix socket.
+    rpc_path = os.environ.get("MONITOR_DEALER_RPC")
+    if rpc_path:
+        rpc_server = RPCServer(DEALER_CALLS, mem_db)
+        await rpc_server.start(rpc_path)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     print("Server is stopping... cleaning up resources")
+    if rpc_server is not None:
+        await rpc_server.close()
+
+    if mem_db.journal is not None:
+        mem_db.journal.close()
+
     await save_all(mem_db)
 
 # Hands out work (servers to check) to worker processes.
 @app.post("/work", dependencies=[Depends(localhost_only)])
 def api_get_work(request: GetWorkReq):
-    stack_type = request.stack_type
-    current_time = request.current_time or int(time.time())
-    monitor_frequency = request.monitor_frequency or MONITOR_FREQUENCY
-    table_type = request.table_type
-
-    # Indicate IPv4 / 6 support of worker process.
-    if stack_type == DUEL_STACK:
-        need_afs = VALID_AFS
-    else:
-        need_afs = (stack_type,) if stack_type in VALID_AFS else VALID_AFS
-
-    # Set table type.
-    if table_type in TABLE_TYPES:
-        table_types = (table_type,)
-    else: 
-        table_types = TABLE_TYPES
-
-    # Allocate work from work queues based on req preferences.
-    return allocate_work(
-        mem_db,
-        need_afs,
-        table_types,
-        current_time,
-        monitor_frequency
-    )
+    return get_work(mem_db, **request.dict())
 
 @app.post("/complete", dependencies=[Depends(localhost_only)])
 def api_work_done(payload: WorkDoneReq):
-    results: List[int] = []
-    for status_info in payload.statuses:
-        try:
-            ret = mark_complete(mem_db, **status_info.dict())
-            results.append(ret)
-        except KeyError:
-            log_exception()
-            continue
-
-    return results
+    statuses = [s.dict() for s in payload.statuses]
+    return work_done(mem_db, statuses, payload.lease_id, payload.telemetry)
 
 @app.post("/insert", dependencies=[Depends(localhost_only)])
 def api_insert_services(payload: InsertServicesReq):
     print(payload)
-    for groups in payload.imports_list:
-        try:
-            records = []
-            alias_count = 0
-            for service in groups:
-                # Convert Pydantic model to dict
-                record = mem_db.insert_service(**service.dict())
-                records.append(record)
-
-                if service.alias_id is not None:
-                    alias_count += 1
-
-            # STUN change servers should have all or no alias.
-            if records[0].type == STUN_CHANGE_TYPE:
-                if alias_count not in (0, 4):
-                    # TODO: delete created records
-                    raise Exception("STUN change servers need even aliases")
-
-            mem_db.add_work(records[0].af, SERVICES_TABLE_TYPE, records)
-        except DuplicateRecordError:
-            log_exception()
-            continue
-
-    # Only allocate imports work once.
-    # This deletes the associated status record. 
-    mark_complete(
-        mem_db,
-        1 if len(payload.imports_list) else 0,
-        payload.status_id
-    )
-
-    return []
+    imports_list = [[s.dict() for s in groups] for groups in payload.imports_list]
+    return insert_services(mem_db, imports_list, payload.status_id)
 
 @app.post("/alias", dependencies=[Depends(localhost_only)])
 def api_update_alias(data: AliasUpdateReq):
-    ip = ensure_ip_is_public(data.ip)
-    current_time = data.current_time or int(time.time())
-    alias_id = data.alias_id
-
-    if alias_id not in mem_db.records[ALIASES_TABLE_TYPE]:
-        raise Exception("Alias id not found.")
-    
-    alias = mem_db.records[ALIASES_TABLE_TYPE][alias_id]
-
-    # Update alias by IP mappings.
-    mem_db.del_alias_by_ip(alias)
-    alias.ip = ip
-    mem_db.add_alias_by_ip(alias)
+    return update_alias(mem_db, **data.dict())
 
-    for table_type in (IMPORTS_TABLE_TYPE, SERVICES_TABLE_TYPE):
-        update_table_ip(mem_db, table_type, ip, alias_id, current_time)
+# DNS answers shared by every worker.
+@app.post("/dns", dependencies=[Depends(localhost_only)])
+def api_shared_dns(payload: DNSReq):
+    return shared_dns(mem_db, **payload.dict())
 
-    return []
+# Prometheus text format.
+@app.get("/metrics", dependencies=[Depends(localhost_only)])
+def api_metrics():
+    return PlainTextResponse(
+        mem_db.metrics.render(),
+        media_type="text/plain; version=0.0.4"
+    )
 
 # Show a listing of servers based on quality
 # Only public API is this one.
 @app.get("/servers")
-async def api_list_servers():
-    return Response(content=server_list_str, media_type="application/json")
+async def api_list_servers(request: Request):
+    snapshot = mem_db.server_list.snapshot()
+
+    # Serve the pre-compressed variant the client accepts.
+    accept_encoding = request.headers.get("accept-encoding")
+    encoding, body = snapshot.pick_encoding(accept_encoding)
+    headers = {
+        "ETag": snapshot.etags[encoding],
+        "Cache-Control": "public, max-age=%d" % (SERVER_LIST_REFRESH,),
+        "Vary": "Accept-Encoding",
+    }
+
+    # Client already has this version.
+    if snapshot.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers=headers
+    )
+
+# Top N groups for one part of the server list.
+# Served from the sorted buckets rather than the whole document.
+@app.get("/servers/query")
+async def api_query_servers(service_type: str | None = None, af: str | None = None, proto: str | None = None, min_score: float | None = None, limit: int = SERVER_QUERY_LIMIT, cursor: str | None = None, fields: str | None = None):
+    try:
+        service_names = {t: TXTS[t] for t in SERVICE_TYPES}
+        groups, next_cursor = mem_db.server_list.query(
+            service_type=list_name(service_type, service_names),
+            af=list_name(af, TXTS["af"]),
+            proto=list_name(proto, TXTS["proto"]),
+            min_score=min_score,
+            limit=min(max(limit, 1), MAX_SERVER_QUERY_LIMIT),
+            cursor=cursor,
+            fields=fields.split(",") if fields else None
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return JSONResponse(
+        content={"groups": groups, "next_cursor": next_cursor},
+        headers={
+            "Cache-Control": "public, max-age=%d" % (SERVER_LIST_REFRESH,)
+        }
+    )
 
 if IS_DEBUG:
     cwd = get_script_parent()
@@ -193,9 +301,18 @@ if IS_DEBUG:
     exec(open(test_apis_path).read(), globals())
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "p2pd_server_monitor.dealer_server:app",
-        host="*",
-        port=8000,
-        reload=False
-    )
\ No newline at end of file
+    # Local workers can skip TCP by setting the same socket path.
+    uds = os.environ.get("MONITOR_DEALER_UDS")
+    if uds:
+        uvicorn.run(
+            "p2pd_server_monitor.dealer_server:app",
+            uds=uds,
+            reload=False
+        )
+    else:
+        uvicorn.run(
+            "p2pd_server_monitor.dealer_server:app",
+            host="*",
+            port=8000,
+            reload=False
+        )
\ No newline at end of file
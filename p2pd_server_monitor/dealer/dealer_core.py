@@ -0,0 +1,183 @@
+"""
+What /work, /complete, /insert, /alias and /dns actually do, taking plain
+dicts. The HTTP endpoints and the Unix socket RPC server both call
+these so the two transports can't drift apart.
+"""
+
+import time
+from p2pd import *
+from ..defs import *
+from ..metrics import timed
+from ..worker.worker_metrics import add_probe_samples
+from .dealer_utils import *
+
+@timed("dealer_call_seconds", ("work",))
+def get_work(mem_db, stack_type=None, table_type=None, current_time=None, monitor_frequency=None, max_groups=None, max_seconds=None):
+    current_time = current_time or int(time.time())
+    monitor_frequency = monitor_frequency or MONITOR_FREQUENCY
+
+    # Indicate IPv4 / 6 support of worker process.
+    if stack_type == DUEL_STACK:
+        need_afs = VALID_AFS
+    else:
+        need_afs = (stack_type,) if stack_type in VALID_AFS else VALID_AFS
+
+    # Set table type.
+    if table_type in TABLE_TYPES:
+        table_types = (table_type,)
+    else:
+        table_types = TABLE_TYPES
+
+    # Tables still loading at startup can't be dealt from yet.
+    table_types = tuple(t for t in table_types if t in mem_db.loaded)
+    if not table_types:
+        raise DealerLoadingError("work tables are still loading")
+
+    # Hand out a batch of groups under a single lease.
+    if max_groups is not None:
+        return allocate_work_lease(
+            mem_db,
+            need_afs,
+            table_types,
+            current_time,
+            monitor_frequency,
+            max_groups,
+            max_seconds
+        )
+
+    # Allocate work from work queues based on req preferences.
+    return allocate_work(
+        mem_db,
+        need_afs,
+        table_types,
+        current_time,
+        monitor_frequency
+    )
+
+@timed("dealer_call_seconds", ("complete",))
+def work_done(mem_db, statuses, lease_id=None, telemetry=None):
+    # Probe timings workers chose to send.
+    if telemetry and mem_db.metrics is not None:
+        add_probe_samples(mem_db.metrics, telemetry[:TELEMETRY_BATCH_MAX])
+
+    results = []
+    done = []
+    try:
+        for status_info in statuses:
+            # One bad status shouldn't lose the rest of the lease.
+            try:
+                ret = mark_complete(mem_db, **status_info)
+                results.append(ret)
+                done.append(status_info["status_id"])
+            except (KeyError, TypeError, ValueError):
+                log_exception()
+                continue
+    finally:
+        # Hand back any leased work the worker didn't get to.
+        if lease_id is not None:
+            release_lease(mem_db, lease_id, done)
+
+    return results
+
+@timed("dealer_call_seconds", ("insert",))
+def insert_services(mem_db, imports_list, status_id):
+    if not mem_db.is_loaded():
+        raise DealerLoadingError("tables are still loading")
+
+    for groups in imports_list:
+        try:
+            records = []
+            alias_count = 0
+            for service in groups:
+                record = mem_db.insert_service(**service)
+                records.append(record)
+
+                if service.get("alias_id") is not None:
+                    alias_count += 1
+
+            # STUN change servers should have all or no alias.
+            if records[0].type == STUN_CHANGE_TYPE:
+                if alias_count not in (0, 4):
+                    # TODO: delete created records
+                    raise Exception("STUN change servers need even aliases")
+
+            meta_group = mem_db.add_work(records[0].af, SERVICES_TABLE_TYPE, records)
+            if mem_db.server_list is not None:
+                mem_db.server_list.touch_group(meta_group.id)
+        except DuplicateRecordError:
+            log_exception()
+            continue
+
+    # Only allocate imports work once.
+    # This deletes the associated status record.
+    mark_complete(
+        mem_db,
+        1 if len(imports_list) else 0,
+        status_id
+    )
+
+    return []
+
+@timed("dealer_call_seconds", ("alias",))
+def update_alias(mem_db, alias_id=None, ip=None, current_time=None, aliases=None, lease_id=None):
+    if not mem_db.is_loaded():
+        raise DealerLoadingError("tables are still loading")
+
+    current_time = current_time or int(time.time())
+    if aliases is None:
+        set_alias_ip(mem_db, alias_id, ensure_ip_is_public(ip), current_time)
+        return []
+
+    # Bulk results from an alias resolver -- [{alias_id, status_id, ips, t} ...]
+    results = []
+    done = []
+    try:
+        for result in aliases:
+            try:
+                ip = update_alias_ips(mem_db, result["alias_id"], result["ips"], current_time)
+                cache_alias_answer(mem_db, result["alias_id"], result["ips"], result.get("ttl"))
+                mark_complete(mem_db, int(ip is not None), result["status_id"], t=result.get("t"))
+                results.append(ip)
+                done.append(result["status_id"])
+            except (KeyError, TypeError, ValueError):
+                log_exception()
+                results.append(None)
+    finally:
+        # Hand back any leased aliases without a result.
+        if lease_id is not None:
+            release_lease(mem_db, lease_id, done)
+
+    return results
+
+@timed("dealer_call_seconds", ("dns",))
+def shared_dns(mem_db, names=None, answers=None):
+    """
+    The DNS cache every worker shares. answers ([{fqn, af, ips, ttl} ...])
+    are stored then names ([{fqn, af} ...]) are looked up. Returns
+    [{ips, ttl} or None ...] in the order of names -- ttl is what's left.
+    """
+    cache = mem_db.dns_cache
+    if cache is None:
+        return [None] * len(names or [])
+
+    for answer in (answers or [])[:DNS_SHARED_BATCH_MAX]:
+        cache.put(answer["fqn"], int(answer["af"]), answer["ips"], answer["ttl"])
+
+    results = []
+    for name in (names or [])[:DNS_SHARED_BATCH_MAX]:
+        entry = cache.get(name["fqn"], int(name["af"]))
+        if entry is None:
+            results.append(None)
+        else:
+            results.append({"ips": entry[0], "ttl": int(entry[1])})
+
+    return results
+
+# Method names for the RPC transport.
+DEALER_CALLS = {
+    "work": get_work,
+    "complete": work_done,
+    "insert": insert_services,
+    "alias": update_alias,
+    "dns": shared_dns,
+}
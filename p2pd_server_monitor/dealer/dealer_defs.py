@@ -1,6 +1,6 @@
 from p2pd import UDP, TCP, V4, V6
 from typing import Any, List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 
 class ServiceData(BaseModel):
     service_type: int
@@ -21,19 +21,60 @@ class WorkResultData(BaseModel):
     status_id: int
     is_success: int
     t: int
+    rtt: float | None = None
 
 class WorkDoneReq(BaseModel):
     statuses: List[WorkResultData]
+    lease_id: int | None = None
 
-class AliasUpdateReq(BaseModel):
+    # Optional worker probe timings: [[type, af, proto, {phase: secs}] ...]
+    telemetry: List[list] | None = None
+
+class AliasResultData(BaseModel):
     alias_id: int
-    ip: str
+    status_id: int
+    ips: List[str]
+    ttl: int | None = None # None if the lookup failed.
+    t: int | None = None
+
+class AliasUpdateReq(BaseModel):
+    alias_id: int | None = None
+    ip: str | None = None
     current_time: int | None = None
 
+    # Bulk results from an alias resolver instead of alias_id / ip.
+    aliases: List[AliasResultData] | None = None
+    lease_id: int | None = None
+
+    @model_validator(mode="after")
+    def validate_form(self):
+        single = self.alias_id is not None and self.ip is not None
+        partial = self.alias_id is not None or self.ip is not None
+        if self.aliases is None and not single:
+            raise ValueError("need alias_id and ip or aliases")
+
+        if self.aliases is not None and partial:
+            raise ValueError("aliases can't be mixed with alias_id or ip")
+
+        return self
+
 class GetWorkReq(BaseModel):
     stack_type: int | None
     table_type: int | None
     current_time: int | None
     monitor_frequency: int | None
+    max_groups: int | None = None
+    max_seconds: int | None = None
+
+    
+class DNSNameData(BaseModel):
+    fqn: str
+    af: int
+
+class DNSAnswerData(DNSNameData):
+    ips: List[str]
+    ttl: int
 
-    
\ No newline at end of file
+class DNSReq(BaseModel):
+    names: List[DNSNameData] | None = None
+    answers: List[DNSAnswerData] | None = None
@@ -0,0 +1,128 @@
+"""
+What the dealer reports on /metrics.
+
+The hot paths (dealer_core calls, deal_work, release_lease) only bump
+counters and histograms. Queue depths, how overdue the oldest AVAILABLE
+work is, open leases and load times are read from mem_db when /metrics
+is scraped.
+"""
+
+import time
+from ..defs import *
+from ..txt_strs import *
+from ..metrics import *
+from ..worker.worker_metrics import describe_probe_metrics
+from ..dns_cache import describe_dns_metrics, dns_cache_collector
+
+# Seconds -- MIN_MONITOR_INTERVAL to MAX_MONITOR_INTERVAL.
+INTERVAL_BUCKETS = (600, 1200, 1800, 3600, 7200, 10800, 14400, 21600)
+
+def table_name(table_type):
+    return TXTS.get(table_type, str(table_type))
+
+def af_name(af):
+    return TXTS["af"].get(af, str(af))
+
+def describe_dealer_metrics(metrics):
+    metrics.describe(
+        "dealer_call_seconds", "histogram",
+        "Time spent in a dealer call (HTTP or RPC.)",
+        ("call",)
+    )
+    metrics.describe(
+        "dealer_allocate_scanned", "histogram",
+        "Queue heads examined per allocate call.",
+        buckets=COUNT_BUCKETS
+    )
+    metrics.describe(
+        "dealer_work_reallocated_total", "counter",
+        "Dealt work handed out again after its worker timed out or released it.",
+        ("table",)
+    )
+    metrics.describe(
+        "dealer_lease_released_total", "counter",
+        "Leased groups handed back without a result.",
+    )
+    metrics.describe(
+        "dealer_save_seconds", "histogram",
+        "Time to persist the in-memory DB.",
+        ("target",)
+    )
+    metrics.describe(
+        "dealer_server_list_seconds", "histogram",
+        "Time to re-score, render and compress the server list.",
+    )
+    metrics.describe(
+        "dealer_monitor_interval_seconds", "histogram",
+        "Interval given to service groups when they complete.",
+        buckets=INTERVAL_BUCKETS
+    )
+    metrics.describe(
+        "dealer_budget_throttled_total", "counter",
+        "Work requests turned away by the probe budget.",
+    )
+    metrics.describe(
+        "dealer_held_released_total", "counter",
+        "Held groups released when their alias resolved.",
+    )
+    metrics.describe(
+        "dealer_queue_depth", "gauge",
+        "Groups in each work queue.",
+        ("table", "af", "status")
+    )
+    metrics.describe(
+        "dealer_overdue_seconds", "gauge",
+        "How long the oldest AVAILABLE group has been due.",
+        ("table", "af")
+    )
+    metrics.describe(
+        "dealer_heap_stale_total", "counter",
+        "Stale ready-heap entries skipped by allocate.",
+    )
+    metrics.describe(
+        "dealer_leases", "gauge",
+        "Leases not yet completed.",
+    )
+    metrics.describe(
+        "dealer_load_failed_total", "counter",
+        "Startup SQLite imports that raised before every table loaded.",
+    )
+    metrics.describe(
+        "dealer_load_seconds", "gauge",
+        "Time taken to load each part of the DB at startup.",
+        ("part",)
+    )
+
+    # Shared DNS cache and timings workers send with /complete.
+    describe_dns_metrics(metrics)
+    return describe_probe_metrics(metrics)
+
+def work_queue_collector(mem_db):
+    def collect(metrics):
+        now = time.time()
+        stale = 0
+        for table_type, by_af in mem_db.work.items():
+            for af, wq in by_af.items():
+                labels = (table_name(table_type), af_name(af))
+                for status_type, queue in wq.queues.items():
+                    depth_labels = labels + (TXTS.get(status_type, str(status_type)),)
+                    metrics.set("dealer_queue_depth", len(queue), depth_labels)
+
+                # Heap top is the AVAILABLE group that was due first.
+                entry = wq.peek_due(STATUS_AVAILABLE)
+                overdue = max(0, now - entry[0]) if entry is not None else 0
+                metrics.set("dealer_overdue_seconds", overdue, labels)
+                stale += wq.stale
+
+        metrics.set("dealer_heap_stale_total", stale)
+        metrics.set("dealer_leases", len(mem_db.leases))
+        for part, elapsed in mem_db.load_stats.items():
+            metrics.set("dealer_load_seconds", elapsed, (table_name(part),))
+
+    return collect
+
+def dealer_metrics(mem_db):
+    metrics = describe_dealer_metrics(Metrics())
+    metrics.add_collector(work_queue_collector(mem_db))
+    metrics.add_collector(dns_cache_collector(lambda: mem_db.dns_cache, "dealer"))
+    return metrics
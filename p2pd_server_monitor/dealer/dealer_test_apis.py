@@ -3,13 +3,17 @@ from fastapi import Depends
 from ..defs import *
 from .dealer_utils import *
 
+# Slotted rows aren't serializable so return plain copies.
 @app.get("/list_groups")
 async def api_list_groups():
-    return mem_db.groups
+    return {k: v.to_model() for k, v in mem_db.groups.items()}
 
 @app.get("/list_records")
 async def api_list_groups():
-    return mem_db.records
+    return {
+        table_type: {k: v.dict() for k, v in records.items()}
+        for table_type, records in mem_db.records.items()
+    }
     
 @app.get("/concurrency_test", dependencies=[Depends(localhost_only)])
 async def api_concurrency_test():
@@ -37,7 +41,8 @@ async def api_aliases_len():
 
 @app.get("/list_aliases")
 async def api_list_aliases():
-    return mem_db.records[ALIASES_TABLE_TYPE]
+    aliases = mem_db.records[ALIASES_TABLE_TYPE]
+    return {k: v.dict() for k, v in aliases.items()}
 
 @app.get("/sql_export", dependencies=[Depends(localhost_only)])
 async def api_sql_export():
@@ -48,15 +53,22 @@ async def api_sql_export():
 
 @app.get("/sql_import", dependencies=[Depends(localhost_only)])
 async def api_sql_import():
-    global server_cache
     await sqlite_import(mem_db)
-    server_cache = build_server_list()
+    mem_db.server_list.rebuild()
+    await start_journal(mem_db)
     return "done"
 
 @app.get("/delete_all", dependencies=[Depends(localhost_only)])
 async def api_delete_all():
     global mem_db
-    mem_db = MemDB()
+    if mem_db.journal is not None:
+        mem_db.journal.close()
+
+    mem_db = make_mem_db()
+    if rpc_server is not None:
+        rpc_server.mem_db = mem_db
+
+    await start_journal(mem_db)
     async with aiosqlite.connect(DB_NAME) as sqlite_db:
         await delete_all_data(sqlite_db)
         await sqlite_db.commit()
@@ -65,10 +77,10 @@ async def api_delete_all():
 
 @app.get("/insert_init", dependencies=[Depends(localhost_only)])
 async def api_insert_init():
-    global server_cache
     mem_db.setup_db()
     insert_main(mem_db)
-    server_cache = build_server_list(mem_db)
+    mem_db.server_list.rebuild()
+    await start_journal(mem_db)
     async with aiosqlite.connect(DB_NAME) as sqlite_db:
         try:
             await sqlite_db.execute("BEGIN")
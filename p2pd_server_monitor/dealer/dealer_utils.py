@@ -1,5 +1,6 @@
 import math
 import time
+import heapq
 import json
 from fastapi.responses import JSONResponse
 from fastapi import Request, HTTPException
@@ -7,9 +8,15 @@ from p2pd import *
 from ..defs import *
 from ..txt_strs import *
 from ..db.db_init import *
+from .scoring import *
+from .scheduling import *
 
 
 def localhost_only(request: Request):
+    # Requests over a Unix socket have no client address.
+    if request.client is None or not request.client.host:
+        return
+
     client_host = request.client.host
     if client_host not in ("127.0.0.1", "::1"):
         raise HTTPException(status_code=403, detail="Access forbidden")
@@ -23,40 +30,6 @@ class PrettyJSONResponse(JSONResponse):
             indent=2,        # pretty-print here
         ).encode("utf-8")
 
-def compute_service_score(status, max_uptime_override=None):
-    if not isinstance(status, dict) or status is None:
-        return 0.0
-
-    # Extract values, default to 0 if missing or None
-    failed_tests = status.get("failed_tests") or 0
-    test_no = status.get("test_no") or 0
-    uptime = status.get("uptime") or 0
-    if max_uptime_override is not None:
-        max_uptime = max_uptime_override
-    else:
-        if "max_uptime" in status and status["max_uptime"] is not None:
-            max_uptime = status["max_uptime"]
-        else:
-            max_uptime = 0
-
-    # Prevent negative numbers
-    failed_tests = max(failed_tests, 0)
-    test_no = max(test_no, 0)
-    uptime = max(uptime, 0)
-    max_uptime = max(max_uptime, 0)
-
-    # Compute uptime ratio safely
-    uptime_ratio = (uptime / max_uptime) if max_uptime > 0 else 0.0
-    uptime_ratio = min(max(uptime_ratio, 0.0), 1.0)
-
-    # Compute test factor safely
-    test_factor = 1.0 - failed_tests / (test_no + 1e-9)
-    smoothing_factor = 1.0 - math.exp(-test_no / 50.0)
-    quality_score = test_factor * (0.5 * uptime_ratio + 0.5) * smoothing_factor
-
-    # Clamp final score to [0,1]
-    return min(max(quality_score, 0.0), 1.0)
-
 def get_fqn_list(mem_db, ip):
     if ip is None:
         return []
@@ -69,7 +42,56 @@ def get_fqn_list(mem_db, ip):
 
     return list(fqns)[::-1]
 
-def build_server_list(mem_db):
+def build_group_entry(mem_db, meta_group, status_scores=None, scorer=None, score_avg=None):
+    # status_scores: {status_id: score} already worked out in bulk.
+    # score_avg: the group's average score if that was too.
+    scorer = scorer or UptimeScorer()
+    scores = []
+    fields = ("test_no", "failed_tests", "uptime", "max_uptime", "last_success")
+    group = list_x_to_dict(meta_group.group)
+    for record in group:
+        try:
+            status_obj = mem_db.statuses.get(record.get("status_id"))
+            if not status_obj:
+                continue
+            status = getattr(status_obj, "dict", lambda: {})()
+
+
+            for k in fields:
+                record[k] = status.get(k, 0)
+
+            # Measured latency in ms if workers have reported one.
+            record["rtt"] = status.get("rtt_ewma") or None
+
+            if status_scores and status_obj.id in status_scores:
+                record["score"] = status_scores[status_obj.id]
+            else:
+                record["score"] = scorer.score(status)
+
+            record["fqns"] = get_fqn_list(mem_db, record.get("ip"))
+            scores.append(record["score"])
+        except Exception:
+            # Skip invalid record but continue processing others
+            continue
+
+    # Compute average score if any
+    if scores:
+        if score_avg is None:
+            score_avg = sum(scores) / len(scores)
+
+        for record in group:
+            record["score"] = score_avg
+
+    return group
+
+def group_bucket_key(group):
+    # Where a group sits in the server list.
+    service_type = TXTS.get(group[0].get("type"), "unknown")
+    af = TXTS["af"].get(group[0].get("af"), "unknown")
+    proto = TXTS["proto"].get(group[0].get("proto"), "unknown")
+    return service_type, af, proto
+
+def build_server_list(mem_db, scorer=None):
     # Init server list
     s = {}
     for service_type in SERVICE_TYPES:
@@ -79,44 +101,25 @@ def build_server_list(mem_db):
             for proto in (UDP, TCP):
                 by_proto = by_af[TXTS["proto"][proto]] = []
 
+    # Score every status and group in one pass if numpy is around.
+    status_scores, group_scores = score_groups(mem_db, mem_db.groups, scorer)
+
     for group_id in mem_db.groups:
         try:
             meta_group = mem_db.groups[group_id]
             if meta_group.table_type != SERVICES_TABLE_TYPE:
                 continue
 
-            scores = []
-            fields = ("test_no", "failed_tests", "uptime", "max_uptime", "last_success")
-            group = list_x_to_dict(meta_group.group)
-            for record in group:
-                try:
-                    status_obj = mem_db.statuses.get(record.get("status_id"))
-                    if not status_obj:
-                        continue
-                    status = getattr(status_obj, "dict", lambda: {})()
-
-
-                    for k in fields:
-                        record[k] = status.get(k, 0)
-
-                    record["score"] = compute_service_score(status)
-                    record["fqns"] = get_fqn_list(mem_db, record.get("ip"))
-                    scores.append(record["score"])
-                except Exception:
-                    # Skip invalid record but continue processing others
-                    continue
-
-            # Compute average score if any
-            if scores:
-                score_avg = sum(scores) / len(scores)
-                for record in group:
-                    record["score"] = score_avg
-
             # Place group in server list
+            group = build_group_entry(
+                mem_db,
+                meta_group,
+                status_scores,
+                scorer,
+                group_scores.get(group_id)
+            )
             if group:
-                service_type = TXTS.get(group[0].get("type"), "unknown")
-                af = TXTS["af"].get(group[0].get("af"), "unknown")
-                proto = TXTS["proto"].get(group[0].get("proto"), "unknown")
+                service_type, af, proto = group_bucket_key(group)
                 s.setdefault(service_type, {}).setdefault(af, {}).setdefault(proto, []).append(group)
 
         except Exception:
@@ -136,7 +139,24 @@ def build_server_list(mem_db):
     s["timestamp"] = int(time.time())
     return s
 
-def mark_complete(mem_db, is_success: int, status_id: int, t=None):
+def update_status_ewma(status, is_success, t, rtt=None):
+    # Time decayed success rate -- older results count for less.
+    sample = 1.0 if is_success else 0.0
+    if not status.test_no or not status.last_status:
+        status.success_ewma = sample
+    else:
+        elapsed = max(0, t - status.last_status)
+        alpha = 1.0 - 0.5 ** (elapsed / SUCCESS_HALF_LIFE)
+        status.success_ewma += alpha * (sample - status.success_ewma)
+
+    # Latency only comes from successful tests.
+    if is_success and rtt is not None and rtt > 0:
+        if not status.rtt_ewma:
+            status.rtt_ewma = float(rtt)
+        else:
+            status.rtt_ewma += RTT_EWMA_ALPHA * (rtt - status.rtt_ewma)
+
+def mark_complete(mem_db, is_success: int, status_id: int, t=None, rtt=None):
     t = t or int(time.time())
     status_type = STATUS_AVAILABLE
     if status_id not in mem_db.statuses:
@@ -157,8 +177,17 @@ def mark_complete(mem_db, is_success: int, status_id: int, t=None):
     af = record.af
     group_id = record.group_id
 
-    # Try to move work to available -- throw exception if not exist.
-    mem_db.work[table_type][af].move_work(group_id, status_type)
+    # Throw exception if the work doesn't exist.
+    wq = mem_db.work[table_type][af]
+    if group_id not in wq.index:
+        raise KeyError(f"move_work: Work ID {group_id} doesnt exist.")
+
+    # Did the result flip since the last test?
+    was_success = status.test_no and status.last_success == status.last_status
+    changed = status.test_no and bool(is_success) != bool(was_success)
+
+    # Before test_no and last_status change.
+    update_status_ewma(status, is_success, t, rtt)
 
     # Update stats for success.
     if is_success:
@@ -182,48 +211,188 @@ def mark_complete(mem_db, is_success: int, status_id: int, t=None):
     status.status = status_type
     status.test_no += 1
     status.last_status = t
-
-def allocate_work(mem_db, need_afs, table_types, cur_time, mon_freq):
-    # Get oldest work by table type and client AF preference.
-    for table_choice in table_types:
+    mem_db.mark_dirty(STATUS_TABLE_TYPE, status_id)
+
+    # Services are due again on their own interval.
+    delay = None
+    if table_type == SERVICES_TABLE_TYPE and status_type == STATUS_AVAILABLE:
+        delay = group_interval(mem_db, mem_db.groups[group_id], changed)
+        if mem_db.metrics is not None:
+            mem_db.metrics.observe("dealer_monitor_interval_seconds", delay)
+
+    wq.move_work(group_id, status_type, delay)
+
+    # Score changed so the group may move in the server list.
+    if mem_db.server_list is not None:
+        if table_type == SERVICES_TABLE_TYPE:
+            mem_db.server_list.touch_group(group_id)
+
+def push_candidate(candidates, table_no, lane, wq, cur_time, mon_freq):
+    due = wq.next_due(mon_freq)
+    if due is None:
+        return
+
+    # Never been allocated work is always safe to hand out.
+    due_time, status_type, group_id = due
+    if status_type == STATUS_INIT:
+        due_time = min(due_time, cur_time)
+
+    # Don't hand out work before its due time.
+    if due_time > cur_time:
+        return
+
+    heapq.heappush(
+        candidates,
+        (lane, due_time, table_no, status_type, group_id, wq)
+    )
+
+def deal_work(mem_db, need_afs, table_types, cur_time, mon_freq, max_groups=1, delay=None):
+    """
+    Each work queue knows the earliest time any of its work becomes
+    eligible. So rather than walking the queues in a fixed order the
+    due candidates from every queue the client wants are put in a heap.
+    Lower WORK_LANES go first so aliases resolve before the imports
+    that need their IPs. Within a lane the most overdue groups are
+    handed out and ties keep the table order.
+    """
+    candidates = []
+    scanned = 0
+    for table_no, table_choice in enumerate(table_types):
+        lane = WORK_LANES.get(table_choice, len(WORK_LANES))
         for need_af in need_afs:
-            """
-            The most recent items are always added at the end. Items at the start
-            are oldest. If the oldest items are still too recent to pass time
-            checks then we know that later items in the queue are also too recent.
-            """
             wq = mem_db.work[table_choice][need_af]
-            for status_type in (STATUS_INIT, STATUS_AVAILABLE, STATUS_DEALT,):
-                for group_id, meta_group in wq.queues[status_type]:
-                    group = meta_group.group
-
-                    # Never been allocated so safe to hand out.
-                    if status_type == STATUS_INIT:
-                        wq.move_work(group_id, STATUS_DEALT)
-                        return list_x_to_dict(group)
-
-                    # Work is moved back to available but don't do it too soon.
-                    # Statuses are bulk updated for entries in a group.
-                    work_timestamp = wq.timestamps[group_id]
-                    elapsed = max(0, cur_time - work_timestamp)
-
-                    # In time order with oldest first.
-                    # So if this isn't old enough then none are.
-                    if status_type != STATUS_DEALT:
-                        if elapsed < mon_freq:
-                            break
-
-                    # Check for worker timeout.sd
-                    # TODO: this line is making work get reallocated.
-                    if status_type == STATUS_DEALT:
-                        if elapsed < WORKER_TIMEOUT:
-                            break
-                            
-                    # Otherwise: allocate it as work.
-                    wq.move_work(group_id, STATUS_DEALT)
-                    return list_x_to_dict(group)
-                
-    return []
+            push_candidate(candidates, table_no, lane, wq, cur_time, mon_freq)
+            scanned += 1
+
+    metrics = mem_db.metrics
+    meta_groups = []
+    while candidates and len(meta_groups) < max_groups:
+        # Allocate it as work.
+        lane, _, table_no, status_type, group_id, wq = heapq.heappop(candidates)
+        meta_group = mem_db.groups[group_id]
+        meta_groups.append(meta_group)
+        wq.move_work(group_id, STATUS_DEALT, delay)
+
+        # DEALT -> DEALT means the last worker never reported back.
+        if metrics is not None and status_type == STATUS_DEALT:
+            labels = (TXTS.get(meta_group.table_type),)
+            metrics.inc("dealer_work_reallocated_total", labels)
+
+        # The queue may have more work that's due.
+        push_candidate(candidates, table_no, lane, wq, cur_time, mon_freq)
+        scanned += 1
+
+    if metrics is not None:
+        metrics.observe("dealer_allocate_scanned", scanned)
+
+    return meta_groups
+
+def take_budget(mem_db, max_groups):
+    # Groups the probe budget allows now (all of them without one.)
+    if mem_db.probe_budget is None:
+        return max_groups
+
+    allowed = mem_db.probe_budget.take(max_groups)
+    if not allowed and mem_db.metrics is not None:
+        mem_db.metrics.inc("dealer_budget_throttled_total")
+
+    return allowed
+
+def return_budget(mem_db, n):
+    if mem_db.probe_budget is not None and n:
+        mem_db.probe_budget.give_back(n)
+
+def allocate_work(mem_db, need_afs, table_types, cur_time, mon_freq):
+    if not take_budget(mem_db, 1):
+        return []
+
+    meta_groups = deal_work(
+        mem_db,
+        need_afs,
+        table_types,
+        cur_time,
+        mon_freq
+    )
+
+    if not meta_groups:
+        return_budget(mem_db, 1)
+        return []
+
+    return list_x_to_dict(meta_groups[0].group)
+
+def allocate_work_lease(mem_db, need_afs, table_types, cur_time, mon_freq, max_groups, max_seconds=None):
+    # Leases can't be held longer than the worker timeout.
+    lease_time = min(max_seconds or WORKER_TIMEOUT, WORKER_TIMEOUT)
+    lease_time = max(lease_time, 1)
+
+    # Alias work is a DNS lookup so resolvers can take more of it.
+    most_groups = MAX_LEASE_GROUPS
+    if tuple(table_types) == (ALIASES_TABLE_TYPE,):
+        most_groups = MAX_ALIAS_LEASE_GROUPS
+
+    max_groups = min(max(max_groups, 1), most_groups)
+
+    # Out of budget -- say when to ask again.
+    max_groups = take_budget(mem_db, max_groups)
+    if not max_groups:
+        return {
+            "lease_id": None,
+            "lease_time": lease_time,
+            "groups": [],
+            "retry_after": mem_db.probe_budget.wait_time(),
+        }
+
+    meta_groups = deal_work(
+        mem_db,
+        need_afs,
+        table_types,
+        cur_time,
+        mon_freq,
+        max_groups=max_groups,
+        delay=lease_time
+    )
+
+    return_budget(mem_db, max_groups - len(meta_groups))
+
+    # Record which groups went out under the lease.
+    lease_id = None
+    if meta_groups:
+        lease = mem_db.add_lease(meta_groups, lease_time)
+        lease_id = lease.id
+
+    return {
+        "lease_id": lease_id,
+        "lease_time": lease_time,
+        "groups": [list_x_to_dict(m.group) for m in meta_groups]
+    }
+
+def release_lease(mem_db, lease_id, status_ids):
+    """
+    Work in a lease that wasn't reported as done goes back to
+    the front of its queue so other workers can pick it up.
+    """
+    lease = mem_db.leases.pop(lease_id, None)
+    if lease is None:
+        return 0
+
+    done = set(status_ids)
+    released = 0
+    for meta_group, entry in zip(lease.groups, lease.entries):
+        if done.intersection(m.status_id for m in meta_group.group):
+            continue
+
+        # Skip work that has moved on since the lease (e.g. timed out.)
+        wq = mem_db.work[meta_group.table_type][meta_group.af]
+        if wq.entries.get(meta_group.id) is not entry:
+            continue
+
+        wq.move_work(meta_group.id, STATUS_DEALT, delay=0)
+        released += 1
+
+    if mem_db.metrics is not None and released:
+        mem_db.metrics.inc("dealer_lease_released_total", n=released)
+
+    return released
 
 def update_table_ip(mem_db, table_type: int, ip: str, alias_id: int, current_time: int):
     for record in mem_db.records_by_aliases[alias_id]:
@@ -237,12 +406,14 @@ def update_table_ip(mem_db, table_type: int, ip: str, alias_id: int, current_tim
             ensure_ip_is_public(record.ip)
         except:
             record.ip = ip
+            mem_db.mark_dirty(table_type, record.id)
             continue
 
         # 2) If import and its never been checked set new IP.
         if table_type == IMPORTS_TABLE_TYPE:
             if not status.test_no:
                 record.ip = ip
+                mem_db.mark_dirty(table_type, record.id)
                 continue
 
         # 3) Otherwise only update if there's a period of downtime.
@@ -258,4 +429,64 @@ def update_table_ip(mem_db, table_type: int, ip: str, alias_id: int, current_tim
 
         # Only set ip if there's a period of downtime.
         if cond_one or cond_two:
-            record.ip = ip
\ No newline at end of file
+            record.ip = ip
+            mem_db.mark_dirty(table_type, record.id)
+
+def set_alias_ip(mem_db, alias_id: int, ip: str, current_time: int):
+    if alias_id not in mem_db.records[ALIASES_TABLE_TYPE]:
+        raise Exception("Alias id not found.")
+
+    alias = mem_db.records[ALIASES_TABLE_TYPE][alias_id]
+
+    # Update alias by IP mappings.
+    old_ip = alias.ip
+    mem_db.del_alias_by_ip(alias)
+    alias.ip = ip
+    mem_db.add_alias_by_ip(alias)
+    mem_db.mark_dirty(ALIASES_TABLE_TYPE, alias_id)
+
+    for table_type in (IMPORTS_TABLE_TYPE, SERVICES_TABLE_TYPE):
+        update_table_ip(mem_db, table_type, ip, alias_id, current_time)
+
+    # Work that was waiting on this IP can be dealt now.
+    released = mem_db.release_held(alias_id)
+    if mem_db.metrics is not None and released:
+        mem_db.metrics.inc("dealer_held_released_total", n=len(released))
+
+    # Listed IPs and FQNs may have changed.
+    if mem_db.server_list is not None:
+        mem_db.server_list.touch_alias(alias_id)
+        mem_db.server_list.touch_ip(old_ip)
+        mem_db.server_list.touch_ip(ip)
+
+def pick_alias_ip(alias, ips):
+    # Keep the current IP while it's still an answer so servers don't hop.
+    public = []
+    for ip in ips:
+        try:
+            public.append(ensure_ip_is_public(ip))
+        except:
+            continue
+
+    if alias.ip in public:
+        return alias.ip
+
+    return public[0] if public else None
+
+def cache_alias_answer(mem_db, alias_id: int, ips, ttl):
+    # Resolver answers go in the shared DNS cache (not failed lookups.)
+    alias = mem_db.records[ALIASES_TABLE_TYPE].get(alias_id)
+    if mem_db.dns_cache is not None and alias is not None and ttl is not None:
+        mem_db.dns_cache.put(alias.fqn, alias.af, ips, ttl)
+
+def update_alias_ips(mem_db, alias_id: int, ips, current_time: int):
+    # Set an alias from all of its answers. Returns the IP used or None.
+    alias = mem_db.records[ALIASES_TABLE_TYPE].get(alias_id)
+    if alias is None:
+        raise KeyError("No alias called id " + str(alias_id))
+
+    ip = pick_alias_ip(alias, ips)
+    if ip is not None and ip != alias.ip:
+        set_alias_ip(mem_db, alias_id, ip, current_time)
+
+    return ip
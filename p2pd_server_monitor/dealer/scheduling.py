@@ -0,0 +1,68 @@
+"""
+How often each service group is checked and how fast work is dealt.
+
+A group's next check is monitor_interval() seconds after its last one
+instead of MONITOR_FREQUENCY for everything. New services (fewer than
+NEW_SERVICE_TEST_NO tests) and ones whose last result flipped are
+checked every MIN_MONITOR_INTERVAL. After that the interval grows with
+the number of tests (full confidence at STABLE_TEST_NO) and with how
+one-sided the time decayed success rate is -- a server that's always up
+(or always down) drifts out to MAX_MONITOR_INTERVAL while one that keeps
+flapping stays near the minimum. A group is checked as often as its
+least stable member.
+
+ProbeBudget is a token bucket for groups dealt per second across every
+worker (MONITOR_PROBE_BUDGET). When it's empty /work returns no groups
+and a retry_after so workers come back soon instead of idling.
+"""
+
+import time
+from ..defs import *
+
+def monitor_interval(status, changed=False):
+    # Seconds until this service is due again.
+    if changed or status.test_no < NEW_SERVICE_TEST_NO:
+        return MIN_MONITOR_INTERVAL
+
+    confidence = min(1.0, status.test_no / STABLE_TEST_NO)
+    success = min(max(status.success_ewma, 0.0), 1.0)
+    stability = abs(2.0 * success - 1.0)
+    span = MAX_MONITOR_INTERVAL - MIN_MONITOR_INTERVAL
+    return int(MIN_MONITOR_INTERVAL + span * confidence * stability)
+
+def group_interval(mem_db, meta_group, changed=False):
+    intervals = [MAX_MONITOR_INTERVAL]
+    for record in meta_group.group:
+        status = mem_db.statuses.get(record.status_id)
+        if status is not None:
+            intervals.append(monitor_interval(status, changed))
+
+    return min(intervals)
+
+class ProbeBudget:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1.0, self.rate * PROBE_BUDGET_BURST)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n):
+        # How many of n groups can be dealt now.
+        self.refill()
+        allowed = max(0, min(n, int(self.tokens)))
+        self.tokens -= allowed
+        return allowed
+
+    def give_back(self, n):
+        # Taken but not dealt (not enough due work.)
+        self.tokens = min(self.burst, self.tokens + n)
+
+    def wait_time(self):
+        # Seconds until one more group can be dealt.
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
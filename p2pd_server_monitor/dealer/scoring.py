@@ -0,0 +1,266 @@
+"""
+Batch version of compute_service_score using NumPy.
+
+compute_service_scores takes columns of test_no, failed_tests, uptime and
+max_uptime and returns every score in one pass. The results are bit for
+bit the same as the scalar function: the arithmetic is done in the same
+order on float64s and exp() is only taken with math.exp on the distinct
+test_no values (there are few of them) so libm rounding can't differ.
+
+score_groups also averages each group's scores in the same pass.
+group_score_averages adds each member in turn, the same order sum()
+does in build_group_entry, so the averages match too.
+
+Without numpy score_statuses returns nothing and callers fall back to
+the scalar function.
+
+How a status is scored is up to a Scorer. UptimeScorer is the original
+uptime / failed tests formula. LatencyScorer ranks by a time decayed
+success rate and the worker measured RTT so a server that was up for a
+month but is failing now (or is slow) drops quickly. The dealer picks one
+with MONITOR_SCORER.
+"""
+
+import math
+from ..defs import *
+from ..db.mem_db_defs import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def compute_service_score(status, max_uptime_override=None):
+    if not isinstance(status, dict) or status is None:
+        return 0.0
+
+    # Extract values, default to 0 if missing or None
+    failed_tests = status.get("failed_tests") or 0
+    test_no = status.get("test_no") or 0
+    uptime = status.get("uptime") or 0
+    if max_uptime_override is not None:
+        max_uptime = max_uptime_override
+    else:
+        if "max_uptime" in status and status["max_uptime"] is not None:
+            max_uptime = status["max_uptime"]
+        else:
+            max_uptime = 0
+
+    # Prevent negative numbers
+    failed_tests = max(failed_tests, 0)
+    test_no = max(test_no, 0)
+    uptime = max(uptime, 0)
+    max_uptime = max(max_uptime, 0)
+
+    # Compute uptime ratio safely
+    uptime_ratio = (uptime / max_uptime) if max_uptime > 0 else 0.0
+    uptime_ratio = min(max(uptime_ratio, 0.0), 1.0)
+
+    # Compute test factor safely
+    test_factor = 1.0 - failed_tests / (test_no + 1e-9)
+    smoothing_factor = 1.0 - math.exp(-test_no / 50.0)
+    quality_score = test_factor * (0.5 * uptime_ratio + 0.5) * smoothing_factor
+
+    # Clamp final score to [0,1]
+    return min(max(quality_score, 0.0), 1.0)
+
+def compute_service_scores(test_no, failed_tests, uptime, max_uptime):
+    # Negative values count as 0.
+    test_no = np.maximum(np.asarray(test_no, dtype=np.int64), 0)
+    failed_tests = np.maximum(np.asarray(failed_tests, dtype=np.int64), 0)
+    uptime = np.maximum(np.asarray(uptime, dtype=np.int64), 0)
+    max_uptime = np.maximum(np.asarray(max_uptime, dtype=np.int64), 0)
+
+    # Uptime ratio is 0 where max_uptime is 0.
+    has_max = max_uptime > 0
+    uptime_ratio = np.zeros(len(test_no), dtype=np.float64)
+    np.divide(
+        uptime.astype(np.float64),
+        max_uptime.astype(np.float64),
+        out=uptime_ratio,
+        where=has_max
+    )
+    uptime_ratio = np.minimum(np.maximum(uptime_ratio, 0.0), 1.0)
+
+    # Same exp() as the scalar function.
+    smoothing = smoothing_factors(test_no)
+
+    test_factor = 1.0 - failed_tests.astype(np.float64) / (test_no.astype(np.float64) + 1e-9)
+    quality_score = test_factor * (0.5 * uptime_ratio + 0.5) * smoothing
+    return np.minimum(np.maximum(quality_score, 0.0), 1.0)
+
+def smoothing_factors(test_no):
+    values, inverse = np.unique(test_no, return_inverse=True)
+    return np.array(
+        [1.0 - math.exp(-t / 50.0) for t in values.tolist()],
+        dtype=np.float64
+    )[inverse.reshape(-1)]
+
+def latency_factor(rtt):
+    # 1 at 0 ms, 0.5 at RTT_REFERENCE_MS. Unknown (0) counts as 0.5.
+    if rtt <= 0:
+        return 0.5
+
+    return 1.0 / (1.0 + rtt / RTT_REFERENCE_MS)
+
+class Scorer:
+    """
+    score() takes a status dict. scores() takes the columns named in
+    columns as arrays and returns every score -- used when numpy is
+    around.
+    """
+    name = None
+    columns = ()
+
+    def score(self, status):
+        raise NotImplementedError
+
+    def scores(self, *cols):
+        raise NotImplementedError
+
+class UptimeScorer(Scorer):
+    name = "uptime"
+    columns = ("test_no", "failed_tests", "uptime", "max_uptime")
+
+    def score(self, status):
+        return compute_service_score(status)
+
+    def scores(self, *cols):
+        return compute_service_scores(*cols)
+
+class LatencyScorer(Scorer):
+    """
+    success_ewma * (0.5 + 0.5 * latency factor), times the same
+    smoothing as UptimeScorer so a server needs a few tests first.
+    """
+    name = "latency"
+    columns = ("test_no", "success_ewma", "rtt_ewma")
+
+    def score(self, status):
+        if not isinstance(status, dict):
+            return 0.0
+
+        test_no = max(status.get("test_no") or 0, 0)
+        success = min(max(status.get("success_ewma") or 0.0, 0.0), 1.0)
+        smoothing = 1.0 - math.exp(-test_no / 50.0)
+        latency = latency_factor(status.get("rtt_ewma") or 0.0)
+        score = success * (0.5 + 0.5 * latency) * smoothing
+        return min(max(score, 0.0), 1.0)
+
+    def scores(self, test_no, success_ewma, rtt_ewma):
+        test_no = np.maximum(np.asarray(test_no, dtype=np.int64), 0)
+        success = np.clip(np.asarray(success_ewma, dtype=np.float64), 0.0, 1.0)
+        rtt = np.asarray(rtt_ewma, dtype=np.float64)
+        latency = np.where(
+            rtt > 0,
+            1.0 / (1.0 + np.maximum(rtt, 0.0) / RTT_REFERENCE_MS),
+            0.5
+        )
+
+        score = success * (0.5 + 0.5 * latency) * smoothing_factors(test_no)
+        return np.clip(score, 0.0, 1.0)
+
+SCORERS = {cls.name: cls for cls in (UptimeScorer, LatencyScorer)}
+
+def get_scorer(name=None):
+    name = name or DEFAULT_SCORER
+    if name not in SCORERS:
+        raise ValueError("unknown scorer %s" % (name,))
+
+    return SCORERS[name]()
+
+def status_score_array(mem_db, status_ids, scorer):
+    # Scores in status_ids order. Every id must be in mem_db.statuses.
+    store = mem_db.status_store
+    if store is not None:
+        ids = np.asarray(status_ids, dtype=np.int64)
+        cols = [store.column(name)[ids] for name in scorer.columns]
+    else:
+        statuses = [mem_db.statuses[s] for s in status_ids]
+        cols = [
+            np.fromiter(
+                (getattr(status, name) or 0 for status in statuses),
+                np.float64 if name in Status.float_fields else np.int64,
+                len(statuses)
+            )
+            for name in scorer.columns
+        ]
+
+    return scorer.scores(*cols)
+
+def score_statuses(mem_db, status_ids, scorer=None):
+    """
+    {status_id: score} for many statuses at once. Reads the columns from
+    the status store if there is one. Empty if numpy isn't available.
+    """
+    if np is None:
+        return {}
+
+    status_ids = [s for s in status_ids if s in mem_db.statuses]
+    if not status_ids:
+        return {}
+
+    scores = status_score_array(mem_db, status_ids, scorer or UptimeScorer())
+    return dict(zip(status_ids, scores.tolist()))
+
+def group_score_averages(scores, group_index, group_no):
+    """
+    Mean score per group. group_index[i] is the group (0 .. group_no - 1)
+    of scores[i]. Members are added in order so averages match sum().
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    group_index = np.asarray(group_index, dtype=np.int64)
+    counts = np.bincount(group_index, minlength=group_no)
+
+    # Position of each score within its group.
+    order = np.argsort(group_index, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = np.empty(len(scores), dtype=np.int64)
+    position[order] = np.arange(len(scores)) - np.repeat(starts, counts)
+
+    # One vector add per member position.
+    totals = np.zeros(group_no, dtype=np.float64)
+    for n in range(int(counts.max()) if len(counts) else 0):
+        at = position == n
+        totals[group_index[at]] += scores[at]
+
+    averages = np.zeros(group_no, dtype=np.float64)
+    np.divide(totals, counts, out=averages, where=counts > 0)
+    return averages
+
+def score_groups(mem_db, group_ids, scorer=None):
+    """
+    ({status_id: score}, {group_id: average score}) for many service
+    groups in one pass. Groups with no statuses are left out. Both are
+    empty if numpy isn't available.
+    """
+    if np is None:
+        return {}, {}
+
+    status_ids = []
+    group_index = []
+    scored_groups = []
+    for group_id in group_ids:
+        meta_group = mem_db.groups.get(group_id)
+        if meta_group is None or meta_group.table_type != SERVICES_TABLE_TYPE:
+            continue
+
+        members = [
+            record.status_id
+            for record in meta_group.group
+            if record.status_id in mem_db.statuses
+        ]
+        if members:
+            status_ids.extend(members)
+            group_index.extend([len(scored_groups)] * len(members))
+            scored_groups.append(group_id)
+
+    if not status_ids:
+        return {}, {}
+
+    scores = status_score_array(mem_db, status_ids, scorer or UptimeScorer())
+    averages = group_score_averages(scores, group_index, len(scored_groups))
+    return (
+        dict(zip(status_ids, scores.tolist())),
+        dict(zip(scored_groups, averages.tolist()))
+    )
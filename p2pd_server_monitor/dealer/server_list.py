@@ -0,0 +1,400 @@
+"""
+The /servers list is kept live instead of being rebuilt from every group
+once a minute. Each service * af * proto bucket holds its groups in score
+order. Changes to a group (completed work, new services, alias updates)
+only mark it as pending. Pending groups are re-scored and moved within
+their bucket the next time the list is read, and only buckets that
+changed get their JSON re-rendered.
+
+Queries for part of the list (/servers/query) walk the sorted buckets
+directly. Results are paged with a cursor of the last (score, group_id)
+sort key returned so a page costs O(log n + limit) per bucket.
+
+Reads of /servers get a snapshot of the list: the compact JSON body plus
+gzip and brotli variants and a strong ETag. A snapshot is only rebuilt if
+the list changed and the last one is older than the refresh interval.
+"""
+
+import json
+import time
+import gzip
+import heapq
+import bisect
+import hashlib
+import itertools
+from p2pd import *
+from ..defs import *
+from ..txt_strs import *
+from .dealer_utils import *
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_SEPARATORS = (",", ":")
+
+class ServerListSnapshot:
+    def __init__(self, text):
+        self.text = text
+        self.built_at = time.time()
+        self.body = text.encode("utf-8")
+        digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self.etag = '"%s"' % (digest,)
+
+        # Pre-compressed once so requests only pick a variant.
+        self.encodings = {"gzip": gzip.compress(self.body, mtime=0)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(self.body)
+
+        # Each encoding is different bytes so gets its own strong ETag.
+        self.etags = {None: self.etag}
+        for name in self.encodings:
+            self.etags[name] = '"%s-%s"' % (digest, name)
+
+    def matches(self, if_none_match):
+        # Weak comparison is fine for If-None-Match.
+        if not if_none_match:
+            return False
+
+        for etag in if_none_match.split(","):
+            etag = etag.strip()
+            if etag == "*":
+                return True
+            if etag.startswith("W/"):
+                etag = etag[2:]
+            if etag in self.etags.values():
+                return True
+
+        return False
+
+    def pick_encoding(self, accept_encoding):
+        # Returns (encoding or None, body).
+        accepted = {}
+        for part in (accept_encoding or "").split(","):
+            fields = part.strip().split(";")
+            name = fields[0].strip().lower()
+            q = 1.0
+            for param in fields[1:]:
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+
+            if name:
+                accepted[name] = q
+
+        for name in ("br", "gzip"):
+            q = accepted.get(name, accepted.get("*", 0.0))
+            if name in self.encodings and q > 0:
+                return name, self.encodings[name]
+
+        return None, self.body
+
+def encode_cursor(sort_key):
+    neg_score, group_id = sort_key
+    return "%s:%d" % (repr(-neg_score), group_id)
+
+def decode_cursor(cursor):
+    score, _, group_id = cursor.rpartition(":")
+    return (-float(score), int(group_id))
+
+def list_name(value, names):
+    """
+    Map an enum value (e.g. 2 for IPv4) or a display name
+    (e.g. "IPv4") to the name used in the server list.
+    """
+    if value is None:
+        return None
+
+    for enum, name in names.items():
+        if value in (name, str(int(enum))):
+            return name
+
+    raise ValueError("unknown server list key %s" % (value,))
+
+def project_group(group, fields):
+    return [{k: record.get(k) for k in fields} for record in group]
+
+class ServerBucket:
+    def __init__(self):
+        self.order = [] # [(-score, group_id) ...]
+        self.entries = {} # group_id: (sort_key, group)
+        self.text = None
+
+    def put(self, group_id, group):
+        self.remove(group_id)
+        sort_key = (-group[0].get("score", 0), group_id)
+        bisect.insort(self.order, sort_key)
+        self.entries[group_id] = (sort_key, group)
+        self.text = None
+
+    def remove(self, group_id):
+        if group_id not in self.entries:
+            return
+
+        sort_key, _ = self.entries.pop(group_id)
+        del self.order[bisect.bisect_left(self.order, sort_key)]
+        self.text = None
+
+    def groups(self):
+        # Highest score first.
+        return [self.entries[group_id][1] for _, group_id in self.order]
+
+    def iter_after(self, cursor=None):
+        # (sort_key, bucket) after the cursor in score order.
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(self.order, cursor)
+
+        for sort_key in itertools.islice(self.order, start, None):
+            yield sort_key, self
+
+    def render(self):
+        if self.text is None:
+            self.text = json.dumps(
+                self.groups(),
+                separators=JSON_SEPARATORS,
+                default=str
+            )
+
+        return self.text
+
+class ServerList:
+    def __init__(self, mem_db, scorer=None):
+        self.mem_db = mem_db
+        self.scorer = scorer or UptimeScorer()
+        self.clear()
+
+    def clear(self):
+        self.layout = {} # service: af: proto: bucket
+        for service_type in SERVICE_TYPES:
+            for af in VALID_AFS:
+                for proto in (UDP, TCP):
+                    self.bucket((
+                        TXTS[service_type],
+                        TXTS["af"][af],
+                        TXTS["proto"][proto]
+                    ))
+
+        self.bucket_by_group = {} # group_id: bucket
+        self.ips_by_group = {} # group_id: {ip ...}
+        self.groups_by_ip = {} # ip: {group_id ...}
+        self.pending = set()
+        self.text = None
+        self.timestamp = 0
+        self.snapshot_cache = None
+
+    def bucket(self, key):
+        service_type, af, proto = key
+        by_af = self.layout.setdefault(service_type, {})
+        by_proto = by_af.setdefault(af, {})
+        if proto not in by_proto:
+            by_proto[proto] = ServerBucket()
+
+        return by_proto[proto]
+
+    def rebuild(self):
+        self.clear()
+        for group_id, meta_group in self.mem_db.groups.items():
+            if meta_group.table_type == SERVICES_TABLE_TYPE:
+                self.pending.add(group_id)
+
+    def touch_group(self, group_id):
+        # O(1) -- the group is re-scored when the list is next read.
+        self.pending.add(group_id)
+
+    def touch_ip(self, ip):
+        # FQNs listed for a group depend on aliases for its IPs.
+        self.pending.update(self.groups_by_ip.get(ip, ()))
+
+    def touch_alias(self, alias_id):
+        for record in self.mem_db.records_by_aliases.get(alias_id, []):
+            if record.table_type == SERVICES_TABLE_TYPE:
+                self.pending.add(record.group_id)
+
+    def index_ips(self, group_id, ips):
+        for ip in self.ips_by_group.pop(group_id, ()):
+            group_ids = self.groups_by_ip[ip]
+            group_ids.discard(group_id)
+            if not group_ids:
+                del self.groups_by_ip[ip]
+
+        if ips:
+            self.ips_by_group[group_id] = ips
+            for ip in ips:
+                self.groups_by_ip.setdefault(ip, set()).add(group_id)
+
+    def remove_group(self, group_id):
+        bucket = self.bucket_by_group.pop(group_id, None)
+        if bucket is not None:
+            bucket.remove(group_id)
+            self.text = None
+
+        self.index_ips(group_id, None)
+
+    def update_group(self, group_id, status_scores=None, score_avg=None):
+        meta_group = self.mem_db.groups.get(group_id)
+        if meta_group is None:
+            self.remove_group(group_id)
+            return
+
+        if meta_group.table_type != SERVICES_TABLE_TYPE:
+            return
+
+        group = build_group_entry(
+            self.mem_db,
+            meta_group,
+            status_scores,
+            self.scorer,
+            score_avg
+        )
+        if not group:
+            self.remove_group(group_id)
+            return
+
+        # Groups only move bucket if their records were changed.
+        bucket = self.bucket(group_bucket_key(group))
+        old_bucket = self.bucket_by_group.get(group_id)
+        if old_bucket is not None and old_bucket is not bucket:
+            old_bucket.remove(group_id)
+
+        bucket.put(group_id, group)
+        self.bucket_by_group[group_id] = bucket
+        self.index_ips(group_id, {r.get("ip") for r in group if r.get("ip")})
+        self.text = None
+
+    def apply(self):
+        # Re-score groups that changed since the last read.
+        pending, self.pending = self.pending, set()
+
+        # Big batches (e.g. after a rebuild) are scored and averaged
+        # in one pass.
+        status_scores, group_scores = None, {}
+        if len(pending) >= SCORE_BATCH_MIN:
+            status_scores, group_scores = score_groups(
+                self.mem_db,
+                pending,
+                self.scorer
+            )
+
+        for group_id in pending:
+            try:
+                self.update_group(
+                    group_id,
+                    status_scores,
+                    group_scores.get(group_id)
+                )
+            except Exception:
+                log_exception()
+
+    def as_dict(self):
+        self.apply()
+        s = {}
+        for service_type, by_af in self.layout.items():
+            s[service_type] = {}
+            for af, by_proto in by_af.items():
+                s[service_type][af] = {}
+                for proto, bucket in by_proto.items():
+                    s[service_type][af][proto] = bucket.groups()
+
+        s["timestamp"] = self.timestamp
+        return s
+
+    def buckets(self, service_type=None, af=None, proto=None):
+        # Buckets matching a filter -- None matches anything.
+        for service_name, by_af in self.layout.items():
+            if service_type not in (None, service_name):
+                continue
+            for af_name, by_proto in by_af.items():
+                if af not in (None, af_name):
+                    continue
+                for proto_name, bucket in by_proto.items():
+                    if proto in (None, proto_name):
+                        yield bucket
+
+    def query(self, service_type=None, af=None, proto=None, min_score=None, limit=SERVER_QUERY_LIMIT, cursor=None, fields=None):
+        """
+        Top groups from the matching buckets in score order.
+        Returns (groups, next_cursor) where next_cursor is None if
+        there are no more results.
+        """
+        self.apply()
+        buckets = list(self.buckets(service_type, af, proto))
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+
+        # Merge the already sorted buckets lazily.
+        merged = heapq.merge(
+            *[bucket.iter_after(cursor) for bucket in buckets],
+            key=lambda x: x[0]
+        )
+
+        groups = []
+        last_key = None
+        for sort_key, bucket in merged:
+            # Everything after is lower.
+            if min_score is not None and -sort_key[0] < min_score:
+                return groups, None
+
+            if len(groups) >= limit:
+                return groups, encode_cursor(last_key)
+
+            group = bucket.entries[sort_key[1]][1]
+            if fields:
+                group = project_group(group, fields)
+
+            groups.append(group)
+            last_key = sort_key
+
+        return groups, None
+
+    def render_node(self, node):
+        if isinstance(node, ServerBucket):
+            return node.render()
+
+        if not isinstance(node, dict):
+            return json.dumps(node)
+
+        items = [
+            json.dumps(k) + ":" + self.render_node(v)
+            for k, v in node.items()
+        ]
+
+        return "{" + ",".join(items) + "}"
+
+    def render(self):
+        """
+        Same document build_server_list + json.dumps made but
+        stitched together from the cached text of each bucket.
+        """
+        self.apply()
+        if self.text is None:
+            self.timestamp = int(time.time())
+            node = dict(self.layout)
+            node["timestamp"] = self.timestamp
+            self.text = self.render_node(node)
+
+        return self.text
+
+    def snapshot(self, max_age=SERVER_LIST_REFRESH):
+        # Reuse the last snapshot while it's fresh enough.
+        cached = self.snapshot_cache
+        now = time.time()
+        if cached is not None and now - cached.built_at < max_age:
+            return cached
+
+        # Only encode and compress again if the list changed.
+        start = time.perf_counter()
+        text = self.render()
+        if cached is None or cached.text is not text:
+            cached = ServerListSnapshot(text)
+            if self.mem_db.metrics is not None:
+                elapsed = time.perf_counter() - start
+                self.mem_db.metrics.observe("dealer_server_list_seconds", elapsed)
+
+        cached.built_at = now
+        self.snapshot_cache = cached
+        return cached
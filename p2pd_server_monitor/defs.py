@@ -9,6 +9,34 @@ MONITOR_FREQUENCY = 60 * 60
 MONITOR_FREQUENCY = 60 * 60 # Just temp for testing.
 MAX_SERVER_DOWNTIME = 600
 IMPORT_TEST_NO = 3 # Try to import items 3 times then stop.
+MAX_LEASE_GROUPS = 100 # Most groups handed out in one /work lease.
+WORK_BATCH_SIZE = 10 # Groups a worker asks for per lease.
+WORKER_TASK_NO = 100 # Probes a worker process runs at once.
+WORK_FETCH_INTERVAL = 0.5 # Min seconds between leases from one worker.
+WORKER_SHUTDOWN_TIMEOUT = 30 # Seconds to finish in-flight probes on exit.
+DEALER_ENDPOINT = "http://127.0.0.1:8000"
+DEALER_TIMEOUT = 10 # Seconds per request to the dealer.
+DEALER_MAX_CONNECTIONS = 20 # Keep-alive connections per worker.
+DEALER_BACKOFF_BASE = 0.5 # Seconds -- doubled per retry with jitter.
+DEALER_BACKOFF_MAX = 10
+UDP_MUX_SOCKETS = 4 # UDP sockets per af shared by every probe of a kind.
+UDP_MUX_TIMEOUT = 4 # Seconds before a muxed request gives up.
+UDP_MUX_RETRANSMIT = 0.5 # Seconds between resends of a muxed request.
+STUN_IMPORT_DEADLINE = 10 # Seconds to classify one STUN import.
+MONITOR_CLOSE_TIMEOUT = 5 # Seconds a probe gets to tear down.
+TURN_START_TIMEOUT = 10 # Seconds a TURN client gets to allocate a relay.
+TELEMETRY_BATCH_MAX = 100 # Probe timings a worker sends per /complete.
+ALIAS_BATCH_SIZE = 500 # Aliases a resolver worker leases at once.
+MAX_ALIAS_LEASE_GROUPS = 1000 # Most aliases handed out in one /work lease.
+ALIAS_RESOLVE_CONCURRENCY = 100 # DNS lookups in flight per resolver.
+ALIAS_RESOLVE_TIMEOUT = 2 # Seconds per DNS lookup.
+ALIAS_IDLE_SLEEP = 60 # Seconds a resolver waits when there's no alias work.
+DNS_DEFAULT_TTL = 300 # Seconds to cache answers that came without a TTL.
+DNS_MIN_TTL = 30
+DNS_MAX_TTL = 24 * 60 * 60
+DNS_NEGATIVE_TTL = 15 * 60 # Most seconds a missing name is cached.
+DNS_CACHE_SIZE = 100000 # Names kept per DNS cache.
+DNS_SHARED_BATCH_MAX = 1000 # Names asked or told per /dns call.
 
 ####################################################################################
 SERVICE_SCHEMA = ("type", "af", "proto", "ip", "port", "group_id")
@@ -23,11 +51,22 @@ PNP_TYPE = 8
 SERVICE_TYPES  = (STUN_MAP_TYPE, STUN_CHANGE_TYPE, MQTT_TYPE,)
 SERVICE_TYPES += (TURN_TYPE, NTP_TYPE)
 
+# Max in-flight probes per service type (None for anything else.)
+PROBE_CONCURRENCY = {
+    STUN_MAP_TYPE: 100,
+    STUN_CHANGE_TYPE: 25,
+    MQTT_TYPE: 25,
+    TURN_TYPE: 25,
+    NTP_TYPE: 50,
+    None: 25,
+}
+
 STATUS_AVAILABLE = 9
 STATUS_DEALT = 11
 STATUS_INIT = 12
 STATUS_DISABLED = 13
 STATUS_TYPES = (STATUS_INIT, STATUS_AVAILABLE, STATUS_DEALT, STATUS_DISABLED,)
+STATUS_HELD = 19 # Work queue only -- waiting on its alias to resolve.
 SERVICES_TABLE_TYPE = 14
 ALIASES_TABLE_TYPE = 15
 IMPORTS_TABLE_TYPE = 16
@@ -35,9 +74,44 @@ GROUPS_TABLE_TYPE = 17
 STATUS_TABLE_TYPE = 18
 NO_WORK = -1
 INVALID_SERVER_RESPONSE = -2
+WORK_THROTTLED = -3
 TABLE_TYPES = (SERVICES_TABLE_TYPE, ALIASES_TABLE_TYPE, IMPORTS_TABLE_TYPE,)
+PERSISTED_TABLE_TYPES = TABLE_TYPES + (STATUS_TABLE_TYPE,)
+
+# Due work is dealt from the lowest lane first. Aliases give imports
+# their IPs and imports become services.
+WORK_LANES = {
+    ALIASES_TABLE_TYPE: 0,
+    IMPORTS_TABLE_TYPE: 1,
+    SERVICES_TABLE_TYPE: 2,
+}
+DB_FLUSH_INTERVAL = 10 # Seconds between writing changed rows to SQLite.
+SNAPSHOT_PATH = DB_NAME + ".snapshot"
+JOURNAL_PATH = DB_NAME + ".journal"
+JOURNAL_FLUSH_INTERVAL = 1 # Most seconds of changes lost in a crash.
+JOURNAL_MAX_BYTES = 64 * 1024 * 1024 # Snapshot again past this.
+JOURNAL_FSYNC = True
+STATUS_STORE_CAPACITY = 1024 # Initial rows -- doubles as needed.
+SERVER_LIST_REFRESH = 5 # Most seconds a /servers response can be stale.
+SERVER_QUERY_LIMIT = 50 # Default groups per /servers/query page.
+MAX_SERVER_QUERY_LIMIT = 500
+SCORE_BATCH_MIN = 64 # Pending groups before scoring is vectorized.
+SUCCESS_HALF_LIFE = 24 * 60 * 60 # Seconds for a result to count half as much.
+RTT_EWMA_ALPHA = 0.2 # Weight of each new latency sample.
+RTT_REFERENCE_MS = 100 # Latency that halves the latency factor.
+DEFAULT_SCORER = "uptime"
+IMPORT_BATCH_SIZE = 10000 # Rows per fetchmany when loading SQLite.
+MIN_MONITOR_INTERVAL = 10 * 60 # Seconds between checks of new or flapping services.
+MAX_MONITOR_INTERVAL = 6 * 60 * 60 # Seconds between checks of long stable services.
+NEW_SERVICE_TEST_NO = 3 # Tests before a service's interval can grow.
+STABLE_TEST_NO = 48 # Tests before a service's history is fully trusted.
+PROBE_BUDGET_BURST = 2 # Seconds of probe budget that can be dealt at once.
 
 class DuplicateRecordError(KeyError):
     """Raised when a duplicate key is inserted."""
     pass
 
+class DealerLoadingError(Exception):
+    """Raised when a call needs tables that are still being loaded."""
+    pass
+
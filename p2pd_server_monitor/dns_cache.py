@@ -0,0 +1,102 @@
+"""
+TTL-aware DNS answer cache.
+
+Answers are kept until their TTL runs out (clamped to DNS_MIN_TTL ..
+DNS_MAX_TTL). A name that doesn't exist or has no records for the af
+is cached as an empty answer for at most DNS_NEGATIVE_TTL so dead names
+aren't looked up every cycle. The cache holds at most `capacity` names
+and drops the least recently used one past that.
+
+Every worker has a cache for its own lookups. The dealer has one that
+all workers share -- resolvers ask it (/dns) before going to DNS and
+their answers go back to it with /dns or the bulk /alias results.
+Hits, misses and evictions are counted in stats for /metrics.
+"""
+
+import time
+from collections import OrderedDict
+from .defs import *
+
+def clamp_ttl(ttl, is_negative=False):
+    most = DNS_NEGATIVE_TTL if is_negative else DNS_MAX_TTL
+    return min(max(int(ttl), DNS_MIN_TTL), most)
+
+class DNSCache:
+    def __init__(self, capacity=DNS_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict() # (fqn, af): (expiry, ips)
+        self.stats = {
+            "hit": 0,
+            "negative_hit": 0,
+            "miss": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    def get(self, fqn, af, now=None):
+        # (ips, seconds left) or None. [] ips is a cached NXDOMAIN.
+        key = (fqn, af)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["miss"] += 1
+            return None
+
+        now = time.monotonic() if now is None else now
+        if entry[0] <= now:
+            del self.entries[key]
+            self.stats["expired"] += 1
+            self.stats["miss"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats["hit" if entry[1] else "negative_hit"] += 1
+        return entry[1], entry[0] - now
+
+    def has(self, fqn, af, now=None):
+        # Fresh entry or not, without counting a lookup.
+        entry = self.entries.get((fqn, af))
+        now = time.monotonic() if now is None else now
+        return entry is not None and entry[0] > now
+
+    def put(self, fqn, af, ips, ttl, now=None):
+        now = time.monotonic() if now is None else now
+        key = (fqn, af)
+        ttl = clamp_ttl(ttl, not ips)
+        self.entries[key] = (now + ttl, list(ips))
+        self.entries.move_to_end(key)
+
+        # Least recently used names go first.
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+def describe_dns_metrics(metrics):
+    metrics.describe(
+        "dns_cache_total", "counter",
+        "DNS cache lookups by result and entries dropped.",
+        ("cache", "result")
+    )
+    metrics.describe(
+        "dns_cache_entries", "gauge",
+        "Names in the DNS cache.",
+        ("cache",)
+    )
+
+    return metrics
+
+def dns_cache_collector(get_cache, name):
+    # get_cache is called on each scrape -- the cache may be set later.
+    def collect(metrics):
+        cache = get_cache()
+        if cache is None:
+            return
+
+        for result, value in cache.stats.items():
+            metrics.set("dns_cache_total", value, (name, result))
+
+        metrics.set("dns_cache_entries", len(cache), (name,))
+
+    return collect
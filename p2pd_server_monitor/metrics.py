@@ -0,0 +1,193 @@
+"""
+Counters, gauges and histograms in the Prometheus text format.
+
+Updates are O(1) -- a dict lookup and an add (histograms also bisect a
+short, fixed list of buckets) -- so they can sit on the /work and
+/complete hot paths. Anything that's expensive to keep up to date as it
+changes (queue depths, overdue lag) is a collector instead: a function
+called when /metrics is read that sets gauges from the current state.
+
+    metrics = Metrics()
+    metrics.inc("dealer_work_reallocated_total", (SERVICES_TABLE_TYPE,))
+    metrics.observe("dealer_call_seconds", 0.0002, ("work",))
+    text = metrics.render()
+
+Labels are a tuple of values in the order of the label names the metric
+was described with.
+"""
+
+import time
+import bisect
+import asyncio
+import functools
+
+# Seconds -- from a fast /work call up to a slow SQLite flush.
+TIME_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # [(le, count) ...] including +Inf.
+        total = 0
+        out = []
+        for le, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            out.append((le, total))
+
+        return out
+
+class Metric:
+    def __init__(self, name, kind, help_text, label_names=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.values = {} # labels: number or Histogram
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    text = ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+
+    return "{" + text + "}"
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def describe(self, name, kind, help_text, label_names=(), buckets=None):
+        if kind == "histogram" and buckets is None:
+            buckets = TIME_BUCKETS
+
+        metric = Metric(name, kind, help_text, label_names, buckets)
+        self.metrics[name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        # Called with this object before every render().
+        self.collectors.append(collector)
+
+    def inc(self, name, labels=(), n=1):
+        values = self.metrics[name].values
+        values[labels] = values.get(labels, 0) + n
+
+    def set(self, name, value, labels=()):
+        self.metrics[name].values[labels] = value
+
+    def observe(self, name, value, labels=()):
+        metric = self.metrics[name]
+        histogram = metric.values.get(labels)
+        if histogram is None:
+            histogram = metric.values[labels] = Histogram(metric.buckets)
+
+        histogram.observe(value)
+
+    def get(self, name, labels=()):
+        return self.metrics[name].values.get(labels)
+
+    def render(self):
+        for collector in self.collectors:
+            collector(self)
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.help_text))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for labels, value in sorted(metric.values.items(), key=str):
+                if metric.kind != "histogram":
+                    lines.append("%s%s %s" % (
+                        metric.name,
+                        format_labels(metric.label_names, labels),
+                        format_value(value)
+                    ))
+                    continue
+
+                for le, count in value.cumulative():
+                    lines.append("%s_bucket%s %d" % (
+                        metric.name,
+                        format_labels(metric.label_names, labels, (("le", le),)),
+                        count
+                    ))
+
+                label_text = format_labels(metric.label_names, labels)
+                lines.append("%s_sum%s %s" % (metric.name, label_text, format_value(value.sum)))
+                lines.append("%s_count%s %d" % (metric.name, label_text, value.count))
+
+        return "\n".join(lines) + "\n"
+
+async def serve_metrics(metrics, host, port):
+    """
+    Minimal HTTP server for processes without FastAPI (workers.)
+    Every GET gets the metrics. Returns the asyncio server.
+    """
+    async def handle(reader, writer):
+        try:
+            # Request line and headers -- the path isn't checked.
+            while (await reader.readline()).strip():
+                pass
+
+            body = metrics.render().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % (len(body),)
+            )
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+def timed(metric_name, labels=()):
+    """
+    Decorator for calls that take mem_db first. Their duration goes in
+    mem_db.metrics if the dealer set one.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(mem_db, *args, **kwargs):
+            if mem_db.metrics is None:
+                return f(mem_db, *args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return f(mem_db, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                mem_db.metrics.observe(metric_name, elapsed, labels)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,234 @@
+"""
+Binary RPC between the dealer and workers on the same host.
+
+It's the same calls as the /work, /complete, /insert, /alias and /dns HTTP
+endpoints but over a Unix socket without pydantic, HTTP parsing or the
+localhost checks. Each message is a frame:
+
+    [4 byte big-endian length][1 byte codec][body]
+
+The body is msgpack if it's installed (codec b"m") and JSON otherwise
+(codec b"j"). Requests are [call_id, method, params] and replies are
+[call_id, ok, result or error string]. The server replies with the codec
+the request used. Replies carry the call_id so one connection can have
+many calls in flight at once.
+"""
+
+import os
+import json
+import random
+import struct
+import asyncio
+import itertools
+from p2pd import *
+from .defs import *
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+RPC_HEADER = struct.Struct(">IB")
+RPC_MSGPACK = ord("m")
+RPC_JSON = ord("j")
+RPC_MAX_FRAME = 16 * 1024 * 1024
+
+class RPCError(Exception):
+    pass
+
+def rpc_encode(obj, codec=None):
+    if codec is None:
+        codec = RPC_MSGPACK if msgpack is not None else RPC_JSON
+
+    if codec == RPC_MSGPACK:
+        body = msgpack.packb(obj, use_bin_type=True)
+    else:
+        body = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    return RPC_HEADER.pack(len(body), codec) + body
+
+def rpc_decode(codec, body):
+    if codec == RPC_MSGPACK:
+        if msgpack is None:
+            raise RPCError("msgpack frame but msgpack isn't installed")
+
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+
+    if codec == RPC_JSON:
+        return json.loads(body)
+
+    raise RPCError("unknown codec %d" % (codec,))
+
+async def rpc_read(reader):
+    # Returns (codec, message) or None on EOF.
+    try:
+        header = await reader.readexactly(RPC_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    size, codec = RPC_HEADER.unpack(header)
+    if size > RPC_MAX_FRAME:
+        raise RPCError("frame too large %d" % (size,))
+
+    body = await reader.readexactly(size)
+    return codec, rpc_decode(codec, body)
+
+class RPCServer:
+    """
+    Calls are run straight on the event loop one after another so
+    handlers see the same mem_db state the HTTP endpoints do.
+    """
+    def __init__(self, calls, mem_db):
+        self.calls = calls
+        self.mem_db = mem_db
+        self.server = None
+        self.path = None
+
+    def dispatch(self, method, params):
+        if not isinstance(method, str) or method not in self.calls:
+            raise RPCError("unknown method %s" % (method,))
+
+        if params is not None and not isinstance(params, dict):
+            raise RPCError("params must be a map")
+
+        return self.calls[method](self.mem_db, **(params or {}))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                frame = await rpc_read(reader)
+                if frame is None:
+                    break
+
+                codec, request = frame
+                if not isinstance(request, list) or len(request) != 3:
+                    # No call_id to answer to so the client times out.
+                    reply = [None, 0, "RPCError: malformed request"]
+                else:
+                    call_id, method, params = request
+                    try:
+                        reply = [call_id, 1, self.dispatch(method, params)]
+                    except Exception as e:
+                        log_exception()
+                        reply = [call_id, 0, "%s: %s" % (type(e).__name__, e)]
+
+                writer.write(rpc_encode(reply, codec))
+                await writer.drain()
+        except (ConnectionError, RPCError, ValueError):
+            log_exception()
+        finally:
+            writer.close()
+
+    async def start(self, path):
+        # Remove a socket left behind by a previous run.
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.path = path
+        self.server = await asyncio.start_unix_server(self.handle, path=path)
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class RPCClient:
+    """
+    Worker side. Has a route and a post() like DealerClient so it
+    can be used in its place.
+    """
+    def __init__(self, route, path, timeout=DEALER_TIMEOUT):
+        self.route = route
+        self.path = path
+        self.timeout = timeout
+        self.backoff_base = DEALER_BACKOFF_BASE
+        self.backoff_max = DEALER_BACKOFF_MAX
+        self.call_ids = itertools.count(1)
+        self.pending = {} # call_id: future
+        self.writer = None
+        self.read_task = None
+        self.connecting = asyncio.Lock()
+
+    async def connect(self):
+        async with self.connecting:
+            if self.writer is not None:
+                return
+
+            reader, self.writer = await asyncio.open_unix_connection(self.path)
+            self.read_task = asyncio.create_task(self.read_loop(reader))
+
+    async def read_loop(self, reader):
+        error = ConnectionError("dealer closed the connection")
+        try:
+            while True:
+                frame = await rpc_read(reader)
+                if frame is None:
+                    break
+
+                _, (call_id, ok, result) = frame
+                future = self.pending.pop(call_id, None)
+                if future is None or future.done():
+                    continue
+
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RPCError(result))
+        except Exception as e:
+            error = e
+        finally:
+            # Fail everything waiting so callers can retry.
+            self.writer = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def call(self, method, params=None):
+        if self.writer is None:
+            await self.connect()
+
+        call_id = next(self.call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            self.writer.write(rpc_encode([call_id, method, params]))
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def post(self, path, params, retries=3):
+        # Same contract as DealerClient.post -- None if it never worked.
+        method = path.strip("/")
+        attempt = 0
+        while retries is None or retries > 0:
+            # Decrement sentinel.
+            if retries is not None:
+                retries -= 1
+
+            try:
+                return await self.call(method, params)
+            except (OSError, RPCError, asyncio.TimeoutError):
+                log_exception()
+
+            # No point waiting after the last try.
+            if retries == 0:
+                break
+
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
@@ -21,6 +21,7 @@ TXTS = {
     STATUS_DEALT: "Dealt",
     STATUS_INIT: "Init",
     STATUS_DISABLED: "Disabled",
+    STATUS_HELD: "Held",
     SERVICES_TABLE_TYPE: "services",
     ALIASES_TABLE_TYPE: "aliases",
     IMPORTS_TABLE_TYPE: "imports",  
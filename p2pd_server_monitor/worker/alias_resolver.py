@@ -0,0 +1,205 @@
+"""
+Resolves alias work in bulk.
+
+A regular worker resolves one alias per dealt group and talks to the
+dealer for each. In resolver mode (MONITOR_WORKER_MODE=alias) a worker
+leases up to ALIAS_BATCH_SIZE aliases at once, looks them all up
+concurrently (at most ALIAS_RESOLVE_CONCURRENCY in flight) and posts
+every result back in a single /alias call that also completes the lease.
+
+Every A / AAAA answer is sent -- the dealer keeps the alias on its
+current IP if that's still one of them. dnspython is used if installed
+so answers come with their TTL. Otherwise getaddrinfo is used and
+answers are kept for DNS_DEFAULT_TTL.
+
+Answers (and names that don't exist) are cached in the worker and in
+the dealer's shared DNS cache (see dns_cache.) Names the worker doesn't
+have are asked of the dealer in one /dns call before going to DNS.
+"""
+
+import time
+import socket
+import asyncio
+from p2pd import *
+from ..defs import *
+from ..dns_cache import *
+from .worker_utils import *
+from .worker_metrics import *
+
+try:
+    import dns.asyncresolver
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# getaddrinfo errors that mean there's no such name (or no records.)
+NO_NAME_ERRORS = {
+    getattr(socket, name)
+    for name in ("EAI_NONAME", "EAI_NODATA")
+    if hasattr(socket, name)
+}
+
+async def lookup_getaddrinfo(fqn, af):
+    # Returns (ips, ttl) -- getaddrinfo doesn't say what the TTL was.
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(fqn, None, family=af, type=socket.SOCK_DGRAM)
+    except socket.gaierror as e:
+        if e.errno in NO_NAME_ERRORS:
+            return [], DNS_NEGATIVE_TTL
+
+        raise
+
+    ips = []
+    for info in infos:
+        ip = info[4][0]
+        if ip not in ips:
+            ips.append(ip)
+
+    return ips, DNS_DEFAULT_TTL
+
+async def lookup_dnspython(fqn, af):
+    rdtype = "A" if af == socket.AF_INET else "AAAA"
+    try:
+        answer = await dns.asyncresolver.resolve(fqn, rdtype)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return [], DNS_NEGATIVE_TTL
+
+    return [r.address for r in answer], answer.rrset.ttl
+
+def default_lookup():
+    return lookup_getaddrinfo if dns is None else lookup_dnspython
+
+class AliasResolver:
+    def __init__(self, lookup=None, concurrency=ALIAS_RESOLVE_CONCURRENCY, timeout=ALIAS_RESOLVE_TIMEOUT, cache=None):
+        self.lookup = lookup or default_lookup()
+        self.cache = cache or DNSCache()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+
+    async def resolve_answer(self, fqn, af, timings=None):
+        # (ips, ttl, looked_up) -- ttl is None if the lookup failed.
+        entry = self.cache.get(fqn, af)
+        if entry is not None:
+            return entry[0], int(entry[1]), False
+
+        async with self.semaphore:
+            try:
+                ips, ttl = await asyncio.wait_for(self.lookup(fqn, af), self.timeout)
+            except Exception:
+                return [], None, True
+
+        if timings is not None:
+            timings.mark("dns")
+
+        # Missing names are cached too -- failures are asked again.
+        self.cache.put(fqn, af, ips, ttl)
+        return ips, ttl, True
+
+    async def resolve(self, fqn, af, timings=None):
+        # Every IP for fqn or [] if it didn't resolve.
+        return (await self.resolve_answer(fqn, af, timings))[0]
+
+    async def resolve_alias(self, alias):
+        timings = ProbeTimings()
+        answer = await self.resolve_answer(alias["fqn"], alias["af"], timings)
+        telemetry.probe_done([alias], timings, bool(answer[0]))
+        return answer
+
+    async def ask_shared(self, curl, aliases):
+        # Fill in names this worker doesn't have from the dealer's cache.
+        names = []
+        for alias in aliases:
+            name = {"fqn": alias["fqn"], "af": alias["af"]}
+            if not self.cache.has(name["fqn"], name["af"]) and name not in names:
+                names.append(name)
+
+        for i in range(0, len(names), DNS_SHARED_BATCH_MAX):
+            chunk = names[i:i + DNS_SHARED_BATCH_MAX]
+            answers = await retry_curl_on_locked(curl, {"names": chunk}, "/dns")
+            for name, answer in zip(chunk, answers or []):
+                if answer is not None:
+                    self.cache.put(name["fqn"], name["af"], answer["ips"], answer["ttl"])
+
+    async def resolve_many(self, aliases, curl=None):
+        # [(ips, ttl, looked_up) ...] in the same order as aliases.
+        # With a curl the dealer's shared cache is asked before DNS.
+        if curl is not None:
+            await async_wrap_errors(self.ask_shared(curl, aliases))
+
+        tasks = [self.resolve_alias(alias) for alias in aliases]
+        return await asyncio.gather(*tasks)
+
+async def share_answers(curl, answers):
+    # answers are [{fqn, af, ips, ttl} ...] for the dealer's cache.
+    for i in range(0, len(answers), DNS_SHARED_BATCH_MAX):
+        chunk = answers[i:i + DNS_SHARED_BATCH_MAX]
+        await retry_curl_on_locked(curl, {"answers": chunk}, "/dns")
+
+async def resolve_alias_batch(curl, resolver, max_groups=ALIAS_BATCH_SIZE):
+    # Returns how many aliases were resolved or a NO_WORK style code.
+    lease_id, groups = await fetch_work_lease(curl, ALIASES_TABLE_TYPE, max_groups)
+    if groups in (INVALID_SERVER_RESPONSE, WORK_THROTTLED):
+        return groups
+
+    if not len(groups):
+        return NO_WORK
+
+    # Alias groups are always one alias long.
+    aliases = [group[0] for group in groups]
+    results = await resolver.resolve_many(aliases, curl)
+
+    # Every result and the lease go back together.
+    t = int(time.time())
+    params = {
+        "aliases": [
+            {
+                "alias_id": alias["id"],
+                "status_id": alias["status_id"],
+                "ips": ips,
+                "ttl": ttl,
+                "t": t,
+            }
+            for alias, (ips, ttl, _) in zip(aliases, results)
+        ],
+        "lease_id": lease_id,
+    }
+
+    await retry_curl_on_locked(curl, params, "/alias")
+    return len(aliases)
+
+class AliasResolverPool:
+    # Same run() / stop() as WorkerPool so worker.main can use either.
+    def __init__(self, curl, resolver=None, batch_size=ALIAS_BATCH_SIZE, idle_sleep=ALIAS_IDLE_SLEEP):
+        self.curl = curl
+        self.resolver = resolver or shared_resolver
+        self.batch_size = batch_size
+        self.idle_sleep = idle_sleep
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def pause(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while not self.stopping.is_set():
+            n = await async_wrap_errors(
+                resolve_alias_batch(self.curl, self.resolver, self.batch_size)
+            )
+
+            # Keep going while there's a backlog.
+            if n == WORK_THROTTLED:
+                await self.pause(1)
+            elif n in (None, NO_WORK, INVALID_SERVER_RESPONSE):
+                await self.pause(self.idle_sleep)
+
+# One per worker process -- alias_monitor uses it too.
+shared_resolver = AliasResolver()
+telemetry.metrics.add_collector(
+    dns_cache_collector(lambda: shared_resolver.cache, "worker")
+)
@@ -0,0 +1,70 @@
+"""
+STUN requests over the worker's shared UDP sockets (see udp_mux.)
+
+Replies are matched to requests by their transaction ID (12 random
+bytes) so any number can be waiting on one socket. Replies are parsed
+with p2pd so the result looks like a STUNClient reply and
+validate_stun_reply works on it.
+
+Only UDP goes through the mux -- TCP probes still use STUNClient.
+"""
+
+from p2pd import *
+from ..defs import *
+from .udp_mux import *
+
+class StunMux(UDPMux):
+    def reply_key(self, data):
+        # Header: type (2), length (2), cookie (4), txn_id (12).
+        return bytes(data[8:20]) if len(data) >= 20 else None
+
+    async def request(self, af, dest, mode=RFC5389, attrs=(), reply_addr=None, timeout=None):
+        """
+        Send one STUN binding request and return the parsed reply.
+        Raises ErrorNoReply if nothing (valid) comes back in time.
+        """
+        msg = STUNMsg(mode=mode)
+        for attr_code, attr_data in attrs:
+            msg.write_attr(attr_code, attr_data)
+
+        data, addr, mux_socket = await self.send_request(
+            af,
+            dest,
+            msg.pack(),
+            bytes(msg.txn_id),
+            reply_addr,
+            timeout
+        )
+
+        reply, _ = stun_proto(data, af)
+        reply.pipe = mux_socket
+        reply.stup = addr[:2]
+        return reply
+
+    async def get_stun_reply(self, af, dest, mode=RFC5389):
+        return await self.request(af, dest, mode, reply_addr=dest)
+
+    async def get_change_port_reply(self, af, dest, ctup):
+        # Same IP, reply from the change port.
+        return await self.request(
+            af,
+            dest,
+            RFC3489,
+            [[STUNAttrs.ChangeRequest, b"\0\0\0\2"]],
+            (dest[0], ctup[1],)
+        )
+
+    async def get_change_tup_reply(self, af, dest, ctup):
+        # Reply from the change IP and port.
+        return await self.request(
+            af,
+            dest,
+            RFC3489,
+            [[STUNAttrs.ChangeRequest, b"\0\0\0\6"]],
+            ctup
+        )
+
+    async def get_wan_ip(self, af, dest, mode=RFC5389):
+        reply = await self.get_stun_reply(af, dest, mode)
+        if hasattr(reply, "rtup"):
+            return ip_norm(reply.rtup[0])
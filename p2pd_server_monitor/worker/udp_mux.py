@@ -0,0 +1,233 @@
+"""
+Many UDP requests over a few long-lived sockets.
+
+Opening a socket for every probe means hundreds of sockets being opened
+and closed a second with many probes in flight. A mux keeps
+UDP_MUX_SOCKETS sockets open per address family and sends every request
+through them round robin. Subclasses say how a reply is matched to its
+request (reply_key) -- STUN by transaction ID, NTP by the originate
+timestamp the server copies back. Requests are resent every
+UDP_MUX_RETRANSMIT seconds until a reply arrives or they time out.
+
+A request can say which address the reply must come from (for RFC3489
+change requests). Replies from anywhere else are ignored and the request
+keeps waiting.
+
+Each worker has one mux of each kind per nic (for_nic) closed when the
+worker exits. Without a nic sockets are bound to loopback.
+"""
+
+import os
+import time
+import socket
+import asyncio
+import itertools
+from p2pd import *
+from p2pd.ntp_client import NTPPacket, NTPStats, NTPException, system_to_ntp_time
+from ..defs import *
+
+def loopback_addr(af):
+    return ("127.0.0.1", 0) if af == IP4 else ("::1", 0)
+
+def same_addr(addr, want, af):
+    if int(addr[1]) != int(want[1]):
+        return False
+
+    try:
+        return socket.inet_pton(af, addr[0]) == socket.inet_pton(af, want[0])
+    except (OSError, ValueError):
+        return addr[0] == want[0]
+
+class MuxSocket(asyncio.DatagramProtocol):
+    def __init__(self, mux, af):
+        self.mux = mux
+        self.af = af
+        self.transport = None
+
+    @property
+    def sock(self):
+        # Same name as a p2pd pipe's socket.
+        return self.transport.get_extra_info("socket")
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.mux.on_reply(self, data, addr)
+
+    def error_received(self, exc):
+        # ICMP errors etc. The request just times out.
+        pass
+
+    def connection_lost(self, exc):
+        self.mux.on_lost(self)
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+
+class UDPMux:
+    shared = {} # (class name, id(nic)): mux
+
+    def __init__(self, nic=None, socket_no=UDP_MUX_SOCKETS, timeout=UDP_MUX_TIMEOUT, local_addr=None):
+        # local_addr (callable af -> addr) binds without a nic.
+        self.nic = nic
+        self.socket_no = socket_no
+        self.timeout = timeout
+        self.local_addr = local_addr
+        if nic is None and local_addr is None:
+            self.local_addr = loopback_addr
+
+        self.sockets = {} # af: [MuxSocket ...]
+        self.turns = {} # af: round robin counter
+        self.opening = {} # af: lock
+        self.pending = {} # key: [future, reply_addr]
+        self.stats = {"sent": 0, "replies": 0, "timeouts": 0, "ignored": 0}
+
+    @classmethod
+    def for_nic(cls, nic):
+        key = (cls.__name__, id(nic))
+        if key not in cls.shared:
+            cls.shared[key] = cls(nic)
+
+        return cls.shared[key]
+
+    @classmethod
+    async def close_all(cls, nic):
+        # Every kind of mux opened for this nic.
+        for key, mux in list(cls.shared.items()):
+            if key[1] == id(nic):
+                del cls.shared[key]
+                await mux.close()
+
+    def reply_key(self, data):
+        # Bytes that match a reply to its request or None.
+        raise NotImplementedError
+
+    async def open_socket(self, af):
+        loop = asyncio.get_running_loop()
+        protocol = MuxSocket(self, af)
+        if self.local_addr is not None:
+            await loop.create_datagram_endpoint(
+                lambda: protocol,
+                local_addr=self.local_addr(af),
+                family=af
+            )
+        else:
+            route = await self.nic.route(af).bind()
+            sock = await socket_factory(route, sock_type=UDP)
+            await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+
+        return protocol
+
+    async def get_socket(self, af):
+        if af not in self.opening:
+            self.opening[af] = asyncio.Lock()
+            self.turns[af] = itertools.count()
+
+        async with self.opening[af]:
+            sockets = self.sockets.setdefault(af, [])
+            while len(sockets) < self.socket_no:
+                sockets.append(await self.open_socket(af))
+
+        return sockets[next(self.turns[af]) % len(sockets)]
+
+    def on_reply(self, mux_socket, data, addr):
+        entry = self.pending.get(self.reply_key(data))
+        if entry is None:
+            self.stats["ignored"] += 1
+            return
+
+        # Change requests must be answered from the other address.
+        future, reply_addr = entry
+        if reply_addr is not None and not same_addr(addr, reply_addr, mux_socket.af):
+            self.stats["ignored"] += 1
+            return
+
+        if not future.done():
+            self.stats["replies"] += 1
+            future.set_result((data, addr, mux_socket))
+
+    def on_lost(self, mux_socket):
+        sockets = self.sockets.get(mux_socket.af, [])
+        if mux_socket in sockets:
+            sockets.remove(mux_socket)
+
+    async def send_request(self, af, dest, buf, key, reply_addr=None, timeout=None):
+        """
+        Send buf until a reply for key arrives.
+        Returns (data, addr, mux socket) or raises ErrorNoReply.
+        """
+        # Normalized so reply addresses compare equal.
+        dest = (ip_norm(dest[0]), int(dest[1]))
+        if reply_addr is not None:
+            reply_addr = (ip_norm(reply_addr[0]), int(reply_addr[1]))
+
+        mux_socket = await self.get_socket(af)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = [future, reply_addr]
+        try:
+            timeout = timeout or self.timeout
+            elapsed = 0
+            while True:
+                mux_socket.sendto(buf, dest)
+                self.stats["sent"] += 1
+                wait = min(UDP_MUX_RETRANSMIT, timeout - elapsed)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    elapsed += wait
+                    if elapsed >= timeout:
+                        self.stats["timeouts"] += 1
+                        raise ErrorNoReply("UDP mux got no reply.")
+        finally:
+            self.pending.pop(key, None)
+            if not future.done():
+                future.cancel()
+
+    def fd_count(self):
+        return sum(len(sockets) for sockets in self.sockets.values())
+
+    async def close(self):
+        for sockets in list(self.sockets.values()):
+            for mux_socket in list(sockets):
+                mux_socket.transport.close()
+
+        self.sockets = {}
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.cancel()
+
+        # Let transports finish closing.
+        await asyncio.sleep(0)
+
+class NTPMux(UDPMux):
+    """
+    NTP client requests over the shared sockets. The low 32 bits of the
+    transmit timestamp are random so requests sent in the same instant
+    can be told apart. Servers copy it to the reply's originate field.
+    """
+    def reply_key(self, data):
+        return bytes(data[24:32]) if len(data) >= 48 else None
+
+    async def request(self, af, dest, version=3, timeout=None):
+        packet = NTPPacket(
+            mode=3,
+            version=version,
+            tx_timestamp=system_to_ntp_time(time.time())
+        )
+
+        buf = bytearray(packet.to_data())
+        buf[44:48] = os.urandom(4)
+        data, _, _ = await self.send_request(
+            af,
+            dest,
+            bytes(buf),
+            bytes(buf[40:48]),
+            reply_addr=dest,
+            timeout=timeout
+        )
+
+        stats = NTPStats()
+        stats.from_data(data)
+        stats.dest_timestamp = system_to_ntp_time(time.time())
+        return stats
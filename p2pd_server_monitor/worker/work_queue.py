@@ -14,26 +14,117 @@ have Log(1) deletes, too. So moving items between queues is all Log(1).
 Would not work if the linked-list was indexed by positional offsets
 over memory addresses as you would have to update each offset for a
 delete. This is a very neat trick used by high performance schedulers.
+
+Work that is waiting on a deadline (AVAILABLE until its monitor interval
+passes, DEALT until the worker timeout passes) is also kept in a min-heap
+keyed on the time it next becomes eligible. Each piece of work can have
+its own delay. Stale heap entries are skipped
+lazily when they reach the top. The earliest eligible work for a queue is
+then just a peek at the INIT head and the two heap tops.
+
+HELD work is never dealt. It's waiting on an alias to resolve and is
+moved to the front of INIT when it does.
 """
 
 from typing import Hashable, Any
+import heapq
 import time
 from ..defs import *
 from ..db.linked_list import *
 
+# Default delay before work in a given status can be handed out again.
+STATUS_DELAYS = {
+    STATUS_AVAILABLE: MONITOR_FREQUENCY,
+    STATUS_DEALT: WORKER_TIMEOUT,
+}
+
 class WorkQueue:
     def __init__(self):
         self.queues = {
             STATUS_INIT: LinkedList(),
             STATUS_AVAILABLE: LinkedList(),
             STATUS_DEALT: LinkedList(),
-            STATUS_DISABLED: LinkedList()
+            STATUS_DISABLED: LinkedList(),
+            STATUS_HELD: LinkedList()
         }
 
         # work_id -> (queue_name, node reference)
         self.index = {} 
         self.timestamps = {}
 
+        # status -> [(due_time, seq, work_id) ...]
+        self.heaps = {status: [] for status in STATUS_DELAYS}
+        self.entries = {} # work_id -> live heap entry
+        self.seq = 0
+        self.stale = 0 # Stale heap entries skipped (for /metrics.)
+
+    def schedule(self, work_id: Hashable, queue_name: int, delay=None):
+        # Only some statuses wait on a timer.
+        self.entries.pop(work_id, None)
+        if queue_name not in self.heaps:
+            return
+
+        # Push next eligible time for this work.
+        delay = STATUS_DELAYS[queue_name] if delay is None else delay
+        self.seq += 1
+        entry = (self.timestamps[work_id] + delay, self.seq, work_id)
+        self.entries[work_id] = entry
+        heap = self.heaps[queue_name]
+        heapq.heappush(heap, entry)
+
+        # Drop stale entries if they start to dominate the heap.
+        if len(heap) > 64 and len(heap) > 2 * len(self.queues[queue_name]):
+            heap[:] = [e for e in heap if self.entries.get(e[2]) is e]
+            heapq.heapify(heap)
+
+    def peek_due(self, queue_name: int):
+        # Lazily discard entries for work that has since moved.
+        heap = self.heaps[queue_name]
+        while heap:
+            entry = heap[0]
+            if self.entries.get(entry[2]) is entry:
+                return entry
+
+            heapq.heappop(heap)
+            self.stale += 1
+
+        return None
+
+    def next_due(self, mon_freq=MONITOR_FREQUENCY):
+        """
+        Return (due_time, queue_name, work_id) for the work in this
+        queue that becomes eligible first or None if there's no work.
+        INIT work is always eligible so its due time is when it was added.
+        """
+        best = None
+        node = self.queues[STATUS_INIT].head
+        if node is not None:
+            work_id = node.value[0]
+            best = (self.timestamps[work_id], STATUS_INIT, work_id)
+
+        # A monitor frequency override applies one interval to all
+        # AVAILABLE work. The list is in the order work was moved so
+        # its head is the first due.
+        if mon_freq != MONITOR_FREQUENCY:
+            node = self.queues[STATUS_AVAILABLE].head
+            entry = None
+            if node is not None:
+                work_id = node.value[0]
+                entry = (self.timestamps[work_id] + mon_freq, 0, work_id)
+        else:
+            entry = self.peek_due(STATUS_AVAILABLE)
+
+        if entry is not None:
+            if best is None or entry[0] < best[0]:
+                best = (entry[0], STATUS_AVAILABLE, entry[2])
+
+        entry = self.peek_due(STATUS_DEALT)
+        if entry is not None:
+            if best is None or entry[0] < best[0]:
+                best = (entry[0], STATUS_DEALT, entry[2])
+
+        return best
+
     def add_work(self, work_id: Hashable, payload: Any, queue_name: int):
         # Avoid overwriting pre-existing work.
         if work_id in self.index:
@@ -42,8 +133,22 @@ class WorkQueue:
         node = self.queues[queue_name].append((work_id, payload))
         self.index[work_id] = (queue_name, node)
         self.timestamps[work_id] = int(time.time())
-
-    def move_work(self, work_id: Hashable, queue_name: int):
+        self.schedule(work_id, queue_name)
+
+    def add_many(self, items, queue_name: int):
+        # add_work for a batch of (work_id, payload) -- used when loading.
+        now = int(time.time())
+        queue = self.queues[queue_name]
+        for work_id, payload in items:
+            if work_id in self.index:
+                raise KeyError(f"add_many: Work ID {work_id} already added.")
+
+            node = queue.append((work_id, payload))
+            self.index[work_id] = (queue_name, node)
+            self.timestamps[work_id] = now
+            self.schedule(work_id, queue_name)
+
+    def move_work(self, work_id: Hashable, queue_name: int, delay=None, front=False):
         # Work doesn't exist.
         if work_id not in self.index:
             raise KeyError(f"move_work: Work ID {work_id} doesnt exist.")
@@ -52,15 +157,20 @@ class WorkQueue:
         from_queue, node = self.index[work_id]
         self.queues[from_queue].remove(node)
 
-        # Add to end of target linked_list.
-        new_node = self.queues[queue_name].append(node.value)
+        # Add to end of target linked_list (or the start to go next.)
+        if front:
+            new_node = self.queues[queue_name].prepend(node.value)
+        else:
+            new_node = self.queues[queue_name].append(node.value)
         self.index[work_id] = (queue_name, new_node)
         self.timestamps[work_id] = int(time.time())
+        self.schedule(work_id, queue_name, delay)
 
     def remove_work(self, work_id: Hashable):
         queue_name, node = self.index.pop(work_id)
         self.queues[queue_name].remove(node)
         self.timestamps.pop(work_id, None)
+        self.entries.pop(work_id, None)
 
     def pop_available(self):
         node = self.queues[STATUS_AVAILABLE].popleft()
@@ -70,6 +180,7 @@ class WorkQueue:
         work_id, payload = node.value
         self.index.pop(work_id, None)
         self.timestamps.pop(work_id, None)
+        self.entries.pop(work_id, None)
         return work_id, payload
 
 """
@@ -1,9 +1,12 @@
+import os
+import signal
 import asyncio
-import random
 from p2pd import *
 from ..defs import *
 from .worker_utils import *
 from .worker_monitors import *
+from .worker_pool import *
+from .alias_resolver import *
 from ..txt_strs import *
 
 """
@@ -32,20 +35,22 @@ if_info = {'id': 'eno1',
 }
 
 async def worker(nic, curl, init_work=None, table_type=None):
+    # Returns (is_success, status_ids, rtt in ms or None.)
     status_ids = []
+    rtt = None
     try:
         # A single group of work, 1 or more grouped long.
         work = init_work or (await fetch_work_list(curl, table_type))
         if work == INVALID_SERVER_RESPONSE:
             print("Invalid server response, try again.")
-            return 0, []
+            return 0, [], None
         if not len(work):
             print("No work found")
-            return NO_WORK, []
+            return NO_WORK, [], None
 
         print("got work = ", work)
 
-        is_success = 0
+        is_success = 1
         status_ids = [w["status_id"] for w in work if "status_id" in w]
         table_type = work[0]["table_type"]
 
@@ -79,7 +84,14 @@ async def worker(nic, curl, init_work=None, table_type=None):
                 print("Not importing.")
 
         if table_type == SERVICES_TABLE_TYPE:
-            is_success = await service_monitor(nic, work)
+            # Probes that raise still count as failed.
+            timings = ProbeTimings()
+            is_success = 0
+            try:
+                is_success, rtt = await service_monitor(nic, work, timings)
+            finally:
+                telemetry.probe_done(work, timings, is_success)
+
             if is_success:
                 print("Online -- updating uptime", status_ids)
             else:
@@ -87,10 +99,17 @@ async def worker(nic, curl, init_work=None, table_type=None):
         
         
         if table_type == ALIASES_TABLE_TYPE:
-            res_ip = await asyncio.wait_for(
-                alias_monitor(curl, work),
-                2
-            )
+            timings = ProbeTimings()
+            res_ip = None
+            try:
+                res_ip = await asyncio.wait_for(
+                    alias_monitor(curl, work, timings),
+                    ALIAS_RESOLVE_TIMEOUT + 2 * DEALER_TIMEOUT
+                )
+
+                timings.mark("dns")
+            finally:
+                telemetry.probe_done(work, timings, res_ip)
 
             if res_ip:
                 params = {"alias_id": int(work[0]["id"]), "ip": res_ip}
@@ -101,25 +120,56 @@ async def worker(nic, curl, init_work=None, table_type=None):
         
 
         print("Work status updated.")
-        return 1, status_ids
+        return is_success, status_ids, rtt
     except:
         what_exception()
         log_exception()
-        return 0, status_ids
+        return 0, status_ids, None
 
 async def process_work(nic, curl, table_type=None, stagger=False):
     await sleep_random(100, 4000)
 
     # Execute work from the dealer server.
     start_time = time.perf_counter()
-    is_success, status_ids = await worker(nic, curl, table_type=table_type)
+    is_success, status_ids, rtt = await worker(nic, curl, table_type=table_type)
     if is_success == NO_WORK:
         # Between 1 - 5 mins.
         await sleep_random(60000, 300000)
 
     # Update statuses.
     await async_wrap_errors(
-        update_work_status(curl, status_ids, is_success)
+        update_work_status(curl, status_ids, is_success, rtt)
+    )
+
+    # If work finished too fast -- add a sleep to avoid DoSing server.     
+    exec_elapsed = time.perf_counter() - start_time
+    if exec_elapsed <= 0.5:
+        ms = int(exec_elapsed * 1000)
+        await sleep_random(max(100, 500 - ms), 1000)
+
+async def process_batch(nic, curl, table_type=None, max_groups=WORK_BATCH_SIZE):
+    await sleep_random(100, 4000)
+
+    # Lease a batch of groups in one round trip.
+    start_time = time.perf_counter()
+    lease_id, groups = await fetch_work_lease(curl, table_type, max_groups)
+    if groups in (INVALID_SERVER_RESPONSE, WORK_THROTTLED):
+        return
+
+    if not len(groups):
+        print("No work found")
+
+        # Between 1 - 5 mins.
+        await sleep_random(60000, 300000)
+        return
+
+    # Run every group in the lease at once.
+    tasks = [worker(nic, curl, init_work=group) for group in groups]
+    outcomes = await asyncio.gather(*tasks)
+
+    # Update statuses for the whole lease together.
+    await async_wrap_errors(
+        complete_work_lease(curl, lease_id, outcomes)
     )
 
     # If work finished too fast -- add a sleep to avoid DoSing server.     
@@ -128,7 +178,7 @@ async def process_work(nic, curl, table_type=None, stagger=False):
         ms = int(exec_elapsed * 1000)
         await sleep_random(max(100, 500 - ms), 1000)
 
-async def main(nic=None):
+async def main(nic=None, task_no=None):
     print("Loading interface...")
     nic = nic or Interface.from_dict(if_info)
     print("Interface loaded: ", nic)
@@ -136,22 +186,52 @@ async def main(nic=None):
     # Workers start randomly over the next min to avoid traffic surges.
     #await sleep_random(1000, 60000)
 
-    endpoint = ("127.0.0.1", 8000,)
+    # One keep-alive client shared by every probe task.
     route = nic.route(IP4)
-    curl = WebCurl(endpoint, route)
-
-    """
-    If there's many items in a work queue then the workers might never get
-    to the end of it before moving to the next queue. So the queue to process
-    is chosen randomly with a bias towards services.
-    """
-    tables = (SERVICES_TABLE_TYPE, IMPORTS_TABLE_TYPE, ALIASES_TABLE_TYPE,)
-    table = random.choice(tables)
-    while 1:
-        await async_wrap_errors(
-            process_work(nic, curl, table_type=table)
+    rpc_path = os.environ.get("MONITOR_DEALER_RPC")
+    if rpc_path:
+        curl = RPCClient(route, rpc_path)
+    else:
+        curl = DealerClient(
+            route,
+            endpoint=os.environ.get("MONITOR_DEALER_URL", DEALER_ENDPOINT),
+            uds=os.environ.get("MONITOR_DEALER_UDS") or None
         )
 
+    # Local /metrics and optional timings sent with /complete.
+    metrics_addr = os.environ.get("MONITOR_WORKER_METRICS")
+    metrics_server = None
+    if metrics_addr:
+        host, port = metrics_addr.rsplit(":", 1)
+        metrics_server = await serve_metrics(telemetry.metrics, host, int(port))
+
+    telemetry.report = os.environ.get("MONITOR_WORKER_TELEMETRY") == "1"
+
+    # Many probes in flight from this one process. Work comes from any
+    # table -- the dealer deals aliases first (see WORK_LANES.)
+    task_no = task_no or int(os.environ.get("MONITOR_WORKER_TASKS", WORKER_TASK_NO))
+    pool = WorkerPool(nic, curl, worker, task_no=task_no)
+
+    # Or only resolve aliases, in bulk.
+    if os.environ.get("MONITOR_WORKER_MODE") == "alias":
+        pool = AliasResolverPool(curl)
+
+    # Finish in-flight probes on shutdown.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, pool.stop)
+        except NotImplementedError:
+            pass
+
+    try:
+        await pool.run()
+    finally:
+        await curl.close()
+        await UDPMux.close_all(nic)
+        if metrics_server is not None:
+            metrics_server.close()
+
     # Give time for event loop to finish.
     await asyncio.sleep(2)
         
@@ -0,0 +1,161 @@
+"""
+Telemetry for one worker process.
+
+Every probe gets a ProbeTimings. Probes mark when they reach each phase
+and worker() records the result, like curl's -w timings -- each phase
+is the time since the probe started, not since the phase before:
+
+    dns -- name resolved (alias work)
+    connect -- connected / allocated (TCP, MQTT, TURN)
+    first_reply -- first reply from the server
+    total -- probe finished, including teardown
+
+Only the phases a protocol has are recorded. latency() is what the
+dealer scores servers on: the request -> reply time if the probe measured
+one (MQTT, NTP, TURN) and first_reply otherwise -- never the whole probe. Timings are labelled by
+service type, af and proto. The pool also records how long groups wait
+in its queue, and retry_curl_on_locked records dealer round trips.
+
+Metrics are served on MONITOR_WORKER_METRICS (host:port) if it's set.
+With MONITOR_WORKER_TELEMETRY=1 probe timings are also sent to the
+dealer with each /complete (at most TELEMETRY_BATCH_MAX a call) so one
+/metrics shows every worker.
+"""
+
+import time
+from ..defs import *
+from ..txt_strs import *
+from ..metrics import *
+from ..dns_cache import describe_dns_metrics
+from .udp_mux import UDPMux
+
+PROBE_PHASES = ("dns", "connect", "first_reply", "total")
+
+class ProbeTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.rtt = None
+
+    def reply(self, sent):
+        # A reply to a request sent at sent (perf_counter.)
+        self.mark("first_reply")
+        if self.rtt is None:
+            self.rtt = time.perf_counter() - sent
+
+    def latency(self):
+        # Seconds or None if there was no reply.
+        if self.rtt is not None:
+            return self.rtt
+
+        return self.phases.get("first_reply")
+
+    def mark(self, phase):
+        # First time only -- retries don't move a phase.
+        if phase not in self.phases:
+            self.phases[phase] = time.perf_counter() - self.start
+
+def probe_labels(work):
+    # (service type, af, proto) names for a group of work.
+    entry = work[0]
+    if "type" in entry:
+        service_type = TXTS.get(entry["type"], str(entry["type"]))
+    else:
+        service_type = TXTS.get(entry.get("table_type"), "unknown")
+
+    af = TXTS["af"].get(entry.get("af"), str(entry.get("af")))
+    proto = TXTS["proto"].get(entry.get("proto"), "ANY")
+    return service_type, af, proto
+
+def describe_probe_metrics(metrics):
+    # Shared with the dealer, which gets them through /complete.
+    metrics.describe(
+        "worker_probe_seconds", "histogram",
+        "Time from probe start to each phase.",
+        ("type", "af", "proto", "phase")
+    )
+
+    return metrics
+
+def describe_worker_metrics(metrics):
+    describe_probe_metrics(metrics)
+    metrics.describe(
+        "worker_probes_total", "counter",
+        "Probes run by result.",
+        ("type", "af", "proto", "result")
+    )
+    metrics.describe(
+        "worker_queue_wait_seconds", "histogram",
+        "Time a leased group waits for a free probe task.",
+    )
+    metrics.describe(
+        "worker_dealer_seconds", "histogram",
+        "Round trip time of calls to the dealer.",
+        ("call",)
+    )
+    metrics.describe(
+        "worker_in_flight", "gauge",
+        "Groups leased and not finished yet.",
+    )
+    metrics.describe(
+        "worker_udp_mux_total", "counter",
+        "Shared UDP socket activity.",
+        ("mux", "stat")
+    )
+
+    return describe_dns_metrics(metrics)
+
+def collect_udp_mux(metrics):
+    for (name, _), mux in list(UDPMux.shared.items()):
+        for stat, value in mux.stats.items():
+            metrics.set("worker_udp_mux_total", value, (name, stat))
+
+class WorkerTelemetry:
+    def __init__(self):
+        self.metrics = describe_worker_metrics(Metrics())
+        self.metrics.add_collector(collect_udp_mux)
+        self.report = False # Send probe timings with /complete.
+        self.pending = [] # [[type, af, proto, {phase: seconds}] ...]
+
+    def probe_done(self, work, timings, is_success):
+        timings.mark("total")
+        labels = probe_labels(work)
+        for phase, seconds in timings.phases.items():
+            self.metrics.observe("worker_probe_seconds", seconds, labels + (phase,))
+
+        result = "ok" if is_success else "failed"
+        self.metrics.inc("worker_probes_total", labels + (result,))
+        if self.report and len(self.pending) < TELEMETRY_BATCH_MAX:
+            self.pending.append(list(labels) + [timings.phases])
+
+    def take_pending(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def dealer_call(self, endpoint, seconds):
+        self.metrics.observe("worker_dealer_seconds", seconds, (endpoint.strip("/"),))
+
+def known_probe_labels():
+    names = {v for k, v in TXTS.items() if isinstance(v, str)}
+    afs = set(TXTS["af"].values())
+    protos = set(TXTS["proto"].values()) | {"ANY"}
+    return names, afs, protos
+
+def add_probe_samples(metrics, samples):
+    # Fold timings sent by a worker into the dealer's metrics.
+    # Unknown label values are dropped to keep the series bounded.
+    names, afs, protos = known_probe_labels()
+    for sample in samples or []:
+        try:
+            labels = tuple(sample[:3])
+            if labels[0] not in names or labels[1] not in afs or labels[2] not in protos:
+                continue
+
+            for phase, seconds in sample[3].items():
+                if phase in PROBE_PHASES:
+                    metrics.observe("worker_probe_seconds", float(seconds), labels + (phase,))
+        except (TypeError, ValueError, IndexError, AttributeError):
+            continue
+
+# One per worker process.
+telemetry = WorkerTelemetry()
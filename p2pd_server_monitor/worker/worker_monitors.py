@@ -1,9 +1,23 @@
+import time
 import asyncio
 from p2pd import *
+from p2pd.gmqtt import Client as MQTTClient
 from ..defs import *
 from .worker_utils import *
+from .worker_metrics import *
+from .alias_resolver import *
+
+async def monitor_stun_map_type(nic, work, timings=None):
+    timings = timings or ProbeTimings()
+
+    # UDP probes share the worker's sockets.
+    if work[0]["proto"] == UDP:
+        mux = StunMux.for_nic(nic)
+        dest = (work[0]["ip"], work[0]["port"],)
+        await mux.get_wan_ip(work[0]["af"], dest, RFC5389)
+        timings.mark("first_reply")
+        return 1
 
-async def monitor_stun_map_type(nic, work):
     client = STUNClient(
         work[0]["af"],
         (work[0]["ip"], work[0]["port"],),
@@ -13,10 +27,12 @@ async def monitor_stun_map_type(nic, work):
     )
 
     out = await client.get_wan_ip()
+    timings.mark("first_reply")
     return 1
 
-async def monitor_stun_change_type(nic, work):
+async def monitor_stun_change_type(nic, work, timings=None):
     # Validates the relationship between 4 stun servers.
+    # Many requests at once so only the total is timed.
     await validate_rfc3489_stun_server(
         work[0]["af"],
         work[0]["proto"],
@@ -29,98 +45,203 @@ async def monitor_stun_change_type(nic, work):
 
     return 1
 
-async def monitor_mqtt_type(nic, work):
-    found_msg = asyncio.Queue()
-
-    def mqtt_proto_closure(ret):
-        async def mqtt_proto(payload, client):
-            found_msg.put_nowait(payload)
-
-        return mqtt_proto
-
-    # Setup MQTT client with basic proto.
-    mqtt_proto = mqtt_proto_closure(found_msg)
-    peer_id = to_s(rand_plain(10))
-    dest = (work[0]["ip"], work[0]["port"])
-    client = SignalMock(peer_id, mqtt_proto, dest)
-
-    # Send message to self and try receive it.
-    client = await client.start()
-    for i in range(0, 3):
-        await client.send_msg(peer_id, peer_id)
-
-        # Allow time to receive responds.
-        await asyncio.sleep(0.1)
-        if not found_msg.empty(): break
+class MonitorProbe:
+    """
+    One probe of a service. Use as "async with" so whatever run()
+    opened is torn down however it ends -- success, failure, timeout
+    or cancellation.
+    """
+    def __init__(self, nic, work, timings=None):
+        self.nic = nic
+        self.work = work
+        self.timings = timings or ProbeTimings()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Teardown errors mustn't hide the probe result.
+        try:
+            await asyncio.wait_for(self.close(), MONITOR_CLOSE_TIMEOUT)
+        except Exception:
+            log_exception()
+
+    async def run(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class ProbeMQTTClient(MQTTClient):
+    # A probe is one connection. gmqtt would otherwise retry a
+    # broker that dropped it every 60 s for as long as we run.
+    async def reconnect(self, delay=False):
+        return
+
+class ProbeSignal(SignalMock):
+    async def get_client(self, mqtt_server):
+        # Kept before connecting so close() works if connect() fails.
+        self.client = ProbeMQTTClient(self.peer_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_subscribe = self.on_subscribe
+        await asyncio.wait_for(
+            self.client.connect(host=mqtt_server[0], port=mqtt_server[1]),
+            5
+        )
+
+        return self.client
+
+class MQTTProbe(MonitorProbe):
+    def __init__(self, nic, work, timings=None):
+        super().__init__(nic, work, timings)
+        self.client = None
+        self.found_msg = asyncio.Queue()
+        self.sent = None
+
+    async def on_msg(self, payload, client):
+        # Timed from the first send -- not the connect or the waits.
+        self.timings.reply(self.sent)
+        self.found_msg.put_nowait(payload)
+
+    async def run(self):
+        # Send message to self and try receive it.
+        peer_id = to_s(rand_plain(10))
+        dest = (self.work[0]["ip"], self.work[0]["port"])
+        self.client = ProbeSignal(peer_id, self.on_msg, dest)
+        await self.client.start()
+        self.timings.mark("connect")
+        self.sent = time.perf_counter()
+        for i in range(0, 3):
+            await self.client.send_msg(peer_id, peer_id)
+
+            # Allow time to receive responds.
+            await asyncio.sleep(0.1)
+            if not self.found_msg.empty(): break
+
+        # Wait for a reply.
+        try:
+            await asyncio.wait_for(self.found_msg.get(), 1.0)
+            return 1
+        except asyncio.TimeoutError:
+            return 0
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+class TURNProbe(MonitorProbe):
+    def __init__(self, nic, work, timings=None):
+        super().__init__(nic, work, timings)
+        self.client = None
+
+    async def run(self):
+        work = self.work
+        user = "" if work[0]["user"] is None else work[0]["user"]
+        password = "" if work[0]["password"] is None else work[0]["password"]
+        self.client = TURNClient(
+            af=work[0]["af"],
+            dest=(work[0]["ip"], work[0]["port"]),
+            nic=self.nic,
+            auth=(user, password),
+
+            # No realm support for now. Most don't set it.
+            realm=None
+        )
+
+        # start() waits on auth forever if the server stops answering.
+        sent = time.perf_counter()
+        await asyncio.wait_for(self.client.start(), TURN_START_TIMEOUT)
+        self.timings.mark("connect")
+
+        # Allocation is two round trips: 401 challenge then signed Allocate.
+        self.timings.rtt = (time.perf_counter() - sent) / 2
+        if self.client:
+            r_addr, r_relay = await self.client.get_tups()
+            if None not in (r_addr, r_relay):
+                self.timings.mark("first_reply")
+                return 1
 
-    # Wait for a reply.
-    try:
-        await asyncio.wait_for(found_msg.get(), 1.0)
-        return 1
-    except asyncio.TimeoutError:
         return 0
 
-async def monitor_turn_type(nic, work):
-    user = "" if work[0]["user"] is None else work[0]["user"]
-    password = "" if work[0]["password"] is None else work[0]["password"]
-    client = await TURNClient(
-        af=work[0]["af"],
-        dest=(work[0]["ip"], work[0]["port"]),
-        nic=nic,
-        auth=(user, password),
-
-        # No realm support for now. Most don't set it.
-        realm=None
-    )
+    async def close(self):
+        if self.client:
+            # client.close() waits out the reply loop's recv poll and
+            # its refresher (~4 s) -- and forever if start() never
+            # got that far. Close the pipe and cancel them instead.
+            await self.client.do_cleanup()
+            tasks = [self.client.processing_loop_task] + self.client.tasks
+            tasks = [task for task in tasks if task is not None]
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.client = None
+
+class NTPProbe(MonitorProbe):
+    # Uses the worker's shared NTP sockets -- nothing to close.
+    async def run(self):
+        mux = NTPMux.for_nic(self.nic)
+        dest = (self.work[0]["ip"], self.work[0]["port"])
+        for _ in range(3):
+            try:
+                # Timed per attempt so retries don't count as latency.
+                sent = time.perf_counter()
+                await mux.request(self.work[0]["af"], dest, version=3)
+                self.timings.reply(sent)
+                return 1
+            except (ErrorNoReply, NTPException):
+                continue
 
-    if client:
-        r_addr, r_relay = await client.get_tups()
-        await client.close()
+        return 0
 
-        if None not in (r_addr, r_relay):
-            return 1
+async def monitor_mqtt_type(nic, work, timings=None):
+    async with MQTTProbe(nic, work, timings) as probe:
+        return await probe.run()
 
-    return 0
+async def monitor_turn_type(nic, work, timings=None):
+    async with TURNProbe(nic, work, timings) as probe:
+        return await probe.run()
 
-async def monitor_ntp_type(nic, work):
+async def monitor_ntp_type(nic, work, timings=None):
     try:
-        for _ in range(3):
-            client = NTPClient(nic)
-            response = await client.request(
-                (work[0]["ip"], work[0]["port"]),
-                version=3
-            )
-            if response is None:
-                continue
-
-            return 1
-    except Exception as e:
+        async with NTPProbe(nic, work, timings) as probe:
+            return await probe.run()
+    except Exception:
         log_exception()
 
     return 0
 
-async def service_monitor(nic, work):
+async def service_monitor(nic, work, timings=None):
+    # Returns (is_success, rtt in ms or None if it failed.)
+    # Phases reached are marked on timings if given.
+    timings = timings or ProbeTimings()
     is_success = 0
     work_type = work[0]["type"]
 
     if len(work) == 1:
         if work_type == STUN_MAP_TYPE:
-            is_success = await monitor_stun_map_type(nic, work)
+            is_success = await monitor_stun_map_type(nic, work, timings)
 
         if work_type == MQTT_TYPE:
-            is_success = await monitor_mqtt_type(nic, work)
+            is_success = await monitor_mqtt_type(nic, work, timings)
 
         if work_type == TURN_TYPE:
-            is_success = await monitor_turn_type(nic, work)
+            is_success = await monitor_turn_type(nic, work, timings)
 
         if work_type == NTP_TYPE:
-            is_success = await monitor_ntp_type(nic, work)
+            is_success = await monitor_ntp_type(nic, work, timings)
 
     if len(work) == 4:
         if work_type == STUN_CHANGE_TYPE:
-            is_success = await monitor_stun_change_type(nic, work)
-    
-    return is_success
+            is_success = await monitor_stun_change_type(nic, work, timings)
+
+    # Latency rather than how long the whole probe took.
+    latency = timings.latency() if is_success else None
+    rtt = latency * 1000 if latency is not None else None
+    return is_success, rtt
 
 async def imports_monitor(nic, pending_insert):
     validated_lists = await validate_service_import(
@@ -169,11 +290,22 @@ async def imports_monitor(nic, pending_insert):
     # Same return time but update status handled by /insert.
     return 1
 
-async def alias_monitor(curl, alias):
-    nic = curl.route.interface
-    try:
-        addr = await Address(alias[0]["fqn"], 80, nic)
-        ip = addr.select_ip(alias[0]["af"]).ip
-        return ip
-    except:
-        return 0
\ No newline at end of file
+async def alias_monitor(curl, alias, timings=None):
+    # First public IP for the alias. Uses the worker's DNS cache and
+    # asks the dealer's shared one before going to DNS.
+    fqn, af = alias[0]["fqn"], alias[0]["af"]
+    await async_wrap_errors(shared_resolver.ask_shared(curl, alias))
+    ips, ttl, looked_up = await shared_resolver.resolve_answer(fqn, af, timings)
+
+    # Other workers can use the answer.
+    if looked_up and ttl is not None:
+        answer = {"fqn": fqn, "af": af, "ips": ips, "ttl": ttl}
+        await async_wrap_errors(share_answers(curl, [answer]))
+
+    for ip in ips:
+        try:
+            return ensure_ip_is_public(ip)
+        except:
+            continue
+
+    return 0
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+Runs many probes at once from one worker process.
+
+A single fetch loop leases batches of work from the dealer but only asks
+for as many groups as there are free probe slots. So when probes are slow
+the worker stops pulling work (backpressure) instead of queueing it up
+and letting leases expire. Probe tasks take groups off the queue and run
+them under a semaphore for their service type so one slow protocol can't
+take every slot. When every group of a lease is done the results go back
+in a single /complete.
+
+stop() (hooked to SIGTERM) stops new leases, lets in-flight probes finish
+and reports them before the pool exits.
+
+Queue waits and the number of groups in flight go in the worker's
+telemetry (see worker_metrics.)
+"""
+
+import time
+import asyncio
+import random
+from p2pd import *
+from ..defs import *
+from .worker_utils import *
+
+class WorkerPool:
+    def __init__(self, nic, curl, probe, task_no=WORKER_TASK_NO, limits=None, table_type=None, fetch_interval=WORK_FETCH_INTERVAL):
+        self.nic = nic
+        self.curl = curl
+        self.probe = probe
+        self.task_no = task_no
+        self.fetch_interval = fetch_interval
+        self.limits = limits or PROBE_CONCURRENCY
+        self.table_type = table_type
+        self.queue = asyncio.Queue()
+        self.semaphores = {}
+        self.leases = {} # lease_id: [remaining, outcomes]
+        self.in_flight = 0
+        self.has_capacity = asyncio.Event()
+        self.has_capacity.set()
+        self.stopping = asyncio.Event()
+
+    def semaphore(self, group):
+        # Aliases and imports are limited by table, services by type.
+        key = group[0].get("table_type")
+        if key == SERVICES_TABLE_TYPE:
+            key = group[0].get("type")
+
+        if key not in self.semaphores:
+            limit = self.limits.get(key, self.limits[None])
+            self.semaphores[key] = asyncio.Semaphore(limit)
+
+        return self.semaphores[key]
+
+    def stop(self):
+        self.stopping.set()
+
+    async def pause(self, seconds):
+        # Sleep that wakes up early on shutdown.
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def lease(self, max_groups):
+        return await fetch_work_lease(self.curl, self.table_type, max_groups)
+
+    async def complete(self, lease_id, outcomes):
+        # Probe timings since the last /complete go with it if enabled.
+        samples = telemetry.take_pending() if telemetry.report else None
+        await async_wrap_errors(
+            complete_work_lease(self.curl, lease_id, outcomes, samples)
+        )
+
+    async def fetch_loop(self):
+        while not self.stopping.is_set():
+            # Backpressure: only lease what there's room to run.
+            free = self.task_no - self.in_flight
+            if free <= 0:
+                self.has_capacity.clear()
+                await self.has_capacity.wait()
+                continue
+
+            try:
+                lease_id, groups = await self.lease(min(free, WORK_BATCH_SIZE))
+            except Exception:
+                log_exception()
+                lease_id, groups = None, INVALID_SERVER_RESPONSE
+
+            # Bad reply or the dealer is over its probe budget.
+            if groups in (INVALID_SERVER_RESPONSE, WORK_THROTTLED):
+                await self.pause(random.uniform(1, 3))
+                continue
+
+            # Between 1 - 5 mins.
+            if not len(groups):
+                await self.pause(random.uniform(60, 300))
+                continue
+
+            self.leases[lease_id] = [len(groups), []]
+            queued_at = time.perf_counter()
+            for group in groups:
+                self.in_flight += 1
+                self.queue.put_nowait((lease_id, group, queued_at))
+
+            telemetry.metrics.set("worker_in_flight", self.in_flight)
+
+            # Avoid DoSing the dealer.
+            await self.pause(self.fetch_interval)
+
+    async def finish(self, lease_id, outcome):
+        self.in_flight -= 1
+        self.has_capacity.set()
+        telemetry.metrics.set("worker_in_flight", self.in_flight)
+
+        # Report the lease once all of its groups are done.
+        lease = self.leases[lease_id]
+        lease[0] -= 1
+        lease[1].append(outcome)
+        if not lease[0]:
+            del self.leases[lease_id]
+            await self.complete(lease_id, lease[1])
+
+    async def probe_loop(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            lease_id, group, queued_at = item
+            outcome = (0, [w["status_id"] for w in group if "status_id" in w])
+            try:
+                async with self.semaphore(group):
+                    waited = time.perf_counter() - queued_at
+                    telemetry.metrics.observe("worker_queue_wait_seconds", waited)
+                    outcome = await self.probe(self.nic, self.curl, init_work=group)
+            except Exception:
+                log_exception()
+            finally:
+                await self.finish(lease_id, outcome)
+
+    async def run(self):
+        tasks = [
+            asyncio.create_task(self.probe_loop())
+            for _ in range(self.task_no)
+        ]
+
+        # Blocks until stop() is called.
+        fetcher = asyncio.create_task(self.fetch_loop())
+        await self.stopping.wait()
+        self.has_capacity.set()
+        await fetcher
+
+        # Drain in-flight work then end the probe tasks.
+        for _ in tasks:
+            self.queue.put_nowait(None)
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*tasks),
+                WORKER_SHUTDOWN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            for task in tasks:
+                task.cancel()
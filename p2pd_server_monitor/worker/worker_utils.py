@@ -1,6 +1,11 @@
 import httpx
+import random
+import asyncio
 from p2pd import *
 from ..defs import *
+from ..rpc import *
+from .stun_mux import *
+from .worker_metrics import *
 
 async def validate_stun_server(ip, port, pipe, mode, cip=None, cport=None):
     # New client used for the req.
@@ -42,50 +47,109 @@ async def validate_stun_server(ip, port, pipe, mode, cip=None, cport=None):
 
     return reply
 
-async def stun_server_classifier(af, ip, port, nic):
-    # List of STUN server endpoints sorted based on type and proto.
-    servers = []
+async def validate_stun_server_mux(mux, af, ip, port, mode, cip=None, cport=None):
+    # validate_stun_server over the shared UDP sockets.
+    dest = (ip, port)
+    if mode == RFC3489 and cport is not None:
+        if cip is None:
+            reply = await mux.get_change_port_reply(af, dest, (ip, cport))
+        else:
+            reply = await mux.get_change_tup_reply(af, dest, (cip, cport))
+    else:
+        reply = await mux.get_stun_reply(af, dest, mode)
 
-    # Mostly RFC3489 is used for NAT checks whick need UDP.
-    # Also, its assumed that IPv4 is used since NATs are used there.
-    # Though you can also NAT on v6.
+    reply = validate_stun_reply(reply, mode)
+    if reply is None:
+        raise Exception("Invalid stun reply.")
+
+    return reply
+
+async def all_or_nothing(coros, timeout=None):
+    """
+    Run coros at once. The first failure cancels the rest and is
+    raised -- as is a timeout. Returns results in order.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
     try:
-        # Initial STUN client used to check if a server can support NAT tests.
-        route = nic.route(af)
-        pipe = await pipe_open(UDP, route=route)
+        done, pending = await asyncio.wait(
+            tasks,
+            timeout=timeout,
+            return_when=asyncio.FIRST_EXCEPTION
+        )
+
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+
+        if pending:
+            raise asyncio.TimeoutError()
+
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def classify_rfc3489(af, ip, port, nic):
+    # Change server group or None.
+    # Get initial reply from STUN server.
+    # The reply needs the change port and change IP attribytes.
+    mux = StunMux.for_nic(nic)
+    reply = await mux.get_stun_reply(af, (ip, port), RFC3489)
+    reply = validate_stun_reply(reply, RFC3489)
+    if reply is None:
+        return None
+
+    primary_tup = (ip, port, reply.ctup[1],)
+    secondary_tup = (reply.ctup[0], port, reply.ctup[1],)
+
+    # Throws exception on failure.
+    await validate_rfc3489_stun_server(
+        af,
+        UDP,
+        nic,
+        primary_tup,
+        secondary_tup
+    )
+
+    return [
+        [STUN_CHANGE_TYPE, int(af), int(UDP), ip, port, None, None],
+        [STUN_CHANGE_TYPE, int(af), int(UDP), ip, reply.ctup[1], None, None],
+        [STUN_CHANGE_TYPE, int(af), int(UDP), reply.ctup[0], port, None, None],
+        [STUN_CHANGE_TYPE, int(af), int(UDP), reply.ctup[0], reply.ctup[1], None, None]
+    ]
+
+async def classify_stun_map(af, ip, port, nic, stun_proto, stun_mode, stun_type):
+    # Map server group or None.
+    # Here the RFC type controls whether to send a specfic magic cookie.
+    if stun_proto == UDP:
+        mux = StunMux.for_nic(nic)
+        wan_ip = await mux.get_wan_ip(af, (ip, port), stun_mode)
+    else:
         stun_client = STUNClient(
-            af=pipe.route.af,
+            af=af,
             dest=(ip, port),
-            nic=pipe.route.interface,
-            proto=pipe.proto,
-            mode=RFC3489
+            nic=nic,
+            proto=stun_proto,
+            mode=stun_mode
         )
 
-        # Get initial reply from STUN server.
-        # The reply needs the change port and change IP attribytes.
-        reply = await stun_client.get_stun_reply(pipe=pipe)
-        reply = validate_stun_reply(reply, RFC3489)
-        if reply is not None:
-            primary_tup = (ip, port, reply.ctup[1],)
-            secondary_tup = (reply.ctup[0], port, reply.ctup[1],)
+        wan_ip = await stun_client.get_wan_ip()
 
-            # Throws exception on failure.
-            await validate_rfc3489_stun_server(
-                af,
-                UDP,
-                nic,
-                primary_tup,
-                secondary_tup
-            )
+    if wan_ip is not None:
+        return [[stun_type, int(af), int(stun_proto), ip, port, None, None]]
 
-            servers.append([
-                [STUN_CHANGE_TYPE, int(af), int(UDP), ip, port, None, None],
-                [STUN_CHANGE_TYPE, int(af), int(UDP), ip, reply.ctup[1], None, None],
-                [STUN_CHANGE_TYPE, int(af), int(UDP), reply.ctup[0], port, None, None],
-                [STUN_CHANGE_TYPE, int(af), int(UDP), reply.ctup[0], reply.ctup[1], None, None]
-            ])
-    except:
-        log_exception()
+async def stun_server_classifier(af, ip, port, nic, deadline=STUN_IMPORT_DEADLINE):
+    """
+    List of STUN server endpoints sorted based on type and proto.
+
+    Every check runs at once so a candidate takes as long as its
+    slowest check (at most deadline seconds) instead of the sum.
+    Checks still running at the deadline count as failed.
+    """
+    # Mostly RFC3489 is used for NAT checks whick need UDP.
+    # Also, its assumed that IPv4 is used since NATs are used there.
+    # Though you can also NAT on v6.
+    checks = [classify_rfc3489(af, ip, port, nic)]
 
     # We specifically DO NOT add any potential change IPs into map.
     # Otherwise WAN IP lookups can contaminate NAT test results.
@@ -97,28 +161,33 @@ async def stun_server_classifier(af, ip, port, nic):
     ]
 
     # Check other capabilities for STUN server.
-    # Here the RFC type controls whether to send a specfic magic cookie.
     # It says "change type" but here we're only interest in a reply at all
-    for stun_info in stun_infos:
-        stun_proto, stun_mode, stun_type = stun_info
-        stun_client = STUNClient(
-            af=af,
-            dest=(ip, port),
-            nic=nic,
-            proto=stun_proto,
-            mode=stun_mode
-        )
+    for stun_proto, stun_mode, stun_type in stun_infos:
+        checks.append(classify_stun_map(
+            af, ip, port, nic, stun_proto, stun_mode, stun_type
+        ))
+
+    tasks = [asyncio.ensure_future(check) for check in checks]
+    try:
+        await asyncio.wait(tasks, timeout=deadline)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Same order as the checks.
+    servers = []
+    for task in tasks:
+        # Still running at the deadline.
+        if not task.done() or task.cancelled():
+            continue
 
-        try:
-            wan_ip = await stun_client.get_wan_ip()
-            if wan_ip is not None:
-                servers.append([
-                    [stun_type, int(af), int(stun_proto), ip, port, None, None]
-                ])
-        except:
-            log_exception()
+        if task.exception() is not None:
+            log("STUN check for %s:%s failed: %r" % (ip, port, task.exception()))
             continue
 
+        if task.result():
+            servers.append(task.result())
+
     return servers
 
 # So with RFC 3489 there's actualoly 4 STUN servers to check:
@@ -138,9 +207,6 @@ async def validate_rfc3489_stun_server(af, proto, nic, primary_tup, secondary_tu
         (primary_tup[0], primary_tup[1], secondary_tup[0], secondary_tup[2],),
     ]
 
-    route = nic.route(af)
-    pipe = await pipe_open(proto, route=route)
-
     # Compare IPS in different tups (must be different)
     if IPR(primary_tup[0], af) == IPR(secondary_tup[0], af):
         raise Exception("primary and secondary IPs must differ 3489.")
@@ -149,38 +215,122 @@ async def validate_rfc3489_stun_server(af, proto, nic, primary_tup, secondary_tu
     if primary_tup[1] == secondary_tup[2]:
         raise Exception("change port must differ 3489")
 
-    # Test each STUN server.
-    for info in infos:
-        dest_ip, dest_port, cip, cport = info
-        await validate_stun_server(
-            ip=dest_ip,
-            port=dest_port,
-            pipe=pipe,
-            mode=RFC3489,
-            cip=cip,
-            cport=cport
+    # UDP goes over the shared sockets and every check runs at once.
+    # The first to fail cancels the rest.
+    if proto == UDP:
+        mux = StunMux.for_nic(nic)
+        await all_or_nothing([
+            validate_stun_server_mux(
+                mux,
+                af,
+                dest_ip,
+                dest_port,
+                RFC3489,
+                cip,
+                cport
+            )
+            for dest_ip, dest_port, cip, cport in infos
+        ])
+
+        return
+
+    route = nic.route(af)
+    pipe = await pipe_open(proto, route=route)
+    try:
+        # Test each STUN server.
+        for info in infos:
+            dest_ip, dest_port, cip, cport = info
+            await validate_stun_server(
+                ip=dest_ip,
+                port=dest_port,
+                pipe=pipe,
+                mode=RFC3489,
+                cip=cip,
+                cport=cport
+            )
+    finally:
+        await pipe.close()
+
+class DealerClient:
+    """
+    One long-lived keep-alive HTTP client for talking to the dealer.
+    Can be used anywhere a curl object is passed since it has the route.
+    """
+    shared = {} # addr: client -- for callers that pass a WebCurl.
+
+    def __init__(self, route, endpoint=DEALER_ENDPOINT, uds=None, timeout=DEALER_TIMEOUT, max_connections=DEALER_MAX_CONNECTIONS):
+        self.route = route
+        self.endpoint = endpoint
+        self.backoff_base = DEALER_BACKOFF_BASE
+        self.backoff_max = DEALER_BACKOFF_MAX
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections
         )
 
-# Will just have workers wait until success.
-async def retry_curl_on_locked(curl, params, endpoint, retries=3):
-    url = "http://localhost:8000" + endpoint
-    async with httpx.AsyncClient() as client:
+        # The dealer is local so it can also listen on a Unix socket.
+        transport = None
+        if uds is not None:
+            transport = httpx.AsyncHTTPTransport(uds=uds, limits=limits)
+
+        self.client = httpx.AsyncClient(
+            base_url=endpoint,
+            timeout=timeout,
+            limits=limits,
+            transport=transport
+        )
+
+    @classmethod
+    def for_curl(cls, curl):
+        addr = getattr(curl, "addr", None)
+        if addr is None:
+            endpoint = DEALER_ENDPOINT
+        else:
+            endpoint = "http://%s:%d" % (addr[0], addr[1])
+
+        if endpoint not in cls.shared:
+            route = getattr(curl, "route", None)
+            cls.shared[endpoint] = cls(route, endpoint)
+
+        return cls.shared[endpoint]
+
+    async def post(self, path, params, retries=3):
+        attempt = 0
         while retries is None or retries > 0:
             # Decrement sentinel.
             if retries is not None:
                 retries -= 1
 
             # Make the request.
-            response = await client.post(url, json=params)
+            try:
+                response = await self.client.post(path, json=params)
+                if response.status_code == 200:
+                    return response.json()
+            except httpx.TransportError:
+                log_exception()
+
+            # No point waiting after the last try.
+            if retries == 0:
+                break
+
+            # Server down or busy -- back off with full jitter.
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
 
-            # Server down, try again.
-            if response.status_code is not 200:
-                await sleep_random(1000, 3000)
-                continue
+    async def close(self):
+        await self.client.aclose()
 
-            # Return output.
-            print(response.json())
-            return response.json()
+# Will just have workers wait until success.
+async def retry_curl_on_locked(curl, params, endpoint, retries=3):
+    if not isinstance(curl, (DealerClient, RPCClient)):
+        curl = DealerClient.for_curl(curl)
+
+    start = time.perf_counter()
+    try:
+        return await curl.post(endpoint, params, retries)
+    finally:
+        telemetry.dealer_call(endpoint, time.perf_counter() - start)
 
 async def fetch_work_list(curl, table_type=None):
     nic = curl.route.interface
@@ -218,14 +368,65 @@ async def fetch_work_list(curl, table_type=None):
     # Return work (may exist or not.)
     return work
 
-async def update_work_status(curl, status_ids, is_success):
-    # Indicate the status outcome.
-    t = int(time.time())
+async def fetch_work_lease(curl, table_type=None, max_groups=WORK_BATCH_SIZE, max_seconds=None):
+    nic = curl.route.interface
+    params = {
+        "stack_type": int(nic.stack),
+        "table_type": table_type,
+        "current_time": None,
+        "monitor_frequency": None,
+        "max_groups": max_groups,
+        "max_seconds": max_seconds,
+    }
+
+    # Server might return an unexpected response.
+    resp = await retry_curl_on_locked(curl, params, "/work")
+    try:
+        # Dealer is over its probe budget.
+        if not resp["groups"] and resp.get("retry_after") is not None:
+            return None, WORK_THROTTLED
+
+        groups = [sorted(g, key=lambda r: r["id"]) for g in resp["groups"]]
+        return resp["lease_id"], groups
+    except:
+        print("Could not process server resp as lease " + str(resp))
+        what_exception()
+        return None, INVALID_SERVER_RESPONSE
+
+def outcome_statuses(status_ids, is_success, t, rtt=None):
+    # /complete entries for one group -- rtt only if it was measured.
     statuses = []
     for status_id in status_ids:
         params = {"is_success": int(is_success), "status_id": status_id, "t": t}
+        if rtt is not None:
+            params["rtt"] = rtt
+
         statuses.append(params)
 
+    return statuses
+
+async def complete_work_lease(curl, lease_id, outcomes, probe_samples=None):
+    # One /complete for every group in the lease.
+    # Outcomes are (is_success, status_ids) or (is_success, status_ids, rtt.)
+    # probe_samples are telemetry timings for the dealer's /metrics.
+    t = int(time.time())
+    statuses = []
+    for outcome in outcomes:
+        is_success, status_ids = outcome[:2]
+        rtt = outcome[2] if len(outcome) > 2 else None
+        statuses += outcome_statuses(status_ids, is_success, t, rtt)
+
+    params = {"statuses": statuses, "lease_id": lease_id}
+    if probe_samples:
+        params["telemetry"] = probe_samples
+
+    await retry_curl_on_locked(curl, params, "/complete")
+
+async def update_work_status(curl, status_ids, is_success, rtt=None):
+    # Indicate the status outcome.
+    t = int(time.time())
+    statuses = outcome_statuses(status_ids, is_success, t, rtt)
+
     if len(statuses):
         params = {"statuses": statuses}
         await retry_curl_on_locked(curl, params, "/complete")
@@ -242,7 +443,7 @@ async def validate_service_import(nic, pending_insert, service_monitor):
         )
     else:
         # Reuse the existing code for validation.
-        is_success = await service_monitor(nic, [pending_insert])
+        is_success, _ = await service_monitor(nic, [pending_insert])
         service_type = pending_insert["type"]
         if service_type in (MQTT_TYPE, NTP_TYPE, TURN_TYPE,):
             proto = UDP
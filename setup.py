@@ -12,6 +12,19 @@ with open(path.join(here, 'README.md'), encoding='utf-8') as f:
     long_description = f.read()
 
 install_reqs = ["fastapi"]
+extras_reqs = {
+    # Pre-compressed brotli variant of /servers.
+    "brotli": ["brotli"],
+
+    # Faster encoding for the dealer <-> worker RPC socket.
+    "msgpack": ["msgpack"],
+
+    # Columnar status store and vectorized scoring.
+    "numpy": ["numpy"],
+
+    # DNS answers with their TTLs for the alias resolver.
+    "dns": ["dnspython"],
+}
 
 setup(
     version='1.0.0',
@@ -29,6 +42,7 @@ setup(
     package_data={'p2pd': ['p2pd_server_monitor/monitor.sqlite3']},
     include_package_data=True,
     install_requires=install_reqs,
+    extras_require=extras_reqs,
     classifiers=[
         'Intended Audience :: Developers',
         'Programming Language :: Python :: 3'
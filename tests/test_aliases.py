@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+from p2pd import IP4, VALID_AFS, Interface
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.rpc import RPCServer, RPCClient
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dns_cache import DNSCache
+from p2pd_server_monitor.dealer.dealer_core import DEALER_CALLS, update_alias, shared_dns
+from p2pd_server_monitor.dealer.dealer_utils import allocate_work_lease
+from p2pd_server_monitor.dealer.dealer_defs import AliasUpdateReq
+from pydantic import ValidationError
+from p2pd_server_monitor.worker.alias_resolver import (
+    AliasResolver,
+    lookup_getaddrinfo,
+    resolve_alias_batch,
+)
+from test_stun_mux import LOOPBACK_INFO
+
+class FakeLookup:
+    def __init__(self, answers, delay=0):
+        self.answers = answers # fqn: [ip ...]
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.most_active = 0
+
+    async def __call__(self, fqn, af):
+        self.calls += 1
+        if fqn == "broken.example.com":
+            raise TimeoutError()
+
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        await asyncio.sleep(self.delay)
+        self.active -= 1
+        return self.answers.get(fqn, []), 60
+
+class TestBulkAliasUpdate(unittest.TestCase):
+    def setUp(self):
+        self.db = MemDB()
+
+    def lease_aliases(self, n):
+        now = int(time.time())
+        return allocate_work_lease(
+            self.db, VALID_AFS, (ALIASES_TABLE_TYPE,), now, MONITOR_FREQUENCY, n
+        )
+
+    def test_results_set_ips_and_complete_lease(self):
+        first = self.db.record_alias(IP4, "a.example.com")
+        second = self.db.record_alias(IP4, "b.example.com", ip="8.8.4.4")
+        third = self.db.record_alias(IP4, "c.example.com")
+        lease = self.lease_aliases(3)
+        assert(len(lease["groups"]) == 3)
+
+        # Current IP is kept while it's still an answer.
+        aliases = [
+            {"alias_id": first.id, "status_id": first.status_id, "ips": ["192.168.1.1", "8.8.8.8"]},
+            {"alias_id": second.id, "status_id": second.status_id, "ips": ["1.1.1.1", "8.8.4.4"]},
+        ]
+
+        out = update_alias(self.db, aliases=aliases, lease_id=lease["lease_id"])
+        assert(out == ["8.8.8.8", "8.8.4.4"])
+        assert(first.ip == "8.8.8.8")
+        assert(self.db.statuses[first.status_id].status == STATUS_AVAILABLE)
+        assert(self.db.statuses[first.status_id].test_no == 1)
+
+        # The alias without a result goes back out straight away.
+        lease = self.lease_aliases(3)
+        assert([g[0]["id"] for g in lease["groups"]] == [third.id])
+
+    def test_request_needs_one_form(self):
+        AliasUpdateReq(alias_id=1, ip="8.8.8.8")
+        AliasUpdateReq(aliases=[], lease_id=1)
+        bad = (
+            {},
+            {"alias_id": 1},
+            {"ip": "8.8.8.8", "current_time": 1},
+            {"alias_id": 1, "ip": "8.8.8.8", "aliases": []},
+        )
+        for params in bad:
+            with self.assertRaises(ValidationError):
+                AliasUpdateReq(**params)
+
+    def test_aliases_get_bigger_leases(self):
+        for i in range(MAX_LEASE_GROUPS + 10):
+            self.db.record_alias(IP4, "%d.example.com" % (i,))
+
+        lease = self.lease_aliases(MAX_LEASE_GROUPS + 10)
+        assert(len(lease["groups"]) == MAX_LEASE_GROUPS + 10)
+
+class TestAliasResolver(unittest.IsolatedAsyncioTestCase):
+    async def test_answers_are_cached_until_ttl(self):
+        lookup = FakeLookup({"a.example.com": ["8.8.8.8", "8.8.4.4"]})
+        resolver = AliasResolver(lookup=lookup)
+        for _ in range(3):
+            ips = await resolver.resolve("a.example.com", IP4)
+            assert(ips == ["8.8.8.8", "8.8.4.4"])
+
+        assert(lookup.calls == 1)
+
+        # Missing names are cached but failed lookups aren't.
+        for _ in range(2):
+            assert(await resolver.resolve("missing.example.com", IP4) == [])
+            assert(await resolver.resolve("broken.example.com", IP4) == [])
+
+        assert(lookup.calls == 4)
+        assert(resolver.cache.stats["negative_hit"] == 1)
+
+    async def test_lookups_in_flight_are_bounded(self):
+        lookup = FakeLookup({}, delay=0.01)
+        resolver = AliasResolver(lookup=lookup, concurrency=5)
+        aliases = [{"fqn": "%d.example.com" % (i,), "af": IP4, "table_type": ALIASES_TABLE_TYPE} for i in range(50)]
+        results = await resolver.resolve_many(aliases)
+        assert(len(results) == 50)
+        assert(lookup.most_active == 5)
+
+    async def test_getaddrinfo_returns_every_answer(self):
+        ips, ttl = await lookup_getaddrinfo("localhost", IP4)
+        assert("127.0.0.1" in ips)
+        assert(ttl == DNS_DEFAULT_TTL)
+
+class TestDNSCache(unittest.TestCase):
+    def test_expired_answers_are_dropped(self):
+        cache = DNSCache()
+        cache.put("a.example.com", IP4, ["8.8.8.8"], 60, now=100)
+        assert(cache.get("a.example.com", IP4, now=110) == (["8.8.8.8"], 50))
+        assert(cache.get("a.example.com", IP4, now=161) is None)
+        assert(cache.stats["expired"] == 1)
+
+    def test_ttls_are_clamped(self):
+        cache = DNSCache()
+        cache.put("a.example.com", IP4, ["8.8.8.8"], 1, now=0)
+        cache.put("b.example.com", IP4, [], DNS_MAX_TTL, now=0)
+        assert(cache.get("a.example.com", IP4, now=0)[1] == DNS_MIN_TTL)
+        assert(cache.get("b.example.com", IP4, now=0) == ([], DNS_NEGATIVE_TTL))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = DNSCache(capacity=2)
+        cache.put("a.example.com", IP4, ["8.8.8.8"], 60)
+        cache.put("b.example.com", IP4, ["8.8.4.4"], 60)
+        assert(cache.get("a.example.com", IP4) is not None)
+        cache.put("c.example.com", IP4, ["1.1.1.1"], 60)
+        assert(cache.get("b.example.com", IP4) is None)
+        assert(cache.get("a.example.com", IP4) is not None)
+        assert(cache.stats["evicted"] == 1)
+
+    def test_dealer_cache_is_shared(self):
+        db = MemDB()
+        db.dns_cache = DNSCache()
+        answers = [{"fqn": "a.example.com", "af": int(IP4), "ips": ["8.8.8.8"], "ttl": 60}]
+        names = [{"fqn": "a.example.com", "af": int(IP4)}, {"fqn": "b.example.com", "af": int(IP4)}]
+        out = shared_dns(db, names=names, answers=answers)
+        assert(out[0]["ips"] == ["8.8.8.8"] and 0 < out[0]["ttl"] <= 60)
+        assert(out[1] is None)
+
+class TestResolveBatch(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "dealer.sock")
+        self.db = MemDB()
+        self.db.dns_cache = DNSCache()
+        self.server = await RPCServer(DEALER_CALLS, self.db).start(self.path)
+        nic = Interface.from_dict(LOOPBACK_INFO)
+        self.client = RPCClient(nic.route(IP4), self.path)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+        self.tmp.cleanup()
+
+    async def test_whole_batch_in_one_round_trip(self):
+        answers = {}
+        for i in range(20):
+            self.db.record_alias(IP4, "%d.example.com" % (i,))
+            answers["%d.example.com" % (i,)] = ["8.8.8.%d" % (i + 1,)]
+
+        resolver = AliasResolver(lookup=FakeLookup(answers))
+        assert(await resolve_alias_batch(self.client, resolver) == 20)
+        for alias in self.db.records[ALIASES_TABLE_TYPE].values():
+            assert(alias.ip == answers[alias.fqn][0])
+
+        assert(await resolve_alias_batch(self.client, resolver) == NO_WORK)
+        assert(len(self.db.dns_cache) == 20)
+
+    async def test_other_workers_use_the_dealer_cache(self):
+        self.db.record_alias(IP4, "a.example.com")
+        self.db.dns_cache.put("a.example.com", IP4, ["8.8.8.8"], 60)
+        lookup = FakeLookup({})
+        resolver = AliasResolver(lookup=lookup)
+        assert(await resolve_alias_batch(self.client, resolver) == 1)
+        assert(lookup.calls == 0)
+        assert(self.db.records[ALIASES_TABLE_TYPE][1].ip == "8.8.8.8")
+
+if __name__ == '__main__':
+    unittest.main()
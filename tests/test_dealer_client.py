@@ -0,0 +1,82 @@
+import httpx
+import asyncio
+import unittest
+import unittest.mock
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.worker_utils import DealerClient, retry_curl_on_locked
+
+def make_client(handler):
+    client = DealerClient(None)
+    client.backoff_base = 0
+    client.client = httpx.AsyncClient(
+        base_url=DEALER_ENDPOINT,
+        transport=httpx.MockTransport(handler)
+    )
+
+    return client
+
+class TestDealerClient(unittest.IsolatedAsyncioTestCase):
+    async def test_post_returns_json(self):
+        seen = []
+        def handler(request):
+            seen.append((request.url.path, request.content))
+            return httpx.Response(200, json={"ok": 1})
+
+        client = make_client(handler)
+        out = await retry_curl_on_locked(client, {"a": 1}, "/work")
+        await client.close()
+        assert(out == {"ok": 1})
+        assert(seen == [("/work", b'{"a":1}')])
+
+    async def test_retries_errors_then_succeeds(self):
+        calls = []
+        def handler(request):
+            calls.append(1)
+            if len(calls) == 1:
+                raise httpx.ConnectError("down")
+            if len(calls) == 2:
+                return httpx.Response(503)
+
+            return httpx.Response(200, json=[])
+
+        client = make_client(handler)
+        out = await client.post("/work", {}, retries=3)
+        await client.close()
+        assert(out == [])
+        assert(len(calls) == 3)
+
+    async def test_gives_up_after_retries(self):
+        calls = []
+        def handler(request):
+            calls.append(1)
+            return httpx.Response(500)
+
+        # One backoff between the two tries, none after the last.
+        client = make_client(handler)
+        client.backoff_base = 1
+        sleeps = []
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        with unittest.mock.patch.object(asyncio, "sleep", sleep):
+            out = await client.post("/work", {}, retries=2)
+
+        await client.close()
+        assert(out is None)
+        assert(len(calls) == 2)
+        assert(len(sleeps) == 1)
+
+    async def test_curl_without_client_shares_one(self):
+        class Curl:
+            addr = ("127.0.0.1", 8123)
+            route = None
+
+        a = DealerClient.for_curl(Curl())
+        b = DealerClient.for_curl(Curl())
+        assert(a is b)
+        assert(a.endpoint == "http://127.0.0.1:8123")
+        del DealerClient.shared[a.endpoint]
+        await a.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import time
+import shutil
+import asyncio
+import threading
+import tempfile
+import unittest
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_journal import MemDBJournal, recover_mem_db
+from p2pd_server_monitor.dealer.dealer_utils import mark_complete
+
+def table_dicts(db):
+    return {
+        table_type: {k: v.dict() for k, v in db.tables[table_type].items()}
+        for table_type in PERSISTED_TABLE_TYPES
+    }
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmp_dir.name, "db.snapshot")
+        self.journal_path = os.path.join(self.tmp_dir.name, "db.journal")
+        self.db = MemDB()
+        self.journal = MemDBJournal(
+            self.db,
+            self.journal_path,
+            self.snapshot_path,
+            fsync=False
+        )
+        self.db.journal = self.journal
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    def insert_service(self, ip, alias_id=None):
+        record = self.db.insert_service(
+            STUN_MAP_TYPE, IP4, UDP, ip, 3478, None, None, alias_id
+        )
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+        return record
+
+    def complete(self, record):
+        self.db.work[SERVICES_TABLE_TYPE][IP4].move_work(
+            record.group_id,
+            STATUS_DEALT
+        )
+        mark_complete(self.db, 1, record.status_id, int(time.time()))
+
+    def recover(self):
+        db = MemDB()
+        recover_mem_db(db, self.snapshot_path, self.journal_path)
+        return db
+
+    def test_snapshot_plus_journal_matches_memory(self):
+        first = self.insert_service("8.8.8.8")
+        self.journal.snapshot()
+
+        # Changes after the snapshot only exist in the journal.
+        alias = self.db.record_alias(IP4, "stun.example.com", "8.8.4.4")
+        self.insert_service("8.8.4.4", alias.id)
+        self.complete(first)
+        assert(self.journal.flush())
+
+        db = self.recover()
+        assert(table_dicts(db) == table_dicts(self.db))
+        assert(set(db.groups) == set(self.db.groups))
+        assert(db.statuses[first.status_id].test_no == 1)
+        assert(db.get_id(SERVICES_TABLE_TYPE) > max(self.db.records[SERVICES_TABLE_TYPE]))
+
+    def test_torn_tail_is_ignored(self):
+        first = self.insert_service("8.8.8.8")
+        self.journal.snapshot()
+        self.complete(first)
+        self.journal.flush()
+
+        # Half written frame from a crash.
+        with open(self.journal_path, "ab") as fp:
+            fp.write(b"\x00\x00\x10\x00\x12\x34")
+
+        db = self.recover()
+        assert(db.statuses[first.status_id].test_no == 1)
+
+    def test_old_journal_is_not_replayed(self):
+        first = self.insert_service("8.8.8.8")
+        self.journal.snapshot()
+        self.complete(first)
+        self.journal.flush()
+        old_journal = self.journal_path + ".old"
+        shutil.copy(self.journal_path, old_journal)
+
+        # Crash after the new snapshot but before the journal reset.
+        self.db.statuses[first.status_id].test_no = 5
+        self.journal.snapshot()
+        shutil.copy(old_journal, self.journal_path)
+
+        db = self.recover()
+        assert(db.statuses[first.status_id].test_no == 5)
+
+    def test_snapshot_compacts_journal(self):
+        record = self.insert_service("8.8.8.8")
+        self.journal.snapshot()
+        empty_size = self.journal.size
+        for _ in range(3):
+            self.db.work[SERVICES_TABLE_TYPE][IP4].move_work(
+                record.group_id,
+                STATUS_DEALT
+            )
+            mark_complete(self.db, 0, record.status_id)
+            self.journal.flush()
+
+        assert(self.journal.size > empty_size)
+        self.journal.snapshot()
+        assert(self.journal.size == empty_size)
+        assert(os.path.getsize(self.journal_path) == empty_size)
+
+    def test_disk_work_runs_off_the_loop(self):
+        first = self.insert_service("8.8.8.8")
+        threads = []
+        write_entries = self.journal.write_entries
+        write_snapshot = self.journal.write_snapshot
+        def record_thread(write):
+            def wrapper(*args):
+                threads.append(threading.get_ident())
+                return write(*args)
+
+            return wrapper
+
+        self.journal.write_entries = record_thread(write_entries)
+        self.journal.write_snapshot = record_thread(write_snapshot)
+        async def save():
+            await self.journal.snapshot_in_executor()
+            self.complete(first)
+            return await self.journal.flush_in_executor()
+
+        assert(asyncio.run(save()) == 1)
+        assert(len(threads) == 2)
+        assert(threading.get_ident() not in threads)
+        assert(self.recover().statuses[first.status_id].test_no == 1)
+
+    def test_no_snapshot(self):
+        assert(recover_mem_db(MemDB(), self.snapshot_path, self.journal_path) is None)
+
+if __name__ == '__main__':
+    unittest.main()
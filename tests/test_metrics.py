@@ -0,0 +1,106 @@
+import time
+import asyncio
+import unittest
+from p2pd import IP4, VALID_AFS
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.metrics import Metrics, Histogram, serve_metrics
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dns_cache import DNSCache
+from p2pd_server_monitor.dealer.dealer_metrics import dealer_metrics
+from p2pd_server_monitor.dealer.dealer_core import get_work, work_done
+from p2pd_server_monitor.dealer.dealer_utils import allocate_work
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.db = MemDB()
+        self.db.metrics = dealer_metrics(self.db)
+
+    def insert_service(self, ip):
+        record = self.db.insert_service(STUN_MAP_TYPE, IP4, UDP, ip, 3478, None, None, None)
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+        return record
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        assert(histogram.cumulative() == [(1, 2), (5, 3), ("+Inf", 4)])
+        assert(histogram.sum == 14.5)
+
+    def test_render_text_format(self):
+        metrics = Metrics()
+        metrics.describe("jobs_total", "counter", "Jobs.", ("kind",))
+        metrics.inc("jobs_total", ("a",))
+        metrics.inc("jobs_total", ("a",), 2)
+        text = metrics.render()
+        assert("# TYPE jobs_total counter" in text)
+        assert('jobs_total{kind="a"} 3' in text)
+
+    def test_worker_timeouts_count_as_reallocations(self):
+        self.insert_service("8.8.8.8")
+        now = int(time.time())
+        allocate_work(self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY)
+        allocate_work(self.db, VALID_AFS, TABLE_TYPES, now + WORKER_TIMEOUT + 1, MONITOR_FREQUENCY)
+        assert(self.db.metrics.get("dealer_work_reallocated_total", ("services",)) == 1)
+        assert(self.db.metrics.get("dealer_allocate_scanned").count == 2)
+
+    def test_calls_are_timed(self):
+        self.insert_service("8.8.8.8")
+        get_work(self.db, max_groups=1)
+        histogram = self.db.metrics.get("dealer_call_seconds", ("work",))
+        assert(histogram.count == 1)
+
+    def test_queue_depth_and_overdue_lag(self):
+        record = self.insert_service("8.8.8.8")
+        wq = self.db.work[SERVICES_TABLE_TYPE][IP4]
+        wq.move_work(record.group_id, STATUS_AVAILABLE, delay=-30)
+
+        text = self.db.metrics.render()
+        assert('dealer_queue_depth{table="services",af="IPv4",status="Available"} 1' in text)
+        overdue = self.db.metrics.get("dealer_overdue_seconds", ("services", "IPv4"))
+        assert(29 <= overdue <= 31)
+
+    def test_worker_probe_timings_are_folded_in(self):
+        telemetry = [
+            ["STUN(see_ip)", "IPv4", "UDP", {"first_reply": 0.02, "total": 0.03}],
+            ["made up", "IPv4", "UDP", {"total": 1}],
+            ["NTP", "IPv4", "UDP", {"not a phase": 1}],
+        ]
+
+        work_done(self.db, [], telemetry=telemetry)
+        labels = ("STUN(see_ip)", "IPv4", "UDP", "total")
+        assert(self.db.metrics.get("worker_probe_seconds", labels).count == 1)
+        assert(len(self.db.metrics.metrics["worker_probe_seconds"].values) == 2)
+
+    def test_dns_cache_hits_and_misses(self):
+        self.db.dns_cache = DNSCache()
+        self.db.dns_cache.put("a.example.com", IP4, ["8.8.8.8"], 60)
+        self.db.dns_cache.get("a.example.com", IP4)
+        self.db.dns_cache.get("b.example.com", IP4)
+
+        text = self.db.metrics.render()
+        assert('dns_cache_total{cache="dealer",result="hit"} 1' in text)
+        assert('dns_cache_total{cache="dealer",result="miss"} 1' in text)
+        assert('dns_cache_entries{cache="dealer"} 1' in text)
+
+class TestServeMetrics(unittest.IsolatedAsyncioTestCase):
+    async def test_get_returns_metrics(self):
+        metrics = Metrics()
+        metrics.describe("up", "gauge", "Up.")
+        metrics.set("up", 1)
+        server = await serve_metrics(metrics, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+            resp = await asyncio.wait_for(reader.read(), 2)
+            writer.close()
+        finally:
+            server.close()
+
+        assert(resp.startswith(b"HTTP/1.1 200 OK"))
+        assert(resp.endswith(b"\nup 1\n"))
+
+if __name__ == '__main__':
+    unittest.main()
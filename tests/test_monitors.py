@@ -0,0 +1,133 @@
+import sys
+import time
+import asyncio
+import unittest
+import unittest.mock
+from p2pd import IP4, UDP, ErrorNoReply
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.udp_mux import NTPMux, UDPMux
+from p2pd_server_monitor.worker.worker_monitors import MonitorProbe, monitor_ntp_type, service_monitor
+from p2pd_server_monitor.worker.worker_metrics import ProbeTimings, telemetry
+from p2pd_server_monitor.worker.worker import worker
+
+worker_module = sys.modules["p2pd_server_monitor.worker.worker"]
+worker_monitors = sys.modules["p2pd_server_monitor.worker.worker_monitors"]
+
+class NTPEcho(asyncio.DatagramProtocol):
+    # Just enough NTP: mode 4 with the client's transmit as originate.
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = bytearray(48)
+        reply[0] = (3 << 3) | 4
+        reply[24:32] = data[40:48]
+        self.transport.sendto(bytes(reply), addr)
+
+class ClosingProbe(MonitorProbe):
+    closed = 0
+
+    async def run(self):
+        raise ValueError("probe failed")
+
+    async def close(self):
+        ClosingProbe.closed += 1
+
+class TestMonitors(unittest.IsolatedAsyncioTestCase):
+    async def test_ntp_probes_share_sockets(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            NTPEcho,
+            local_addr=("127.0.0.1", 0)
+        )
+
+        port = transport.get_extra_info("sockname")[1]
+        work = [{"type": NTP_TYPE, "af": IP4, "proto": UDP, "ip": "127.0.0.1", "port": port}]
+        try:
+            results = await asyncio.gather(*[
+                monitor_ntp_type(None, work) for _ in range(200)
+            ])
+
+            assert(results == [1] * 200)
+            assert(NTPMux.for_nic(None).fd_count() == UDP_MUX_SOCKETS)
+        finally:
+            await UDPMux.close_all(None)
+            transport.close()
+
+    async def test_probe_marks_first_reply(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            NTPEcho,
+            local_addr=("127.0.0.1", 0)
+        )
+
+        port = transport.get_extra_info("sockname")[1]
+        work = [{"type": NTP_TYPE, "af": IP4, "proto": UDP, "ip": "127.0.0.1", "port": port}]
+        timings = ProbeTimings()
+        try:
+            assert(await monitor_ntp_type(None, work, timings) == 1)
+            assert(list(timings.phases) == ["first_reply"])
+        finally:
+            await UDPMux.close_all(None)
+            transport.close()
+
+    async def test_rtt_is_latency_not_probe_time(self):
+        # Replies fast then spends a while tearing down.
+        async def slow_teardown(nic, work, timings):
+            timings.reply(time.perf_counter())
+            await asyncio.sleep(0.2)
+            return 1
+
+        work = [{"type": NTP_TYPE, "af": IP4, "proto": UDP, "ip": "127.0.0.1", "port": 123}]
+        with unittest.mock.patch.object(worker_monitors, "monitor_ntp_type", slow_teardown):
+            is_success, rtt = await service_monitor(None, work)
+
+        assert(is_success == 1)
+        assert(0 <= rtt < 100)
+
+    async def test_ntp_rtt_skips_failed_attempts(self):
+        # First request goes unanswered.
+        class FlakyMux:
+            calls = 0
+            async def request(self, af, dest, version=3):
+                FlakyMux.calls += 1
+                if FlakyMux.calls == 1:
+                    await asyncio.sleep(0.2)
+                    raise ErrorNoReply("timeout")
+
+        work = [{"type": NTP_TYPE, "af": IP4, "proto": UDP, "ip": "127.0.0.1", "port": 123}]
+        timings = ProbeTimings()
+        with unittest.mock.patch.object(NTPMux, "for_nic", lambda nic: FlakyMux()):
+            assert(await monitor_ntp_type(None, work, timings) == 1)
+
+        assert(timings.phases["first_reply"] >= 0.2)
+        assert(timings.latency() < 0.1)
+
+    async def test_raising_probe_is_counted(self):
+        async def broken_monitor(nic, work, timings):
+            raise ValueError("probe failed")
+
+        work = [{
+            "type": NTP_TYPE, "af": IP4, "proto": UDP, "ip": "127.0.0.1",
+            "port": 123, "status_id": 1, "table_type": SERVICES_TABLE_TYPE
+        }]
+
+        labels = ("NTP", "IPv4", "UDP")
+        before = telemetry.metrics.get("worker_probes_total", labels + ("failed",))
+        with unittest.mock.patch.object(worker_module, "service_monitor", broken_monitor):
+            assert(await worker(None, None, init_work=work) == (0, [1], None))
+
+        after = telemetry.metrics.get("worker_probes_total", labels + ("failed",))
+        assert(after == (before or 0) + 1)
+        samples = telemetry.metrics.get("worker_probe_seconds", labels + ("total",))
+        assert(samples.count)
+
+    async def test_probe_is_closed_on_failure(self):
+        with self.assertRaises(ValueError):
+            async with ClosingProbe(None, []) as probe:
+                await probe.run()
+
+        assert(ClosingProbe.closed == 1)
+
+if __name__ == '__main__':
+    unittest.main()
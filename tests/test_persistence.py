@@ -0,0 +1,290 @@
+import os
+import gc
+import sys
+import time
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+import aiosqlite
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_defs import MEM_DB_ENUMS
+from p2pd_server_monitor.db.mem_db_journal import MemDBJournal, recover_mem_db
+from p2pd_server_monitor.db.mem_db_utils import sqlite_flush, sqlite_import, sqlite_export, migrate_db
+from p2pd_server_monitor.dealer.dealer_core import get_work
+from p2pd_server_monitor.dealer.dealer import save_all
+from p2pd_server_monitor.dealer.dealer_utils import mark_complete
+
+mem_db_utils = sys.modules["p2pd_server_monitor.db.mem_db_utils"]
+dealer = sys.modules["p2pd_server_monitor.dealer.dealer"]
+
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "p2pd_server_monitor",
+    "db",
+    "monitor.sqlite3.sql"
+)
+
+class TestPersistence(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitor.sqlite3")
+        self.sqlite_db = await aiosqlite.connect(self.db_path)
+        with open(SCHEMA_PATH) as f:
+            await self.sqlite_db.executescript(f.read())
+
+        self.db = MemDB()
+
+    async def asyncTearDown(self):
+        await self.sqlite_db.close()
+        self.tmp_dir.cleanup()
+
+    async def flush(self):
+        await sqlite_flush(self.db, self.sqlite_db)
+        await self.sqlite_db.commit()
+
+    async def fetch_all(self, sql, params=()):
+        async with self.sqlite_db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    def insert_service(self, ip):
+        record = self.db.insert_service(
+            STUN_MAP_TYPE, IP4, UDP, ip, 3478, None, None, None
+        )
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+        return record
+
+    async def test_inserts_are_flushed(self):
+        record = self.insert_service("8.8.8.8")
+        await self.flush()
+
+        rows = await self.fetch_all("SELECT id, ip, group_id FROM services")
+        assert(rows == [(record.id, "8.8.8.8", record.group_id)])
+        rows = await self.fetch_all("SELECT id FROM status")
+        assert(rows == [(record.status_id,)])
+
+    async def test_only_changed_rows_are_flushed(self):
+        first = self.insert_service("8.8.8.8")
+        second = self.insert_service("8.8.4.4")
+        await self.flush()
+        for table_type in PERSISTED_TABLE_TYPES:
+            assert(not self.db.dirty[table_type])
+
+        # Work has to be dealt before it can complete.
+        self.db.work[SERVICES_TABLE_TYPE][IP4].move_work(
+            second.group_id,
+            STATUS_DEALT
+        )
+
+        t = int(time.time())
+        mark_complete(self.db, 1, second.status_id, t)
+        assert(self.db.dirty[STATUS_TABLE_TYPE] == {second.status_id})
+        await self.flush()
+
+        rows = await self.fetch_all(
+            "SELECT id, test_no FROM status ORDER BY id"
+        )
+        assert(rows == [(first.status_id, 0), (second.status_id, 1)])
+
+    async def test_deleted_rows_are_removed(self):
+        record = self.insert_service("8.8.8.8")
+        await self.flush()
+
+        self.db.mark_deleted(SERVICES_TABLE_TYPE, record.id)
+        await self.flush()
+        rows = await self.fetch_all("SELECT id FROM services")
+        assert(not len(rows))
+
+    async def test_failed_flush_keeps_changes(self):
+        record = self.insert_service("8.8.8.8")
+        await self.sqlite_db.execute("DROP TABLE status")
+        try:
+            await self.flush()
+            assert(0)
+        except Exception:
+            pass
+
+        assert(record.status_id in self.db.dirty[STATUS_TABLE_TYPE])
+
+    async def test_failed_commit_keeps_changes(self):
+        record = self.insert_service("8.8.8.8")
+        async def broken_commit(sqlite_db):
+            raise sqlite3.OperationalError("database is locked")
+
+        with unittest.mock.patch.object(aiosqlite.Connection, "commit", broken_commit):
+            with self.assertRaises(sqlite3.OperationalError):
+                await save_all(self.db, self.db_path)
+
+        assert(record.status_id in self.db.dirty[STATUS_TABLE_TYPE])
+        await save_all(self.db, self.db_path)
+        rows = await self.fetch_all("SELECT id FROM services")
+        assert(rows == [(record.id,)])
+
+    async def test_journal_recovery_reaches_sqlite(self):
+        snapshot_path = os.path.join(self.tmp_dir.name, "db.snapshot")
+        journal_path = os.path.join(self.tmp_dir.name, "db.journal")
+        self.db.journal = MemDBJournal(self.db, journal_path, snapshot_path, fsync=False)
+        record = self.insert_service("8.8.8.8")
+        self.db.journal.snapshot()
+        await self.flush()
+
+        # Crash after the journal flush but before the SQLite flush.
+        self.db.work[SERVICES_TABLE_TYPE][IP4].move_work(record.group_id, STATUS_DEALT)
+        mark_complete(self.db, 1, record.status_id, int(time.time()))
+        alias = self.db.record_alias(IP4, "stun.example.com", "8.8.4.4")
+        assert(self.db.journal.flush())
+        self.db.journal.close()
+
+        self.db = MemDB()
+        recover_mem_db(self.db, snapshot_path, journal_path)
+        await self.flush()
+        rows = await self.fetch_all(
+            "SELECT test_no FROM status WHERE id = ?",
+            (record.status_id,)
+        )
+        assert(rows == [(1,)])
+        rows = await self.fetch_all("SELECT ip FROM aliases WHERE id = ?", (alias.id,))
+        assert(rows == [("8.8.4.4",)])
+
+    async def test_export_writes_every_table(self):
+        self.insert_service("8.8.8.8")
+        alias = self.db.record_alias(IP4, "stun.example.com", "8.8.4.4")
+        record = self.db.insert_import(STUN_MAP_TYPE, IP4, "8.8.4.4", 3478)
+        self.db.add_work(IP4, IMPORTS_TABLE_TYPE, [record])
+
+        await sqlite_export(self.db, self.sqlite_db)
+        await self.sqlite_db.commit()
+        for table_type in PERSISTED_TABLE_TYPES:
+            table = MEM_DB_ENUMS[table_type]
+            rows = await self.fetch_all(f"SELECT COUNT(*) FROM {table}")
+            assert(len(self.db.tables[table_type]))
+            assert(rows == [(len(self.db.tables[table_type]),)])
+
+    async def test_import_restores_everything(self):
+        plain = self.insert_service("8.8.8.8")
+        alias = self.db.record_alias(IP4, "stun.example.com", "8.8.4.4")
+        aliased = self.db.insert_service(
+            STUN_MAP_TYPE, IP4, UDP, "8.8.4.4", 3478, None, None, alias.id
+        )
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [aliased])
+        await self.flush()
+
+        db = MemDB()
+        await sqlite_import(db, self.db_path)
+        assert(db.loaded == set(TABLE_TYPES))
+        assert("first_work" in db.load_stats)
+
+        # Records link back to their statuses, aliases and groups.
+        for record in (plain, aliased):
+            loaded = db.records[SERVICES_TABLE_TYPE][record.id]
+            assert(loaded.dict() == record.dict())
+            assert(loaded.status_id in db.statuses)
+            assert(db.groups[record.group_id].group == [loaded])
+
+        assert(db.records_by_aliases[alias.id][0].id == aliased.id)
+        assert(db.aliases_by_ip["8.8.4.4"][0].id == alias.id)
+
+        # New ids carry on after the loaded ones.
+        assert(db.get_id(SERVICES_TABLE_TYPE) > aliased.id)
+        assert(db.get_id(GROUPS_TABLE_TYPE) > aliased.group_id)
+
+        # Every group is back in its work queue.
+        wq = db.work[SERVICES_TABLE_TYPE][IP4]
+        assert(set(wq.index) == {plain.group_id, aliased.group_id})
+        assert(not any(db.dirty.values()))
+
+    async def test_old_db_gets_new_status_columns(self):
+        # A status table from before the EWMA columns existed.
+        old_path = os.path.join(self.tmp_dir.name, "old.sqlite3")
+        with open(SCHEMA_PATH) as f:
+            schema = f.read()
+
+        schema = "".join(
+            line for line in schema.splitlines(True)
+            if "_ewma" not in line
+        )
+
+        async with aiosqlite.connect(old_path) as old_db:
+            await old_db.executescript(schema)
+
+        added = await migrate_db(old_path)
+        assert(added == [("status", "success_ewma"), ("status", "rtt_ewma")])
+        assert(await migrate_db(old_path) == [])
+
+        record = self.insert_service("8.8.8.8")
+        status = self.db.statuses[record.status_id]
+        status.success_ewma = 0.5
+        status.rtt_ewma = 0.25
+        async with aiosqlite.connect(old_path) as old_db:
+            await sqlite_flush(self.db, old_db)
+            await old_db.commit()
+
+        db = MemDB()
+        await sqlite_import(db, old_path)
+        loaded = db.statuses[record.status_id]
+        assert(loaded.success_ewma == 0.5)
+        assert(loaded.rtt_ewma == 0.25)
+
+    async def test_rows_are_frozen_after_first_good_load(self):
+        gc.unfreeze()
+        mem_db_utils.rows_frozen = False
+
+        async def broken_import(*args):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        with unittest.mock.patch.object(mem_db_utils, "import_tables", broken_import):
+            with self.assertRaises(sqlite3.OperationalError):
+                await sqlite_import(MemDB(), self.db_path)
+
+        assert(not mem_db_utils.rows_frozen)
+        assert(not gc.get_freeze_count())
+
+        self.insert_service("8.8.8.8")
+        await self.flush()
+        await sqlite_import(MemDB(), self.db_path)
+        assert(mem_db_utils.rows_frozen)
+        assert(gc.get_freeze_count())
+
+    async def test_work_waits_for_tables_to_load(self):
+        self.insert_service("8.8.8.8")
+        self.db.loaded = set()
+        with self.assertRaises(DealerLoadingError):
+            get_work(self.db, stack_type=IP4)
+
+        # Services are enough to hand out service work.
+        self.db.loaded = {SERVICES_TABLE_TYPE}
+        assert(len(get_work(self.db, stack_type=IP4)))
+
+    async def test_failed_import_is_not_served_as_loaded(self):
+        async def half_import(mem_db):
+            mem_db.loaded = {SERVICES_TABLE_TYPE}
+            raise sqlite3.OperationalError("disk I/O error")
+
+        async def no_migrate():
+            pass
+
+        mem_db = dealer.make_mem_db()
+        insert_main = unittest.mock.Mock()
+        start_journal = unittest.mock.AsyncMock()
+        with unittest.mock.patch.multiple(
+            dealer,
+            mem_db=mem_db,
+            migrate_db=no_migrate,
+            recover_mem_db=lambda mem_db: None,
+            sqlite_import=half_import,
+            insert_main=insert_main,
+            start_journal=start_journal
+        ):
+            await dealer.load_db()
+
+        # No CSV merge or snapshot over a partial DB.
+        assert(mem_db.loaded == {SERVICES_TABLE_TYPE})
+        assert(not insert_main.called)
+        assert(not start_journal.called)
+        assert(mem_db.metrics.get("dealer_load_failed_total") == 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -481,7 +481,7 @@ class TestProject(unittest.IsolatedAsyncioTestCase):
 
 
     async def test_worker_loop_exception_should_continue(self):
-        is_success, _ = await worker(self.nic, None)
+        is_success, _, _ = await worker(self.nic, None)
         assert(not is_success)
 
     async def test_status_should_be_created_on_new_alias(self):
@@ -665,7 +665,7 @@ class TestProject(unittest.IsolatedAsyncioTestCase):
         nic = await Interface()
         route = nic.route(IP4)
         curl = WebCurl(("8.8.8.8", 80,), route)
-        is_success, status_ids = await worker(nic, curl, init_work=[alias_work])
+        is_success, status_ids, _ = await worker(nic, curl, init_work=[alias_work])
 
         status_ids = [k for k in db.statuses]
 
@@ -0,0 +1,60 @@
+import unittest
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_defs import Record, RecordType, Status
+
+class TestRecords(unittest.TestCase):
+    def test_records_are_slotted(self):
+        mem_db = MemDB()
+        record = mem_db.insert_service(
+            STUN_MAP_TYPE, int(IP4), int(UDP), "8.8.8.8", 3478, None, None, None
+        )
+
+        assert(isinstance(record, Record))
+        assert(not hasattr(record, "__dict__"))
+        assert(isinstance(mem_db.statuses[record.status_id], Status))
+        with self.assertRaises(AttributeError):
+            record.not_a_field = 1
+
+    def test_dict_matches_model(self):
+        mem_db = MemDB()
+        record = mem_db.insert_service(
+            STUN_MAP_TYPE, int(IP4), int(UDP), "8.8.8.8", 3478, None, None, None
+        )
+
+        model = record.to_model()
+        assert(isinstance(model, RecordType))
+        assert(model.dict() == record.dict())
+        assert(Record.from_model(model).dict() == record.dict())
+
+        group = mem_db.add_work(int(IP4), SERVICES_TABLE_TYPE, [record])
+        assert(group.to_model().group[0].id == record.id)
+
+    def test_inserts_are_still_validated(self):
+        mem_db = MemDB()
+        with self.assertRaises(ValueError):
+            mem_db.insert_service(
+                STUN_MAP_TYPE, int(IP4), int(UDP), "8.8.8.8", 0, None, None, None
+            )
+
+        with self.assertRaises(ValueError):
+            mem_db.insert_service(
+                99, int(IP4), int(UDP), "8.8.8.8", 3478, None, None, None
+            )
+
+    def test_validated_coerces_like_the_model(self):
+        record = Record.validated(
+            id=1,
+            table_type=SERVICES_TABLE_TYPE,
+            type=STUN_MAP_TYPE,
+            af=int(IP4),
+            ip="8.8.8.8",
+            port="3478"
+        )
+
+        assert(record.port == 3478)
+        assert(record.score == 0)
+
+if __name__ == '__main__':
+    unittest.main()
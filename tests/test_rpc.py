@@ -0,0 +1,107 @@
+import os
+import asyncio
+import tempfile
+import unittest
+import unittest.mock
+from p2pd import DUEL_STACK
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.rpc import RPCServer, RPCClient, RPCError, RPC_HEADER, RPC_JSON, rpc_encode, rpc_decode, rpc_read
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dealer.dealer_core import DEALER_CALLS
+
+def echo(mem_db, **params):
+    return params
+
+def fail(mem_db):
+    raise KeyError("nope")
+
+class TestRPC(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "dealer.sock")
+        calls = {"echo": echo, "fail": fail}
+        calls.update(DEALER_CALLS)
+        self.server = await RPCServer(calls, MemDB()).start(self.path)
+        self.client = RPCClient(None, self.path)
+        self.client.backoff_base = 0
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+        self.tmp.cleanup()
+
+    async def test_round_trip(self):
+        out = await self.client.call("echo", {"a": [1, "x"], "b": None})
+        assert(out == {"a": [1, "x"], "b": None})
+
+    async def test_many_calls_in_flight(self):
+        tasks = [self.client.call("echo", {"n": n}) for n in range(100)]
+        outs = await asyncio.gather(*tasks)
+        assert([o["n"] for o in outs] == list(range(100)))
+
+    async def test_errors_are_returned(self):
+        with self.assertRaises(RPCError):
+            await self.client.call("fail")
+
+        with self.assertRaises(RPCError):
+            await self.client.call("missing")
+
+        # Connection is still usable.
+        assert(await self.client.call("echo", {}) == {})
+
+    async def test_malformed_frames_get_an_error(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            for request in ({"a": 1}, [1, "echo"], 5, [2, "echo", [1]]):
+                writer.write(rpc_encode(request, RPC_JSON))
+                _, reply = await rpc_read(reader)
+                assert(reply[1] == 0)
+
+            # Connection is still usable.
+            writer.write(rpc_encode([3, "echo", {}], RPC_JSON))
+            _, reply = await rpc_read(reader)
+            assert(reply == [3, 1, {}])
+        finally:
+            writer.close()
+
+    async def test_post_matches_http_paths(self):
+        params = {
+            "stack_type": DUEL_STACK,
+            "table_type": None,
+            "current_time": None,
+            "monitor_frequency": None,
+        }
+
+        # Empty DB so no work.
+        assert(await self.client.post("/work", params) == [])
+        assert(await self.client.post("/complete", {"statuses": []}) == [])
+
+    async def test_reconnects_after_server_restart(self):
+        assert(await self.client.call("echo", {"x": 1}) == {"x": 1})
+        await self.server.close()
+        await asyncio.sleep(0.05)
+        self.server = await RPCServer({"echo": echo}, None).start(self.path)
+        out = await self.client.post("/echo", {"x": 2}, retries=3)
+        assert(out == {"x": 2})
+
+    async def test_post_gives_up_without_sleeping(self):
+        sleeps = []
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        self.client.backoff_base = 1
+        with unittest.mock.patch.object(asyncio, "sleep", sleep):
+            assert(await self.client.post("/fail", {}, retries=2) is None)
+
+        assert(len(sleeps) == 1)
+
+    def test_frame_codec(self):
+        frame = rpc_encode([1, "work", {"a": 1}], RPC_JSON)
+        size, codec = RPC_HEADER.unpack(frame[:RPC_HEADER.size])
+        assert(codec == RPC_JSON)
+        assert(size == len(frame) - RPC_HEADER.size)
+        body = frame[RPC_HEADER.size:]
+        assert(rpc_decode(codec, body) == [1, "work", {"a": 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import time
+import unittest
+from p2pd import IP4, VALID_AFS
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.mem_db_defs import Status
+from p2pd_server_monitor.dealer.scheduling import monitor_interval, ProbeBudget
+from p2pd_server_monitor.dealer.dealer_utils import (
+    allocate_work,
+    allocate_work_lease,
+    mark_complete,
+)
+
+def make_status(test_no, success_ewma):
+    return Status(
+        1, 1, SERVICES_TABLE_TYPE, STATUS_AVAILABLE, 0,
+        test_no, 0, 0, 0, 0, 0, success_ewma
+    )
+
+class TestScheduling(unittest.TestCase):
+    def setUp(self):
+        self.db = MemDB()
+
+    def insert_service(self, ip):
+        record = self.db.insert_service(STUN_MAP_TYPE, IP4, UDP, ip, 3478, None, None, None)
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+        return record
+
+    def due_in(self, record):
+        wq = self.db.work[SERVICES_TABLE_TYPE][IP4]
+        return wq.entries[record.group_id][0] - wq.timestamps[record.group_id]
+
+    def test_interval_bounds(self):
+        assert(monitor_interval(make_status(1, 1.0)) == MIN_MONITOR_INTERVAL)
+        assert(monitor_interval(make_status(STABLE_TEST_NO, 1.0)) == MAX_MONITOR_INTERVAL)
+        assert(monitor_interval(make_status(STABLE_TEST_NO, 0.0)) == MAX_MONITOR_INTERVAL)
+        assert(monitor_interval(make_status(STABLE_TEST_NO, 0.5)) == MIN_MONITOR_INTERVAL)
+        assert(monitor_interval(make_status(STABLE_TEST_NO, 1.0), changed=True) == MIN_MONITOR_INTERVAL)
+
+        # Grows with the number of tests.
+        short = monitor_interval(make_status(NEW_SERVICE_TEST_NO, 1.0))
+        longer = monitor_interval(make_status(STABLE_TEST_NO // 2, 1.0))
+        assert(MIN_MONITOR_INTERVAL < short < longer < MAX_MONITOR_INTERVAL)
+
+    def test_stable_services_are_checked_less(self):
+        record = self.insert_service("8.8.8.8")
+        now = int(time.time())
+        for n in range(STABLE_TEST_NO):
+            allocate_work(self.db, VALID_AFS, TABLE_TYPES, now + MAX_MONITOR_INTERVAL * n, MONITOR_FREQUENCY)
+            mark_complete(self.db, 1, record.status_id, t=now + n)
+            if n == 0:
+                assert(self.due_in(record) == MIN_MONITOR_INTERVAL)
+
+        assert(self.due_in(record) > MONITOR_FREQUENCY)
+
+        # A failure after a long run of passes is rechecked soon.
+        allocate_work(self.db, VALID_AFS, TABLE_TYPES, now + MAX_MONITOR_INTERVAL * 100, MONITOR_FREQUENCY)
+        mark_complete(self.db, 0, record.status_id)
+        assert(self.due_in(record) == MIN_MONITOR_INTERVAL)
+
+    def test_budget_limits_groups_dealt(self):
+        for i in range(10):
+            self.insert_service("8.8.8.%d" % (i + 1))
+
+        self.db.probe_budget = ProbeBudget(2, burst=3)
+        now = int(time.time())
+        lease = allocate_work_lease(self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 10)
+        assert(len(lease["groups"]) == 3)
+
+        lease = allocate_work_lease(self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 10)
+        assert(lease["groups"] == [])
+        assert(0 < lease["retry_after"] <= 0.5)
+
+    def test_unused_budget_is_given_back(self):
+        self.insert_service("8.8.8.8")
+        self.db.probe_budget = ProbeBudget(1, burst=5)
+        now = int(time.time())
+        lease = allocate_work_lease(self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 5)
+        assert(len(lease["groups"]) == 1)
+        assert(self.db.probe_budget.tokens >= 4)
+
+if __name__ == '__main__':
+    unittest.main()
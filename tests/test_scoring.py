@@ -0,0 +1,170 @@
+import sys
+import random
+import unittest
+import unittest.mock
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dealer.dealer_utils import compute_service_score, build_server_list, mark_complete
+from p2pd_server_monitor.dealer.scoring import compute_service_scores, group_score_averages, score_groups, score_statuses, np
+from p2pd_server_monitor.dealer.server_list import ServerList
+from p2pd_server_monitor.dealer.scoring import get_scorer, LatencyScorer, UptimeScorer
+from p2pd_server_monitor.worker.worker_utils import outcome_statuses
+
+dealer_utils = sys.modules["p2pd_server_monitor.dealer.dealer_utils"]
+
+def random_status(rand):
+    test_no = rand.choice([0, 1, 2, 49, 50, 51, 1000, rand.randrange(0, 10 ** 6)])
+    max_uptime = rand.choice([0, rand.randrange(0, 10 ** 9)])
+    return {
+        "test_no": test_no,
+        "failed_tests": rand.randrange(-1, test_no + 2),
+        "uptime": rand.choice([-5, 0, rand.randrange(0, 10 ** 9), max_uptime]),
+        "max_uptime": max_uptime,
+    }
+
+@unittest.skipUnless(np is not None, "needs numpy")
+class TestScoring(unittest.TestCase):
+    def test_matches_scalar_exactly(self):
+        rand = random.Random(1)
+        statuses = [random_status(rand) for _ in range(20000)]
+        scores = compute_service_scores(
+            [s["test_no"] for s in statuses],
+            [s["failed_tests"] for s in statuses],
+            [s["uptime"] for s in statuses],
+            [s["max_uptime"] for s in statuses]
+        )
+
+        for status, score in zip(statuses, scores.tolist()):
+            assert(score == compute_service_score(status))
+
+    def test_group_averages_match_sum(self):
+        rand = random.Random(2)
+        scores = [rand.random() for _ in range(1000)]
+        group_index = [rand.randrange(0, 300) for _ in scores]
+        averages = group_score_averages(scores, group_index, 301)
+
+        for group in range(301):
+            members = [s for s, g in zip(scores, group_index) if g == group]
+            expected = sum(members) / len(members) if members else 0.0
+            assert(averages[group] == expected)
+
+    def test_server_list_is_unchanged(self):
+        db = MemDB()
+        rand = random.Random(3)
+        i = 0
+        while i < 400:
+            # Groups of 1 - 4 members so averages are exercised.
+            records = []
+            for _ in range(rand.randrange(1, 5)):
+                i += 1
+                records.append(db.insert_service(
+                    STUN_MAP_TYPE, IP4, UDP, "8.8.%d.%d" % (i // 250, i % 250 + 1), 3478, None, None, None
+                ))
+
+            db.add_work(IP4, SERVICES_TABLE_TYPE, records)
+            for record in records:
+                status = db.statuses[record.status_id]
+                values = random_status(rand)
+                status.test_no = values["test_no"]
+                status.failed_tests = max(values["failed_tests"], 0)
+                status.max_uptime = values["max_uptime"]
+                status.uptime = min(max(values["uptime"], 0), status.max_uptime)
+
+        status_ids = list(db.statuses)
+        scores = score_statuses(db, status_ids)
+        for status_id in status_ids:
+            status = db.statuses[status_id].dict()
+            assert(scores[status_id] == compute_service_score(status))
+
+        status_scores, group_scores = score_groups(db, db.groups)
+        assert(status_scores == scores)
+        for group_id, meta_group in db.groups.items():
+            members = [scores[r.status_id] for r in meta_group.group]
+            assert(group_scores[group_id] == sum(members) / len(members))
+
+        # Same document as scoring one at a time.
+        batched = build_server_list(db)
+        with unittest.mock.patch.object(dealer_utils, "score_groups", lambda *a: ({}, {})):
+            scalar = build_server_list(db)
+
+        batched.pop("timestamp")
+        scalar.pop("timestamp")
+        assert(scalar == batched)
+
+        # A rebuild goes through the batched path too.
+        assert(len(db.groups) >= SCORE_BATCH_MIN)
+        server_list = ServerList(db)
+        server_list.rebuild()
+        incremental = server_list.as_dict()
+        incremental.pop("timestamp", None)
+        assert(incremental == scalar)
+
+def service_db(n=1):
+    db = MemDB()
+    for i in range(1, n + 1):
+        record = db.insert_service(
+            STUN_MAP_TYPE, IP4, UDP, "8.8.%d.%d" % (i // 250, i % 250 + 1), 3478, None, None, None
+        )
+        db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+
+    return db
+
+class TestScorers(unittest.TestCase):
+    def test_get_scorer(self):
+        assert(isinstance(get_scorer(), UptimeScorer))
+        assert(isinstance(get_scorer("latency"), LatencyScorer))
+        with self.assertRaises(ValueError):
+            get_scorer("nope")
+
+    def test_success_ewma_decays_with_time(self):
+        db = service_db()
+        status_id = list(db.statuses)[0]
+        status = db.statuses[status_id]
+        t = 1800000000
+
+        # First result sets it outright.
+        mark_complete(db, 1, status_id, t, rtt=40)
+        assert(status.success_ewma == 1.0)
+        assert(status.rtt_ewma == 40.0)
+
+        # A failure one half life later halves it.
+        t += SUCCESS_HALF_LIFE
+        mark_complete(db, 0, status_id, t, rtt=None)
+        assert(abs(status.success_ewma - 0.5) < 1e-9)
+        assert(status.rtt_ewma == 40.0)
+
+        # Latency moves towards new samples.
+        t += 60
+        mark_complete(db, 1, status_id, t, rtt=140)
+        assert(abs(status.rtt_ewma - (40 + RTT_EWMA_ALPHA * 100)) < 1e-9)
+
+    def test_latency_ranks_faster_servers_higher(self):
+        scorer = LatencyScorer()
+        fast = {"test_no": 100, "success_ewma": 1.0, "rtt_ewma": 10.0}
+        slow = {"test_no": 100, "success_ewma": 1.0, "rtt_ewma": 500.0}
+        failing = {"test_no": 100, "success_ewma": 0.2, "rtt_ewma": 10.0}
+        assert(scorer.score(fast) > scorer.score(slow))
+        assert(scorer.score(fast) > scorer.score(failing))
+
+    def test_outcome_rtt(self):
+        statuses = outcome_statuses([1, 2], 1, 5, 12.5)
+        assert(statuses[0] == {"is_success": 1, "status_id": 1, "t": 5, "rtt": 12.5})
+        assert("rtt" not in outcome_statuses([1], 0, 5)[0])
+
+    @unittest.skipUnless(np is not None, "needs numpy")
+    def test_latency_batch_matches_scalar(self):
+        db = service_db(100)
+        rand = random.Random(4)
+        for status in db.statuses.values():
+            status.test_no = rand.randrange(0, 200)
+            status.success_ewma = rand.random()
+            status.rtt_ewma = rand.choice([0.0, rand.uniform(1, 1000)])
+
+        scorer = LatencyScorer()
+        scores = score_statuses(db, list(db.statuses), scorer)
+        for status_id, status in db.statuses.items():
+            assert(abs(scores[status_id] - scorer.score(status.dict())) < 1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import json
+import gzip
+import time
+import unittest
+from p2pd import IP4, IP6, UDP, TCP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.dealer.dealer_utils import (
+    build_server_list,
+    mark_complete,
+)
+from p2pd_server_monitor.dealer.server_list import ServerList, list_name
+
+class TestServerList(unittest.TestCase):
+    def setUp(self):
+        self.db = MemDB()
+        self.db.server_list = ServerList(self.db)
+
+    def insert_group(self, ips, service_type=STUN_MAP_TYPE, af=IP4, proto=UDP, alias_id=None):
+        records = []
+        for ip in ips:
+            records.append(self.db.insert_service(
+                service_type, af, proto, ip, 3478, None, None, alias_id
+            ))
+
+        meta_group = self.db.add_work(af, SERVICES_TABLE_TYPE, records)
+        self.db.server_list.touch_group(meta_group.id)
+        return meta_group
+
+    def complete(self, meta_group, is_success, t):
+        for record in meta_group.group:
+            wq = self.db.work[SERVICES_TABLE_TYPE][meta_group.af]
+            wq.move_work(meta_group.id, STATUS_DEALT)
+            mark_complete(self.db, is_success, record.status_id, t)
+
+    def top_ips(self, service="STUN(see_ip)", af="IPv4", proto="UDP"):
+        s = self.db.server_list.as_dict()
+        return [g[0]["ip"] for g in s[service][af][proto]]
+
+    def test_render_matches_full_build(self):
+        self.insert_group(["8.8.8.8"])
+        self.insert_group(["8.8.4.4"], proto=TCP)
+        self.insert_group(["2001:4860:4860::8888"], af=IP6)
+        t = int(time.time())
+        for meta_group in list(self.db.groups.values())[:2]:
+            self.complete(meta_group, 1, t)
+
+        text = self.db.server_list.render()
+        expected = build_server_list(self.db)
+        expected["timestamp"] = self.db.server_list.timestamp
+        assert(text == json.dumps(expected, separators=(",", ":"), default=str))
+
+    def test_completed_work_reorders_groups(self):
+        first = self.insert_group(["8.8.8.8"])
+        second = self.insert_group(["8.8.4.4"])
+        t = int(time.time())
+        self.complete(second, 1, t)
+        self.complete(first, 0, t)
+        assert(self.top_ips() == ["8.8.4.4", "8.8.8.8"])
+
+        for i in range(1, 4):
+            self.complete(first, 1, t + i)
+        self.complete(second, 0, t + 4)
+        assert(self.top_ips() == ["8.8.8.8", "8.8.4.4"])
+
+    def test_render_is_cached_until_change(self):
+        meta_group = self.insert_group(["8.8.8.8"])
+        text = self.db.server_list.render()
+        assert(self.db.server_list.render() is text)
+
+        self.complete(meta_group, 1, int(time.time()))
+        assert(self.db.server_list.render() is not text)
+
+    def test_alias_ip_updates_fqns(self):
+        self.insert_group(["8.8.8.8"])
+        self.db.server_list.render()
+
+        alias = self.db.record_alias(IP4, "dns.google", "8.8.8.8")
+        self.db.server_list.touch_ip(alias.ip)
+        s = self.db.server_list.as_dict()
+        assert(s["STUN(see_ip)"]["IPv4"]["UDP"][0][0]["fqns"] == ["dns.google"])
+
+    def test_snapshot_is_compressed_and_etagged(self):
+        self.insert_group(["8.8.8.8"])
+        snapshot = self.db.server_list.snapshot()
+        assert(gzip.decompress(snapshot.encodings["gzip"]) == snapshot.body)
+        assert(snapshot.matches(snapshot.etag))
+        assert(snapshot.matches("W/" + snapshot.etag + ", \"x\""))
+        assert(not snapshot.matches('"x"'))
+
+        encoding, body = snapshot.pick_encoding("gzip;q=0.5, identity")
+        assert(encoding == "gzip")
+        assert(snapshot.etags["gzip"] != snapshot.etag)
+        assert(snapshot.etags["gzip"] == snapshot.etag[:-1] + '-gzip"')
+        assert(snapshot.matches(snapshot.etags["gzip"]))
+        encoding, body = snapshot.pick_encoding("gzip;q=0")
+        assert(encoding is None and body == snapshot.body)
+
+    def test_snapshot_rebuilt_only_after_refresh(self):
+        meta_group = self.insert_group(["8.8.8.8"])
+        snapshot = self.db.server_list.snapshot()
+        self.complete(meta_group, 1, int(time.time()))
+        assert(self.db.server_list.snapshot() is snapshot)
+
+        fresh = self.db.server_list.snapshot(max_age=0)
+        assert(fresh is not snapshot)
+        assert(fresh.etag != snapshot.etag)
+
+        # Unchanged list keeps the same snapshot.
+        assert(self.db.server_list.snapshot(max_age=0) is fresh)
+
+    def test_query_pages_through_matching_buckets(self):
+        t = int(time.time())
+        for i in range(5):
+            meta_group = self.insert_group(["8.8.8.%d" % (i + 1)])
+            for j in range(i):
+                self.complete(meta_group, 1, t + j)
+
+        self.insert_group(["8.8.4.4"], proto=TCP)
+        server_list = self.db.server_list
+        groups, cursor = server_list.query(
+            service_type="STUN(see_ip)", af="IPv4", proto="UDP", limit=2
+        )
+        assert([g[0]["ip"] for g in groups] == ["8.8.8.5", "8.8.8.4"])
+
+        groups, cursor = server_list.query(
+            service_type="STUN(see_ip)", af="IPv4", proto="UDP", limit=2,
+            cursor=cursor
+        )
+        assert([g[0]["ip"] for g in groups] == ["8.8.8.3", "8.8.8.2"])
+
+        groups, cursor = server_list.query(
+            service_type="STUN(see_ip)", af="IPv4", proto="UDP", limit=2,
+            cursor=cursor
+        )
+        assert([g[0]["ip"] for g in groups] == ["8.8.8.1"])
+        assert(cursor is None)
+
+        # Any proto merges buckets by score.
+        groups, _ = server_list.query(af="IPv4", limit=10)
+        assert(len(groups) == 6)
+        scores = [g[0]["score"] for g in groups]
+        assert(scores == sorted(scores, reverse=True))
+
+    def test_query_min_score_and_fields(self):
+        t = int(time.time())
+        good = self.insert_group(["8.8.8.8"])
+        self.insert_group(["8.8.4.4"])
+        self.complete(good, 1, t)
+
+        groups, cursor = self.db.server_list.query(
+            min_score=0.001, fields=["ip", "score"]
+        )
+        assert(groups == [[{"ip": "8.8.8.8", "score": groups[0][0]["score"]}]])
+        assert(cursor is None)
+
+    def test_list_name_accepts_enums_and_names(self):
+        assert(list_name(str(int(IP6)), {IP4: "IPv4", IP6: "IPv6"}) == "IPv6")
+        assert(list_name("UDP", {UDP: "UDP", TCP: "TCP"}) == "UDP")
+        self.assertRaises(ValueError, list_name, "x", {UDP: "UDP"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import time
+import tempfile
+import unittest
+from p2pd import IP4, UDP
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.db.status_store import StatusStore, np
+from p2pd_server_monitor.dealer.dealer_utils import mark_complete
+
+@unittest.skipUnless(np is not None, "needs numpy")
+class TestStatusStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "status.bin")
+        self.db = MemDB()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def insert_service(self, ip):
+        record = self.db.insert_service(
+            STUN_MAP_TYPE, IP4, UDP, ip, 3478, None, None, None
+        )
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [record])
+        return record
+
+    def test_mark_complete_updates_in_place(self):
+        self.db.status_store = StatusStore(self.path, capacity=2)
+        records = [self.insert_service("8.8.8.%d" % (i,)) for i in range(1, 6)]
+        record = records[-1]
+        self.db.work[SERVICES_TABLE_TYPE][IP4].move_work(
+            record.group_id,
+            STATUS_DEALT
+        )
+        mark_complete(self.db, 0, record.status_id, int(time.time()))
+
+        store = self.db.status_store
+        status = self.db.statuses[record.status_id]
+        assert(store.get(record.status_id) == status.dict())
+        assert(store.column("failed_tests")[record.status_id] == 1)
+        assert(int(store.valid().sum()) == len(self.db.statuses))
+
+    def test_readers_share_the_file(self):
+        self.db.status_store = StatusStore(self.path)
+        record = self.insert_service("8.8.8.8")
+        self.db.status_store.flush()
+
+        reader = StatusStore.open_readonly(self.path)
+        assert(reader.get(record.status_id)["row_id"] == record.id)
+
+        # Writes show up without reopening.
+        status = self.db.statuses[record.status_id]
+        status.test_no = 7
+        self.db.mark_dirty(STATUS_TABLE_TYPE, status.id)
+        assert(reader.get(record.status_id)["test_no"] == 7)
+
+    def test_bulk_load(self):
+        for i in range(1, 20):
+            self.insert_service("8.8.8.%d" % (i,))
+
+        store = StatusStore(capacity=4)
+        store.load(self.db.statuses.values())
+        for status in self.db.statuses.values():
+            assert(store.get(status.id) == status.dict())
+
+        self.db.status_store = store
+        self.db.mark_deleted(STATUS_TABLE_TYPE, 1)
+        assert(store.get(1) is None)
+
+if __name__ == '__main__':
+    unittest.main()
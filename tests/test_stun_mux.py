@@ -0,0 +1,195 @@
+import sys
+import time
+import struct
+import socket
+import asyncio
+import unittest
+import unittest.mock
+from p2pd import IP4, IP6, UDP, RFC3489, RFC5389, ErrorNoReply, OPEN_INTERNET, NA_DELTA, Interface
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.stun_mux import StunMux
+from p2pd_server_monitor.worker.worker_utils import validate_rfc3489_stun_server, stun_server_classifier
+
+worker_utils = sys.modules["p2pd_server_monitor.worker.worker_utils"]
+
+def stun_reply(request, addr):
+    # Binding success with a MAPPED-ADDRESS of addr.
+    attr = struct.pack("!BBH", 0, 1, addr[1]) + socket.inet_aton(addr[0])
+    body = struct.pack("!HH", 0x0001, len(attr)) + attr
+    return struct.pack("!HH", 0x0101, len(body)) + request[4:20] + body
+
+# Loopback with a made up public IP -- enough for p2pd routes.
+LOOPBACK_INFO = {
+    "id": "lo",
+    "name": "lo",
+    "mac": "00-00-00-00-00-00",
+    "is_default": {int(IP4): True, int(IP6): False},
+    "nat": {"type": OPEN_INTERNET, "delta": {"type": NA_DELTA, "value": 0}},
+    "netiface_index": 1,
+    "nic_no": 0,
+    "rp": {
+        int(IP4): [{
+            "af": int(IP4),
+            "nic_ips": [{"af": int(IP4), "cidr": 32, "ip": "127.0.0.1"}],
+            "ext_ips": [{"af": int(IP4), "cidr": 32, "ip": "8.8.8.8"}],
+            "link_local_ips": [],
+        }],
+        int(IP6): [],
+    },
+}
+
+class FakeStunServer(asyncio.DatagramProtocol):
+    """
+    Answers binding requests. A change port request is answered
+    from the alt socket like a real RFC3489 server.
+    """
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.seen = 0
+        self.alt = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.seen += 1
+        if self.drop:
+            self.drop -= 1
+            return
+
+        change_port = data[20:24] == b"\x00\x03\x00\x04" and data[27] & 2
+        transport = self.alt if change_port else self.transport
+        transport.sendto(stun_reply(data, addr), addr)
+
+async def start_server(drop=0):
+    loop = asyncio.get_running_loop()
+    server = FakeStunServer(drop)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: server,
+        local_addr=("127.0.0.1", 0)
+    )
+    server.alt, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol,
+        local_addr=("127.0.0.1", 0)
+    )
+
+    server.port = transport.get_extra_info("sockname")[1]
+    server.alt_port = server.alt.get_extra_info("sockname")[1]
+    return server
+
+class TestStunMux(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = await start_server()
+        self.mux = StunMux(socket_no=2, timeout=2)
+
+    async def asyncTearDown(self):
+        await self.mux.close()
+        self.server.transport.close()
+        self.server.alt.close()
+
+    async def test_many_probes_few_sockets(self):
+        dest = ("127.0.0.1", self.server.port)
+        tasks = [self.mux.get_wan_ip(IP4, dest) for _ in range(500)]
+        ips = await asyncio.gather(*tasks)
+        assert(ips == ["127.0.0.1"] * 500)
+        assert(self.mux.fd_count() == 2)
+        assert(not self.mux.pending)
+
+    async def test_mux_binds_nic_route(self):
+        mux = StunMux(Interface.from_dict(LOOPBACK_INFO), socket_no=1, timeout=2)
+        dest = ("127.0.0.1", self.server.port)
+        try:
+            assert(await mux.get_wan_ip(IP4, dest) == "127.0.0.1")
+        finally:
+            await mux.close()
+
+    async def test_change_port_reply(self):
+        dest = ("127.0.0.1", self.server.port)
+        reply = await self.mux.get_change_port_reply(
+            IP4,
+            dest,
+            ("127.0.0.1", self.server.alt_port)
+        )
+
+        assert(reply.stup == ("127.0.0.1", self.server.alt_port))
+
+    async def test_reply_from_wrong_address_is_ignored(self):
+        # Server answers from its main port but the alt port is wanted.
+        dest = ("127.0.0.1", self.server.port)
+        with self.assertRaises(ErrorNoReply):
+            await self.mux.request(
+                IP4,
+                dest,
+                RFC3489,
+                reply_addr=("127.0.0.1", self.server.alt_port),
+                timeout=0.3
+            )
+
+        assert(self.mux.stats["ignored"])
+        assert(not self.mux.pending)
+
+    async def test_lost_requests_are_resent(self):
+        self.server.drop = 1
+        dest = ("127.0.0.1", self.server.port)
+        ip = await self.mux.get_wan_ip(IP4, dest, RFC5389)
+        assert(ip == "127.0.0.1")
+        assert(self.server.seen == 2)
+
+class TestParallelValidation(unittest.IsolatedAsyncioTestCase):
+    async def test_change_checks_run_at_once(self):
+        async def check(*args):
+            await asyncio.sleep(0.2)
+
+        start = time.perf_counter()
+        with unittest.mock.patch.object(worker_utils, "validate_stun_server_mux", check):
+            await validate_rfc3489_stun_server(
+                IP4, UDP, object(), ("1.1.1.1", 3478, 3479), ("8.8.8.8", 3478, 3479)
+            )
+
+        assert(time.perf_counter() - start < 0.5)
+
+    async def test_first_failure_cancels_the_rest(self):
+        cancelled = []
+        async def check(mux, af, ip, port, mode, cip, cport):
+            if cport is None:
+                raise ErrorNoReply("no reply")
+
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(cport)
+                raise
+
+        start = time.perf_counter()
+        with unittest.mock.patch.object(worker_utils, "validate_stun_server_mux", check):
+            with self.assertRaises(ErrorNoReply):
+                await validate_rfc3489_stun_server(
+                    IP4, UDP, object(), ("1.1.1.1", 3478, 3479), ("8.8.8.8", 3478, 3479)
+                )
+
+        await asyncio.sleep(0)
+        assert(time.perf_counter() - start < 1)
+        assert(len(cancelled) == 2)
+
+    async def test_classifier_deadline_keeps_finished_checks(self):
+        async def hangs(*args):
+            await asyncio.sleep(60)
+
+        async def map_check(af, ip, port, nic, stun_proto, stun_mode, stun_type):
+            if stun_proto == UDP:
+                raise ErrorNoReply("no reply")
+
+            return [[stun_type, int(af), int(stun_proto), ip, port, None, None]]
+
+        start = time.perf_counter()
+        with unittest.mock.patch.object(worker_utils, "classify_rfc3489", hangs):
+            with unittest.mock.patch.object(worker_utils, "classify_stun_map", map_check):
+                servers = await stun_server_classifier(
+                    IP4, "1.1.1.1", 3478, object(), deadline=0.3
+                )
+
+        assert(time.perf_counter() - start < 1)
+        assert(servers == [[[STUN_MAP_TYPE, int(IP4), int(TCP), "1.1.1.1", 3478, None, None]]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import time
+import unittest
+from p2pd import IP4, IP6, VALID_AFS
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.db.mem_db import MemDB
+from p2pd_server_monitor.worker.work_queue import WorkQueue
+from p2pd_server_monitor.dealer.dealer_utils import (
+    allocate_work,
+    allocate_work_lease,
+    release_lease,
+    mark_complete,
+)
+from p2pd_server_monitor.dealer.dealer_core import update_alias, work_done
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.db = MemDB()
+
+    def get_work(self, current_time=None, mon_freq=MONITOR_FREQUENCY, table_types=TABLE_TYPES):
+        current_time = current_time or int(time.time())
+        return allocate_work(
+            self.db,
+            VALID_AFS,
+            table_types,
+            current_time,
+            mon_freq
+        )
+
+    def insert_import(self, ip, port=3478):
+        record = self.db.insert_import(STUN_MAP_TYPE, IP4, ip, port)
+        self.db.add_work(IP4, IMPORTS_TABLE_TYPE, [record])
+        return record
+
+    def test_init_work_should_be_handed_out_once(self):
+        self.insert_import("8.8.8.8")
+        work = self.get_work()
+        assert(len(work))
+        assert(not len(self.get_work()))
+
+    def test_available_work_waits_for_monitor_frequency(self):
+        self.insert_import("8.8.8.8")
+        work = self.get_work()
+        group_id = work[0]["group_id"]
+        wq = self.db.work[IMPORTS_TABLE_TYPE][IP4]
+        wq.move_work(group_id, STATUS_AVAILABLE)
+
+        now = int(time.time())
+        assert(not len(self.get_work(current_time=now)))
+        later = now + MONITOR_FREQUENCY + 1
+        assert(len(self.get_work(current_time=later)))
+
+        # Overrides shift the due time for all available work.
+        wq.move_work(group_id, STATUS_AVAILABLE)
+        assert(len(self.get_work(current_time=now + 11, mon_freq=10)))
+
+    def test_dealt_work_reallocated_after_worker_timeout(self):
+        self.insert_import("8.8.8.8")
+        assert(len(self.get_work()))
+        assert(not len(self.get_work()))
+
+        later = int(time.time()) + WORKER_TIMEOUT + 1
+        assert(len(self.get_work(current_time=later)))
+
+    def test_most_overdue_work_is_allocated_first(self):
+        first = self.insert_import("8.8.8.8")
+        second = self.insert_import("8.8.4.4")
+        for _ in range(2):
+            self.get_work()
+
+        # Put second back first so its due time is oldest.
+        wq = self.db.work[IMPORTS_TABLE_TYPE][IP4]
+        wq.move_work(second.group_id, STATUS_AVAILABLE)
+        wq.move_work(first.group_id, STATUS_AVAILABLE, delay=10)
+        later = int(time.time()) + 11
+        work = self.get_work(current_time=later)
+        assert(work[0]["group_id"] == first.group_id)
+
+    def test_stale_heap_entries_are_compacted(self):
+        wq = WorkQueue()
+        wq.add_work(1, None, STATUS_AVAILABLE)
+        for _ in range(1000):
+            wq.move_work(1, STATUS_AVAILABLE)
+
+        assert(len(wq.heaps[STATUS_AVAILABLE]) <= 65)
+        assert(wq.next_due()[2] == 1)
+
+    def test_lease_should_hand_out_batch_of_groups(self):
+        for i in range(5):
+            self.insert_import("8.8.8.%d" % (i + 1))
+
+        now = int(time.time())
+        lease = allocate_work_lease(
+            self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 3
+        )
+        assert(len(lease["groups"]) == 3)
+        assert(lease["lease_id"] in self.db.leases)
+
+        # Rest of the work is still available.
+        lease = allocate_work_lease(
+            self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 10
+        )
+        assert(len(lease["groups"]) == 2)
+
+    def test_lease_time_sets_worker_timeout(self):
+        self.insert_import("8.8.8.8")
+        now = int(time.time())
+        lease = allocate_work_lease(
+            self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 1, 5
+        )
+        assert(lease["lease_time"] == 5)
+        assert(not len(self.get_work(current_time=now + 4)))
+        assert(len(self.get_work(current_time=now + 6)))
+
+    def test_release_lease_returns_unfinished_work(self):
+        self.insert_import("8.8.8.8")
+        self.insert_import("8.8.4.4")
+        now = int(time.time())
+        lease = allocate_work_lease(
+            self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 2
+        )
+
+        # Only the first group is reported as done.
+        done = lease["groups"][0][0]
+        mark_complete(self.db, 1, done["status_id"])
+        released = release_lease(self.db, lease["lease_id"], [done["status_id"]])
+        assert(released == 1)
+        assert(lease["lease_id"] not in self.db.leases)
+
+        work = self.get_work()
+        assert(work[0]["group_id"] == lease["groups"][1][0]["group_id"])
+
+    def test_bad_status_does_not_lose_lease(self):
+        self.insert_import("8.8.8.8")
+        self.insert_import("8.8.4.4")
+        now = int(time.time())
+        lease = allocate_work_lease(
+            self.db, VALID_AFS, TABLE_TYPES, now, MONITOR_FREQUENCY, 2
+        )
+
+        # Second status is malformed so its group goes back.
+        first, second = [g[0] for g in lease["groups"]]
+        statuses = [
+            {"is_success": 1, "status_id": first["status_id"]},
+            {"is_success": 1, "status_id": second["status_id"], "bogus": 1},
+            {"is_success": 1},
+        ]
+        assert(work_done(self.db, statuses, lease["lease_id"]) == [None])
+        assert(lease["lease_id"] not in self.db.leases)
+
+        work = self.get_work()
+        assert(work[0]["group_id"] == second["group_id"])
+
+    def test_imports_wait_for_their_alias(self):
+        record = self.db.insert_import(STUN_MAP_TYPE, IP4, None, 3478, fqn="stun.example.com")
+        self.db.add_work(IP4, IMPORTS_TABLE_TYPE, [record])
+        wq = self.db.work[IMPORTS_TABLE_TYPE][IP4]
+        assert(wq.index[record.group_id][0] == STATUS_HELD)
+
+        # Only the alias can be dealt.
+        work = self.get_work()
+        assert(work[0]["table_type"] == ALIASES_TABLE_TYPE)
+        assert(not len(self.get_work()))
+
+        # Resolving it releases the import straight away.
+        update_alias(self.db, record.alias_id, "8.8.8.8")
+        work = self.get_work()
+        assert(work[0]["id"] == record.id)
+        assert(work[0]["ip"] == "8.8.8.8")
+
+    def test_aliases_are_dealt_before_older_work(self):
+        service = self.db.insert_service(STUN_MAP_TYPE, IP4, UDP, "8.8.8.8", 3478, None, None, None)
+        self.db.add_work(IP4, SERVICES_TABLE_TYPE, [service])
+        self.db.record_alias(IP4, "stun.example.com")
+
+        work = self.get_work(current_time=int(time.time()) + 60)
+        assert(work[0]["table_type"] == ALIASES_TABLE_TYPE)
+        assert(self.get_work()[0]["id"] == service.id)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+from p2pd_server_monitor.defs import *
+from p2pd_server_monitor.worker.worker_pool import WorkerPool
+
+def make_group(status_id, service_type=STUN_MAP_TYPE):
+    return [{
+        "status_id": status_id,
+        "table_type": SERVICES_TABLE_TYPE,
+        "type": service_type,
+    }]
+
+class FakePool(WorkerPool):
+    def __init__(self, groups, **kwargs):
+        super().__init__(
+            None,
+            None,
+            self.fake_probe,
+            fetch_interval=0,
+            **kwargs
+        )
+        self.pending = list(groups)
+        self.completed = {}
+        self.lease_sizes = []
+        self.active = {}
+        self.most_active = {}
+
+    async def lease(self, max_groups):
+        self.lease_sizes.append(max_groups)
+        groups = self.pending[:max_groups]
+        self.pending = self.pending[max_groups:]
+        if not groups:
+            self.stop()
+
+        return len(self.lease_sizes), groups
+
+    async def complete(self, lease_id, outcomes):
+        self.completed[lease_id] = outcomes
+
+    async def fake_probe(self, nic, curl, init_work=None):
+        service_type = init_work[0]["type"]
+        self.active[service_type] = self.active.get(service_type, 0) + 1
+        self.most_active[service_type] = max(
+            self.most_active.get(service_type, 0),
+            self.active[service_type]
+        )
+
+        await asyncio.sleep(0.01)
+        self.active[service_type] -= 1
+        return 1, [init_work[0]["status_id"]]
+
+class TestWorkerPool(unittest.IsolatedAsyncioTestCase):
+    async def test_every_lease_is_completed_once(self):
+        groups = [make_group(i) for i in range(50)]
+        pool = FakePool(groups, task_no=20)
+        await asyncio.wait_for(pool.run(), 5)
+
+        status_ids = []
+        for outcomes in pool.completed.values():
+            for is_success, ids in outcomes:
+                status_ids += ids
+
+        assert(sorted(status_ids) == list(range(50)))
+        assert(not pool.leases)
+        assert(not pool.in_flight)
+
+    async def test_leases_never_exceed_free_slots(self):
+        groups = [make_group(i) for i in range(50)]
+        pool = FakePool(groups, task_no=4)
+        await asyncio.wait_for(pool.run(), 5)
+        assert(max(pool.lease_sizes) <= 4)
+
+    async def test_service_type_limits_are_respected(self):
+        groups = [make_group(i, NTP_TYPE) for i in range(30)]
+        groups += [make_group(i + 30, MQTT_TYPE) for i in range(30)]
+        limits = {NTP_TYPE: 3, None: 5}
+        pool = FakePool(groups, task_no=20, limits=limits)
+        await asyncio.wait_for(pool.run(), 5)
+        assert(pool.most_active[NTP_TYPE] <= 3)
+        assert(pool.most_active[MQTT_TYPE] <= 5)
+
+    async def test_stop_drains_in_flight_work(self):
+        groups = [make_group(i) for i in range(10)]
+        pool = FakePool(groups, task_no=10)
+        task = asyncio.create_task(pool.run())
+        await asyncio.sleep(0)
+        pool.stop()
+        await asyncio.wait_for(task, 5)
+        assert(not pool.in_flight)
+        assert(not pool.leases)
+
+if __name__ == '__main__':
+    unittest.main()